@@ -0,0 +1,261 @@
+# This file is copied into the base image and provides a catalog of datastream writes
+# so that scheduling queries don't have to list the datastream's objects in S3
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogBackend:
+    S3 = "s3"
+    SQLite = "sqlite"
+
+
+class DatastreamCatalog(ABC):
+    """Records each successful write of a datastream (data date range, object keys and
+    write time) so that `last_modified` and `modified_since` are answered with a
+    single lookup instead of listing the datastream's storage area.
+
+    Both query methods return None if the catalog has no record of the datastream, so
+    callers can fall back to the storage listing (e.g., for data written before the
+    catalog was enabled).
+    """
+
+    @abstractmethod
+    def record(
+        self,
+        datastream: str,
+        start: datetime,
+        end: datetime,
+        keys: List[str],
+        written: Optional[datetime] = None,
+    ):
+        """Record a write of the datastream.
+
+        Args:
+            datastream (str): the datastream that was written
+            start (datetime): first data timestamp in the write
+            end (datetime): last data timestamp in the write
+            keys (List[str]): object keys that were written
+            written (datetime, optional): time of the write.  Defaults to now.
+        """
+
+    @abstractmethod
+    def last_modified(self, datastream: str) -> Optional[datetime]:
+        """Time of the most recent write of the datastream, or None if unknown."""
+
+    @abstractmethod
+    def modified_since(
+        self, datastream: str, last_modified: Optional[datetime]
+    ) -> Optional[List[datetime]]:
+        """Data start dates of all writes after last_modified, or None if unknown."""
+
+
+class S3JsonCatalog(DatastreamCatalog):
+    """Catalog with one JSON document per datastream in the output bucket
+    (`s3://{bucket}/{prefix}/{datastream}.json`).  Concurrent writers are handled with
+    conditional puts, retrying if the document changed in between."""
+
+    # Number of writes kept per datastream
+    MAX_ENTRIES = 5000
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, client, bucket: str, prefix: str = "catalog"):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def record(
+        self,
+        datastream: str,
+        start: datetime,
+        end: datetime,
+        keys: List[str],
+        written: Optional[datetime] = None,
+    ):
+        entry = _make_entry(start, end, keys, written)
+        for attempt in range(self.MAX_ATTEMPTS):
+            doc, etag = self._get(datastream)
+            doc["entries"] = (doc["entries"] + [entry])[-self.MAX_ENTRIES :]
+            doc["last_modified"] = max(doc.get("last_modified") or "", entry["written"])
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+            try:
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=self._get_key(datastream),
+                    Body=json.dumps(doc).encode(),
+                    ContentType="application/json",
+                    **condition,
+                )
+                return
+            except self.client.exceptions.ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                logger.debug("Catalog for %s changed, retrying (%s)", datastream, code)
+                time.sleep(0.1 * (attempt + 1))
+        raise RuntimeError(f"Could not update the catalog for {datastream}")
+
+    def last_modified(self, datastream: str) -> Optional[datetime]:
+        doc, etag = self._get(datastream)
+        if not etag or not doc.get("last_modified"):
+            return None
+        return datetime.fromisoformat(doc["last_modified"])
+
+    def modified_since(
+        self, datastream: str, last_modified: Optional[datetime]
+    ) -> Optional[List[datetime]]:
+        doc, etag = self._get(datastream)
+        if not etag:
+            return None
+        return _filter_entries(doc["entries"], last_modified)
+
+    def _get_key(self, datastream: str) -> str:
+        return f"{self.prefix}/{datastream}.json"
+
+    def _get(self, datastream: str):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._get_key(datastream)
+            )
+        except self.client.exceptions.NoSuchKey:
+            return {"datastream": datastream, "entries": []}, None
+        return json.loads(response["Body"].read()), response["ETag"]
+
+
+class SQLiteCatalog(DatastreamCatalog):
+    """Catalog stored in a local SQLite database.  Useful for running and testing
+    pipelines locally."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS writes (datastream TEXT NOT NULL, start"
+                " TEXT NOT NULL, end TEXT NOT NULL, keys TEXT NOT NULL, written TEXT"
+                " NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS writes_by_datastream ON writes"
+                " (datastream, written)"
+            )
+
+    def record(
+        self,
+        datastream: str,
+        start: datetime,
+        end: datetime,
+        keys: List[str],
+        written: Optional[datetime] = None,
+    ):
+        entry = _make_entry(start, end, keys, written)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO writes VALUES (?, ?, ?, ?, ?)",
+                (
+                    datastream,
+                    entry["start"],
+                    entry["end"],
+                    json.dumps(entry["keys"]),
+                    entry["written"],
+                ),
+            )
+
+    def last_modified(self, datastream: str) -> Optional[datetime]:
+        with self._connect() as conn:
+            (written,) = conn.execute(
+                "SELECT MAX(written) FROM writes WHERE datastream = ?", (datastream,)
+            ).fetchone()
+        return datetime.fromisoformat(written) if written else None
+
+    def modified_since(
+        self, datastream: str, last_modified: Optional[datetime]
+    ) -> Optional[List[datetime]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT start, written FROM writes WHERE datastream = ?", (datastream,)
+            ).fetchall()
+        if not rows:
+            return None
+        entries = [{"start": start, "written": written} for start, written in rows]
+        return _filter_entries(entries, last_modified)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection's own context manager only commits or rolls back, so also
+        # close it, or a warm container leaks a connection per query
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            yield conn
+
+
+def _make_entry(
+    start: datetime, end: datetime, keys: List[str], written: Optional[datetime]
+) -> Dict:
+    written = written or datetime.now(timezone.utc)
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "keys": keys,
+        "written": written.astimezone(timezone.utc).isoformat(),
+    }
+
+
+def _filter_entries(
+    entries: List[Dict], last_modified: Optional[datetime]
+) -> List[datetime]:
+    return [
+        datetime.fromisoformat(entry["start"])
+        for entry in entries
+        if last_modified is None
+        or datetime.fromisoformat(entry["written"]) > last_modified
+    ]
+
+
+_CATALOG: Optional[DatastreamCatalog] = None
+_CATALOG_SETTINGS = None
+
+
+def get_catalog() -> Optional[DatastreamCatalog]:
+    """Get the catalog configured by the TSDAT_CATALOG (s3 or sqlite) and
+    TSDAT_CATALOG_PATH (key prefix in the output bucket or path to the database file)
+    environment variables, which are set by the lambda function from the `catalog`
+    section of pipelines_config.yml.  Returns None if no catalog is configured."""
+    global _CATALOG, _CATALOG_SETTINGS
+
+    backend = os.environ.get("TSDAT_CATALOG", "").lower()
+    path = os.environ.get("TSDAT_CATALOG_PATH")
+    bucket = os.environ.get("TSDAT_S3_BUCKET_NAME")
+    settings = (backend, path, bucket)
+    if settings == _CATALOG_SETTINGS:
+        return _CATALOG
+
+    if backend == CatalogBackend.S3:
+        import boto3
+
+        _CATALOG = S3JsonCatalog(boto3.client("s3"), bucket, path or "catalog")
+    elif backend == CatalogBackend.SQLite:
+        _CATALOG = SQLiteCatalog(path or "catalog.db")
+    elif backend:
+        raise ValueError(f"Unknown datastream catalog backend: {backend}")
+    else:
+        _CATALOG = None
+
+    _CATALOG_SETTINGS = settings
+    return _CATALOG
+
+
+def record_write(datastream: str, start: datetime, end: datetime, keys: List[str]):
+    """Record a datastream write in the configured catalog, if any."""
+    catalog = get_catalog()
+    if catalog is not None:
+        catalog.record(datastream, start, end, keys)
@@ -29,12 +29,68 @@ class Env:
     AWS_DEFAULT_REGION = os.environ.get("AWS_DEFAULT_REGION")
 
     LAMBDA_ROLE_ARN = os.environ.get("LAMBDA_ROLE_ARN")
+
+    # Role the EventBridge Scheduler uses to invoke debounced (Upstream trigger) runs
+    SCHEDULER_ROLE_ARN = os.environ.get("SCHEDULER_ROLE_ARN")
+
+    # Fargate resources for configs with the container backend, passed in by the
+    # stack (empty if no config uses it).  The subnet ids are comma-separated.
+    CONTAINER_CLUSTER_ARN = os.environ.get("CONTAINER_CLUSTER_ARN", "")
+    CONTAINER_SUBNET_IDS = os.environ.get("CONTAINER_SUBNET_IDS", "")
+    CONTAINER_SECURITY_GROUP_ID = os.environ.get("CONTAINER_SECURITY_GROUP_ID", "")
+    CONTAINER_EXECUTION_ROLE_ARN = os.environ.get("CONTAINER_EXECUTION_ROLE_ARN", "")
+    CONTAINER_LOG_GROUP = os.environ.get("CONTAINER_LOG_GROUP", "")
+
+    # SNS topic the pipelines' alarms notify, passed in by the stack
+    ALARM_TOPIC_ARN = os.environ.get("ALARM_TOPIC_ARN", "")
     TRIGGER = os.environ.get("TRIGGER")
 
+    # Which part of the build to run (see BuildStep).  Set by the stack for each
+    # CodePipeline action when batch builds are enabled.
+    BUILD_STEP = os.environ.get("BUILD_STEP")
+
+    # Comma-separated list of pipelines to build, exported by the base build step and
+    # passed to each build shard.  Also selects the pipelines to roll back.
+    PIPELINES_TO_BUILD = os.environ.get("PIPELINES_TO_BUILD", "")
+
+    # The shard of the pipelines list that this build node is responsible for
+    SHARD_INDEX = int(os.environ.get("SHARD_INDEX", 0))
+    SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 1))
+
     # This is passed into the build environment automatically by AWS
     CODE_VERSION = os.environ.get("CODEBUILD_RESOLVED_SOURCE_VERSION", "test")
 
 
+class BuildStep:
+    # Build everything on one node (the default)
+    All = "all"
+
+    # Build the base image and export the list of pipelines to build
+    Base = "base"
+
+    # Build and deploy one shard of the pipelines list
+    Shard = "shard"
+
+    # Update the S3 and cron triggers for all pipelines
+    Triggers = "triggers"
+
+    # Point the rollout alias of versioned pipelines back at the previous version
+    Rollback = "rollback"
+
+
+# File the base build step writes the pipelines list to, so buildspec.yml can export it
+PIPELINES_TO_BUILD_FILE = "/tmp/pipelines_to_build"
+
+
+# Key of the synthetic event used to warm up a newly published function version
+WARMUP_EVENT_KEY = "tsdat_warmup"
+
+
+# CloudWatch namespace of the metrics the handler logs (e.g., PipelineFailures), by
+# function name
+METRICS_NAMESPACE = "Tsdat/Pipelines"
+
+
 class PipelineType:
     Ingest = "Ingest"
     VAP = "VAP"
@@ -44,6 +100,26 @@ class Trigger:
     S3 = "S3"
     Cron = "Cron"
 
+    # New output written to one of the pipeline's upstream datastreams
+    Upstream = "Upstream"
+
+
+class S3Routing:
+    # One bucket notification configuration for all of the S3 triggered configs
+    Notifications = "notifications"
+
+    # One EventBridge rule per S3 triggered config
+    EventBridge = "eventbridge"
+
+
+class Backend:
+    # Run in the lambda itself
+    Lambda = "lambda"
+
+    # The lambda starts a Fargate task that runs the same image and handler, for
+    # runs that need more time, memory or disk than a lambda has
+    Container = "container"
+
 
 class Schedule:
     Hourly = "Hourly"
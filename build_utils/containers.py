@@ -0,0 +1,109 @@
+# This file is copied into the base image and runs the configs that have the container
+# backend (see pipelines_config.yml).  The lambda their triggers invoke doesn't run the
+# pipeline:  it starts a Fargate task that runs the same image and lambda_handler on
+# the event (see task_runner.py), so the S3, cron and upstream triggers are unchanged.
+
+import json
+import os
+import uuid
+from typing import Any, Dict
+
+from .constants import Backend
+
+# Name of the container in the task definitions
+CONTAINER_NAME = "pipeline"
+
+# Task overrides are limited to 8 KiB in total, so larger events are passed via S3
+MAX_INLINE_EVENT_BYTES = 6 * 1024
+
+
+def is_container_task() -> bool:
+    """Check if this process is a container task, rather than the lambda that starts
+    them."""
+    return os.environ.get("TSDAT_BACKEND") == Backend.Container
+
+
+def get_task_definitions() -> Dict[str, str]:
+    """The task definition (family:revision) of each config the lambda starts tasks
+    for, from CONTAINER_TASKS.  The revision is pinned by the build, so a rollback of
+    the lambda also rolls back its tasks."""
+    return json.loads(os.environ.get("CONTAINER_TASKS") or "{}")
+
+
+def run_task(event: Any, config_id: str, ecs_client=None, s3_client=None) -> str:
+    """
+    Start the Fargate task that runs the config on the event.  Configured with these
+    environment variables, which the build sets on the lambda:
+
+        CONTAINER_TASKS: JSON object of config id to task definition
+        CONTAINER_CLUSTER: cluster to run the task in
+        CONTAINER_SUBNETS: comma-separated subnet ids for the task
+        CONTAINER_SECURITY_GROUP: security group of the task
+        TSDAT_EVENT_PATH: prefix in the output bucket (TSDAT_S3_BUCKET_NAME) for
+            events too large to pass to the task directly (default task-events)
+
+    Returns:
+        str: the task ARN.
+
+    Raises:
+        RuntimeError: if ECS couldn't start the task, so the invocation fails and is
+        retried.
+    """
+    import boto3
+
+    ecs_client = ecs_client or boto3.client("ecs")
+    task_definition = get_task_definitions()[config_id]
+
+    body = json.dumps(event)
+    if len(body.encode()) <= MAX_INLINE_EVENT_BYTES:
+        event_env = {"name": "TSDAT_EVENT", "value": body}
+    else:
+        s3_client = s3_client or boto3.client("s3")
+        bucket = os.environ["TSDAT_S3_BUCKET_NAME"]
+        prefix = os.environ.get("TSDAT_EVENT_PATH", "task-events").strip("/")
+        key = f"{prefix}/{config_id}/{uuid.uuid4().hex}.json"
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=body.encode(),
+            ContentType="application/json",
+        )
+        event_env = {"name": "TSDAT_EVENT_URI", "value": f"s3://{bucket}/{key}"}
+
+    response = ecs_client.run_task(
+        cluster=os.environ["CONTAINER_CLUSTER"],
+        taskDefinition=task_definition,
+        launchType="FARGATE",
+        count=1,
+        startedBy=f"tsdat-{config_id}"[:36],
+        networkConfiguration={
+            "awsvpcConfiguration": {
+                "subnets": os.environ["CONTAINER_SUBNETS"].split(","),
+                "securityGroups": [os.environ["CONTAINER_SECURITY_GROUP"]],
+                # Public subnets without a NAT gateway:  the task needs a public IP
+                # to pull its image and reach S3
+                "assignPublicIp": "ENABLED",
+            }
+        },
+        overrides={
+            "containerOverrides": [{"name": CONTAINER_NAME, "environment": [event_env]}]
+        },
+    )
+    if response.get("failures") or not response.get("tasks"):
+        raise RuntimeError(
+            f"Failed to start task {task_definition}: {response.get('failures')}"
+        )
+    return response["tasks"][0]["taskArn"]
+
+
+def get_task_event() -> Any:
+    """The event a container task runs, from TSDAT_EVENT, or from the S3 object at
+    TSDAT_EVENT_URI for large events."""
+    if "TSDAT_EVENT" in os.environ:
+        return json.loads(os.environ["TSDAT_EVENT"])
+
+    import boto3
+
+    bucket, key = os.environ["TSDAT_EVENT_URI"][len("s3://") :].split("/", 1)
+    response = boto3.client("s3").get_object(Bucket=bucket, Key=key)
+    return json.loads(response["Body"].read())
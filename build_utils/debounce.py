@@ -0,0 +1,170 @@
+# This file is copied into the base image and is used to coalesce bursts of upstream
+# datastream writes into a single run of the VAPs that depend on them
+
+import hashlib
+import json
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# The "source" of the event that starts a debounced run
+DEBOUNCE_EVENT_SOURCE = "tsdat.debounce"
+
+
+class DebounceBackend:
+    Scheduler = "scheduler"
+    Local = "local"
+
+
+def is_upstream_event(event: Any) -> bool:
+    """True if the event is an S3 "Object Created" event delivered by EventBridge."""
+    return (
+        isinstance(event, dict)
+        and event.get("source") == "aws.s3"
+        and event.get("detail-type") == "Object Created"
+    )
+
+
+def is_debounce_event(event: Any) -> bool:
+    return isinstance(event, dict) and event.get("source") == DEBOUNCE_EVENT_SOURCE
+
+
+class Debouncer(ABC):
+    """Schedules one delayed run of a function per debounce window.  The first
+    request opens the window; requests made while a run is pending are coalesced
+    onto it."""
+
+    @abstractmethod
+    def request(
+        self, function_arn: str, delay: timedelta, config_id: Optional[str] = None
+    ) -> bool:
+        """Request a run of the function after the delay.
+
+        Args:
+            function_arn (str): the function (or alias) to invoke
+            delay (timedelta): the debounce window
+            config_id (Optional[str]): the run config to run, for functions that run
+                several configs.  Each config is debounced separately.
+
+        Returns:
+            bool: True if a new run was scheduled, False if the request was coalesced
+            onto an already pending run.
+        """
+
+    def complete(self, function_arn: str, config_id: Optional[str] = None):
+        """Called by the debounced run when it starts, so later requests open a new
+        window."""
+
+    @staticmethod
+    def get_name(function_arn: str, config_id: Optional[str] = None) -> str:
+        # Schedule names are limited to 64 characters
+        function_name = (
+            function_arn.split(":")[6] if ":" in function_arn else function_arn
+        )
+        digest = hashlib.sha1(f"{function_arn}/{config_id or ''}".encode())
+        return f"{function_name[:50]}-{digest.hexdigest()[:8]}"
+
+    @staticmethod
+    def get_event(config_id: Optional[str] = None) -> Dict[str, str]:
+        """The event the debounced run is invoked with."""
+        event = {
+            "source": DEBOUNCE_EVENT_SOURCE,
+            "requested": datetime.now(timezone.utc).isoformat(),
+        }
+        if config_id:
+            event["config_id"] = config_id
+        return event
+
+
+class SchedulerDebouncer(Debouncer):
+    """Uses one-time EventBridge Scheduler schedules.  The schedule name is unique per
+    function, so creating it fails while a run is still pending, and the schedule
+    deletes itself after it fires."""
+
+    def __init__(self, client, role_arn: str):
+        self.client = client
+        self.role_arn = role_arn
+
+    def request(
+        self, function_arn: str, delay: timedelta, config_id: Optional[str] = None
+    ) -> bool:
+        fire_at = datetime.now(timezone.utc) + delay
+        try:
+            self.client.create_schedule(
+                Name=self.get_name(function_arn, config_id),
+                ScheduleExpression=f"at({fire_at.strftime('%Y-%m-%dT%H:%M:%S')})",
+                ScheduleExpressionTimezone="UTC",
+                FlexibleTimeWindow={"Mode": "OFF"},
+                ActionAfterCompletion="DELETE",
+                Target={
+                    "Arn": function_arn,
+                    "RoleArn": self.role_arn,
+                    "Input": json.dumps(self.get_event(config_id)),
+                },
+            )
+        except self.client.exceptions.ConflictException:
+            return False
+        return True
+
+
+class LocalDebouncer(Debouncer):
+    """Local stand-in for the EventBridge Scheduler that keeps the pending runs in a
+    JSON file.  Nothing is invoked automatically:  call the handler with the pending
+    run's "event" (e.g., `{"source": "tsdat.debounce"}`) to simulate the delayed run,
+    and use `pending()` to check which runs would have been scheduled."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def request(
+        self, function_arn: str, delay: timedelta, config_id: Optional[str] = None
+    ) -> bool:
+        state = self._read()
+        name = self.get_name(function_arn, config_id)
+        if name in state:
+            state[name]["requests"] += 1
+            self._write(state)
+            return False
+        state[name] = {
+            "function_arn": function_arn,
+            "event": self.get_event(config_id),
+            "fire_at": (datetime.now(timezone.utc) + delay).isoformat(),
+            "requests": 1,
+        }
+        self._write(state)
+        return True
+
+    def complete(self, function_arn: str, config_id: Optional[str] = None):
+        state = self._read()
+        state.pop(self.get_name(function_arn, config_id), None)
+        self._write(state)
+
+    def pending(self) -> Dict[str, Dict]:
+        return self._read()
+
+    def _read(self) -> Dict[str, Dict]:
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text())
+
+    def _write(self, state: Dict[str, Dict]):
+        self.path.write_text(json.dumps(state, indent=2))
+
+
+def get_debouncer() -> Debouncer:
+    """Get the debouncer configured by the TSDAT_DEBOUNCE_BACKEND environment variable
+    (scheduler or local, defaults to scheduler).  The scheduler backend uses the role
+    in TSDAT_DEBOUNCE_ROLE_ARN to invoke the function; the local backend keeps its
+    state in the file at TSDAT_DEBOUNCE_PATH."""
+    backend = os.environ.get("TSDAT_DEBOUNCE_BACKEND", DebounceBackend.Scheduler)
+    if backend == DebounceBackend.Local:
+        return LocalDebouncer(os.environ.get("TSDAT_DEBOUNCE_PATH", "debounce.json"))
+    elif backend == DebounceBackend.Scheduler:
+        import boto3
+
+        return SchedulerDebouncer(
+            boto3.client("scheduler"), os.environ["TSDAT_DEBOUNCE_ROLE_ARN"]
+        )
+    raise ValueError(f"Unknown debounce backend: {backend}")
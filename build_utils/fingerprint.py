@@ -0,0 +1,158 @@
+# This file is copied into the base image and lets a VAP skip a window whose inputs
+# haven't changed.  Each run records the storage queries it made and the exact input
+# objects (keys and ETags) it read, and stores a fingerprint of them with its output.
+# The next run of the same window replays the queries (listing only) and skips the
+# run if the fingerprint is the same.
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class InputRecorder:
+    """Records the fetch_data queries of the storage classes in build_utils.storage
+    and the ETags of the objects they found, while recording is on."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = False
+        self.queries: List[Dict[str, Any]] = []
+        self.objects: Dict[str, Optional[str]] = {}
+        self._etags: Dict[str, str] = {}
+
+    @contextmanager
+    def recording(self) -> Iterator["InputRecorder"]:
+        """Record the queries and objects read in the `with` block."""
+        with self._lock:
+            self._active = True
+            self.queries, self.objects, self._etags = [], {}, {}
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._active = False
+
+    def record_listing(self, objects: List[Any]):
+        """Remember the ETags of listed S3 objects (boto3 ObjectSummary)."""
+        with self._lock:
+            if self._active:
+                for obj in objects:
+                    self._etags[obj.key] = obj.e_tag
+
+    def record_found(
+        self,
+        datastream: str,
+        start: datetime,
+        end: datetime,
+        metadata_kwargs: Optional[Dict[str, str]],
+        keys: List[str],
+    ):
+        """Record a query and the keys it found, which are the keys that are read."""
+        with self._lock:
+            if not self._active:
+                return
+            self.queries.append(
+                {
+                    "datastream": datastream,
+                    "start": start.isoformat(),
+                    "end": end.isoformat(),
+                    "metadata_kwargs": metadata_kwargs,
+                }
+            )
+            for key in keys:
+                self.objects[key] = self._etags.get(key)
+
+    def fingerprint(self, code: str) -> Optional[str]:
+        """Hash of the objects read and the code that read them, or None if an ETag
+        is unknown (e.g., the storage class doesn't record its listings)."""
+        if not self.queries or None in self.objects.values():
+            return None
+        body = json.dumps({"code": code, "objects": self.objects}, sort_keys=True)
+        return hashlib.sha256(body.encode()).hexdigest()
+
+
+INPUTS = InputRecorder()
+
+
+def replay(storage, queries: List[Dict[str, Any]]) -> InputRecorder:
+    """Run the recorded queries again, only listing the objects they would read."""
+    with INPUTS.recording() as recorder:
+        for query in queries:
+            storage._find_data(
+                datetime.fromisoformat(query["start"]),
+                datetime.fromisoformat(query["end"]),
+                query["datastream"],
+                metadata_kwargs=query["metadata_kwargs"],
+            )
+    return recorder
+
+
+def get_code_fingerprint(paths: List[Path], *extra: str) -> str:
+    """Hash of the files under the paths (e.g., the pipeline's code and configs) and
+    any extra strings (e.g., the code version), so a deploy that changes how the
+    output is computed reruns every window."""
+    digest = hashlib.sha256()
+    for value in extra:
+        digest.update(value.encode())
+    for path in paths:
+        for file in sorted(path.rglob("*")):
+            if file.is_file() and "__pycache__" not in file.parts:
+                digest.update(file.as_posix().encode())
+                digest.update(file.read_bytes())
+    return digest.hexdigest()
+
+
+class FingerprintStore:
+    """Fingerprints of the last successful run of each datastream and window, stored
+    as objects in the output bucket."""
+
+    def __init__(self, client, bucket: str, prefix: str = "fingerprints"):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def get(self, datastream: str, window: str) -> Optional[Dict[str, Any]]:
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._get_path(datastream, window)
+            )
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def put(self, datastream: str, window: str, fingerprint: str, recorder):
+        body = {
+            "fingerprint": fingerprint,
+            "written": datetime.now(timezone.utc).isoformat(),
+            "queries": recorder.queries,
+            "objects": recorder.objects,
+        }
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._get_path(datastream, window),
+            Body=json.dumps(body).encode(),
+            ContentType="application/json",
+        )
+
+    def _get_path(self, datastream: str, window: str) -> str:
+        return f"{self.prefix}/{datastream}/{window}.json"
+
+
+def get_fingerprint_store() -> Optional[FingerprintStore]:
+    """Get the fingerprint store if TSDAT_FINGERPRINTS is true, or None.  Fingerprints
+    are written to TSDAT_S3_BUCKET_NAME under the TSDAT_FINGERPRINT_PATH prefix
+    (default "fingerprints")."""
+    if os.environ.get("TSDAT_FINGERPRINTS", "").lower() not in ("1", "true", "yes"):
+        return None
+    import boto3
+
+    return FingerprintStore(
+        boto3.client("s3"),
+        os.environ["TSDAT_S3_BUCKET_NAME"],
+        os.environ.get("TSDAT_FINGERPRINT_PATH", "fingerprints"),
+    )
@@ -0,0 +1,344 @@
+# This file is copied into the base image and keeps concurrent invocations from doing
+# the same work twice.  Before running, an invocation takes a lease on its output
+# datastream and time window; an invocation that finds the lease held by a live run
+# coalesces onto that run instead of computing and writing the same output.  Leases
+# have a short ttl and are renewed by a heartbeat while their run is alive, so the
+# lease of a run that dies without releasing it (e.g., out of memory) soon expires.
+
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseBackend:
+    # Conditional writes to the output bucket
+    S3 = "s3"
+
+    # Exclusive file creation in a local directory
+    Local = "local"
+
+
+class LeaseHeldError(RuntimeError):
+    """Raised by an invocation that coalesced onto a run it can't rely on to finish,
+    so that its event is retried (or sent to the DLQ) instead of being dropped."""
+
+
+class Lease:
+    def __init__(self, key: str, token: str, owner: str, expires: datetime):
+        self.key = key
+        self.token = token  # Identifies this holder's copy of the lease
+        self.owner = owner
+        self.expires = expires
+        self.heartbeat: Optional["LeaseHeartbeat"] = None
+
+    def stop_heartbeat(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
+
+def get_lease_key(datastream: str, window: str) -> str:
+    return f"{datastream}/{window}"
+
+
+def get_lease_ttl() -> timedelta:
+    # Short, since the heartbeat keeps the lease of a live run from expiring
+    return timedelta(seconds=float(os.environ.get("TSDAT_LEASE_TTL_S", 120)))
+
+
+def get_owner(context: Any = None) -> str:
+    if context is not None:
+        return context.aws_request_id
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseManager(ABC):
+    """Single-flight leases.  A lease expires after its ttl unless it is renewed, so
+    that a run that was killed (e.g., by an out of memory error or the lambda timeout)
+    doesn't block the key; an expired lease is taken over by the next invocation that
+    asks for it."""
+
+    def hold(self, key: str, owner: str, ttl: timedelta) -> Optional[Lease]:
+        """Take the lease on the key (see acquire) and renew it every third of its
+        ttl until Lease.stop_heartbeat is called."""
+        lease = self.acquire(key, owner, ttl)
+        if lease is not None:
+            lease.heartbeat = LeaseHeartbeat(self, lease, ttl)
+            lease.heartbeat.start()
+        return lease
+
+    @abstractmethod
+    def acquire(self, key: str, owner: str, ttl: timedelta) -> Optional[Lease]:
+        """Take the lease on the key.
+
+        Args:
+            key (str): the work to do, see get_lease_key()
+            owner (str): who is taking the lease (logged for the other invokers)
+            ttl (timedelta): how long the lease is held if it is never released
+
+        Returns:
+            Optional[Lease]: the lease, or None if another live invocation holds it.
+        """
+
+    @abstractmethod
+    def renew(self, lease: Lease, ttl: timedelta) -> bool:
+        """Extend the lease to ttl from now.  Returns False if it was lost (it expired
+        and was taken over by another invocation)."""
+
+    @abstractmethod
+    def release(self, lease: Lease):
+        """Release the lease, unless it expired and was taken over by another
+        invocation."""
+
+    @abstractmethod
+    def holder(self, key: str) -> Optional[Dict[str, str]]:
+        """The current holder of the lease on the key, if any."""
+
+    @staticmethod
+    def _get_body(owner: str, ttl: timedelta) -> Dict[str, str]:
+        now = datetime.now(timezone.utc)
+        return {
+            "owner": owner,
+            "token": uuid.uuid4().hex,
+            "acquired": now.isoformat(),
+            "expires": (now + ttl).isoformat(),
+        }
+
+    @staticmethod
+    def _is_expired(body: Dict[str, str]) -> bool:
+        return datetime.fromisoformat(body["expires"]) <= datetime.now(timezone.utc)
+
+
+class S3LeaseManager(LeaseManager):
+    """Leases stored as objects in the output bucket.  Taking a free lease is a put
+    with If-None-Match, and taking over an expired one is a put with If-Match on its
+    ETag, so exactly one invocation wins either way."""
+
+    def __init__(self, client, bucket: str, prefix: str = "leases"):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def acquire(self, key: str, owner: str, ttl: timedelta) -> Optional[Lease]:
+        body = self._get_body(owner, ttl)
+        if self._put(key, body, IfNoneMatch="*"):
+            return self._to_lease(key, body)
+
+        current = self._get(key)
+        if current is None:
+            # Released since the put failed:  try once more
+            return (
+                self._to_lease(key, body)
+                if self._put(key, body, IfNoneMatch="*")
+                else None
+            )
+        etag, current_body = current
+        if not self._is_expired(current_body):
+            return None
+        if self._put(key, body, IfMatch=etag):
+            return self._to_lease(key, body)
+        return None
+
+    def renew(self, lease: Lease, ttl: timedelta) -> bool:
+        current = self._get(lease.key)
+        if current is None or current[1].get("token") != lease.token:
+            return False
+        etag, body = current
+        body = {**body, "expires": (datetime.now(timezone.utc) + ttl).isoformat()}
+        if not self._put(lease.key, body, IfMatch=etag):
+            return False
+        lease.expires = datetime.fromisoformat(body["expires"])
+        return True
+
+    def release(self, lease: Lease):
+        current = self._get(lease.key)
+        if current is not None and current[1].get("token") == lease.token:
+            self.client.delete_object(Bucket=self.bucket, Key=self._get_path(lease.key))
+
+    def holder(self, key: str) -> Optional[Dict[str, str]]:
+        current = self._get(key)
+        return current[1] if current is not None else None
+
+    def _get_path(self, key: str) -> str:
+        return f"{self.prefix}/{key}.json"
+
+    def _put(self, key: str, body: Dict[str, str], **condition) -> bool:
+        try:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self._get_path(key),
+                Body=json.dumps(body).encode(),
+                ContentType="application/json",
+                **condition,
+            )
+        except self.client.exceptions.ClientError as e:
+            # 412 if the condition failed, 409 if a concurrent write won the race
+            if e.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                return False
+            raise
+        return True
+
+    def _get(self, key: str):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._get_path(key)
+            )
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response["ETag"], json.loads(response["Body"].read())
+
+    @staticmethod
+    def _to_lease(key: str, body: Dict[str, str]) -> Lease:
+        return Lease(
+            key, body["token"], body["owner"], datetime.fromisoformat(body["expires"])
+        )
+
+
+class LocalLeaseManager(LeaseManager):
+    """Local stand-in for the S3 leases that creates the lease files with O_EXCL, so it
+    also works across processes on one machine (e.g., tools.reprocess workers)."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def acquire(self, key: str, owner: str, ttl: timedelta) -> Optional[Lease]:
+        path = self._get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        body = self._get_body(owner, ttl)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    current = json.loads(path.read_text())
+                except FileNotFoundError:
+                    continue  # Released in the meantime
+                except json.JSONDecodeError:
+                    return None  # Still being written by a new holder
+                if not self._is_expired(current):
+                    return None
+                # Move the expired lease out of the way.  Only one invocation can
+                # rename it; the others fail and see the new lease on the next try.
+                expired = Path(f"{path}.{uuid.uuid4().hex}.expired")
+                try:
+                    os.rename(path, expired)
+                except FileNotFoundError:
+                    continue
+                if not self._is_expired_file(expired):
+                    # Another invocation took over the lease since we read it:  put
+                    # it back (unless yet another one got there first)
+                    try:
+                        os.link(expired, path)
+                    except FileExistsError:
+                        pass
+                    expired.unlink()
+                    return None
+                expired.unlink()
+                continue
+            with os.fdopen(fd, "w") as file:
+                json.dump(body, file)
+            return Lease(
+                key, body["token"], owner, datetime.fromisoformat(body["expires"])
+            )
+        return None
+
+    def renew(self, lease: Lease, ttl: timedelta) -> bool:
+        current = self.holder(lease.key)
+        if current is None or current.get("token") != lease.token:
+            return False
+        # Renewed well before it expires, so no one else can take it over meanwhile
+        body = {**current, "expires": (datetime.now(timezone.utc) + ttl).isoformat()}
+        path = self._get_path(lease.key)
+        renewed = Path(f"{path}.{uuid.uuid4().hex}.renewed")
+        renewed.write_text(json.dumps(body))
+        os.replace(renewed, path)
+        lease.expires = datetime.fromisoformat(body["expires"])
+        return True
+
+    def release(self, lease: Lease):
+        current = self.holder(lease.key)
+        if current is not None and current.get("token") == lease.token:
+            self._get_path(lease.key).unlink(missing_ok=True)
+
+    def holder(self, key: str) -> Optional[Dict[str, str]]:
+        try:
+            return json.loads(self._get_path(key).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _get_path(self, key: str) -> Path:
+        return self.path / f"{key}.lease"
+
+    def _is_expired_file(self, path: Path) -> bool:
+        try:
+            return self._is_expired(json.loads(path.read_text()))
+        except json.JSONDecodeError:
+            return False  # A new lease that is still being written
+
+
+class LeaseHeartbeat:
+    """Renews a lease in a background thread while the run holding it is alive."""
+
+    def __init__(self, manager: LeaseManager, lease: Lease, ttl: timedelta):
+        self.manager = manager
+        self.lease = lease
+        self.ttl = ttl
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        interval = self.ttl.total_seconds() / 3
+        while not self._stopped.wait(interval):
+            try:
+                if not self.manager.renew(self.lease, self.ttl):
+                    # The run goes on, but another invocation may now duplicate it
+                    logger.warning("Lost the lease on %s", self.lease.key)
+                    self.lost = True
+                    return
+            except Exception:
+                # Retried on the next beat, before the lease expires
+                logger.warning(
+                    "Failed to renew the lease on %s", self.lease.key, exc_info=True
+                )
+
+
+def get_lease_manager() -> Optional[LeaseManager]:
+    """Get the lease manager configured by the TSDAT_LEASE_BACKEND environment variable
+    (s3 or local), or None if single-flight leases are off (empty or unset).  The s3
+    backend writes the leases to TSDAT_S3_BUCKET_NAME under the TSDAT_LEASE_PATH prefix
+    (default "leases"); the local backend writes them to the TSDAT_LEASE_PATH
+    directory.  The ttl of the leases is TSDAT_LEASE_TTL_S (see get_lease_ttl)."""
+    backend = os.environ.get("TSDAT_LEASE_BACKEND", "").lower()
+    if not backend:
+        return None
+    if backend == LeaseBackend.Local:
+        return LocalLeaseManager(os.environ.get("TSDAT_LEASE_PATH", "leases"))
+    elif backend == LeaseBackend.S3:
+        import boto3
+
+        return S3LeaseManager(
+            boto3.client("s3"),
+            os.environ["TSDAT_S3_BUCKET_NAME"],
+            os.environ.get("TSDAT_LEASE_PATH", "leases"),
+        )
+    raise ValueError(f"Unknown lease backend: {backend}")
@@ -3,9 +3,13 @@
 import json
 import logging
 import os
-from logging import Formatter, Logger, LogRecord, StreamHandler
+import random
+import re
+import time
+from collections import Counter
+from logging import Filter, Formatter, Logger, LogRecord, StreamHandler
 from logging.handlers import MemoryHandler
-from typing import Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 # Remove the extra handler(s) that AWS attaches when running in lambda to prevent
 # duplicate log messages in our own logging handler
@@ -13,6 +17,106 @@ ROOT_LOGGER = logging.getLogger()
 AWS_HANDLERS = ROOT_LOGGER.handlers.copy()
 
 
+class RateLimitFilter(Filter):
+    """Keeps high-volume DEBUG/INFO logging (e.g., tsdat's per-variable QC messages)
+    out of the buffered log.  WARNING and above are always kept.
+
+    A message that repeats more than `max_repeats` times is collapsed into a count.
+    Messages are the same if they come from the same logger at the same level with
+    the same format string, ignoring numbers.  Once a logger has logged
+    `sample_after` DEBUG/INFO records, only a `sample_rate` fraction of the rest are
+    kept.  The counts are reported by stats() and reset for the next invocation.
+    """
+
+    NUMBERS = re.compile(r"\d+")
+
+    def __init__(
+        self,
+        max_repeats: int = 10,
+        sample_after: int = 1000,
+        sample_rate: float = 0.1,
+        max_keys: int = 10000,
+        top_n: int = 10,
+    ):
+        super().__init__()
+        self.max_repeats = max_repeats
+        self.sample_after = sample_after
+        self.sample_rate = sample_rate
+        self.max_keys = max_keys  # Bounds the memory used to track messages
+        self.top_n = top_n
+        self.reset()
+
+    @classmethod
+    def from_env(cls) -> Optional["RateLimitFilter"]:
+        """Create a filter configured by these environment variables, or None if
+        LOG_RATE_LIMIT is false:
+
+        LOG_MAX_REPEATS: times a message is logged before it is collapsed
+        LOG_SAMPLE_AFTER: DEBUG/INFO records per logger before sampling starts
+        LOG_SAMPLE_RATE: fraction of the records kept after that
+        """
+        if os.environ.get("LOG_RATE_LIMIT", "true").lower() in ("0", "false", "no"):
+            return None
+        return cls(
+            max_repeats=int(os.environ.get("LOG_MAX_REPEATS", 10)),
+            sample_after=int(os.environ.get("LOG_SAMPLE_AFTER", 1000)),
+            sample_rate=float(os.environ.get("LOG_SAMPLE_RATE", 0.1)),
+        )
+
+    def reset(self):
+        self.repeats: Counter = Counter()
+        self.per_logger: Counter = Counter()
+        self.collapsed: Counter = Counter()
+        self.sampled_out: Counter = Counter()
+
+    def filter(self, record: LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = self._get_key(record)
+        if key in self.repeats or len(self.repeats) < self.max_keys:
+            self.repeats[key] += 1
+            if self.repeats[key] > self.max_repeats:
+                self.collapsed[key] += 1
+                return False
+
+        self.per_logger[record.name] += 1
+        if (
+            self.per_logger[record.name] > self.sample_after
+            and random.random() >= self.sample_rate
+        ):
+            self.sampled_out[record.name] += 1
+            return False
+        return True
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        """The suppression section of the log context, or None if nothing was
+        suppressed."""
+        if not self.collapsed and not self.sampled_out:
+            return None
+        return {
+            "collapsed": sum(self.collapsed.values()),
+            "sampled_out": sum(self.sampled_out.values()),
+            "sampled_out_by_logger": dict(self.sampled_out),
+            "top_collapsed": [
+                {
+                    "logger": name,
+                    "level": logging.getLevelName(level),
+                    "message": message,
+                    "suppressed": count,
+                }
+                for (name, level, message), count in self.collapsed.most_common(
+                    self.top_n
+                )
+            ],
+        }
+
+    def _get_key(self, record: LogRecord) -> Tuple[str, int, str]:
+        # The format string groups messages that only differ in their arguments
+        message = self.NUMBERS.sub("#", str(record.msg))
+        return record.name, record.levelno, message
+
+
 class DelayedJSONStreamHandler(MemoryHandler):
     """A handler class which buffers logging records in memory, flushing them to a
     target handler only when the program exits or flushing is triggered manually. When
@@ -50,9 +154,16 @@ class DelayedJSONStreamHandler(MemoryHandler):
     def shouldFlush(self, record: LogRecord) -> bool:
         return False  # Don't flush the buffer automatically
 
-    def flush(self, context: Optional[Dict] = None) -> None:
+    def flush(
+        self, context: Optional[Dict] = None, metrics: Optional[Dict] = None
+    ) -> None:
         """Ensure that all logging calls have been flushed. This method is automatically
         called when the program exits, but may be called earlier as well.
+
+        Args:
+            context (Dict, optional): Additional context for this blob only.
+            metrics (Dict, optional): CloudWatch embedded metric format document (see
+            get_emf_metrics), written on its own line after the blob.
         """
 
         # Add the AWS Handler(s) back so that the flushed message can be shown in the
@@ -64,26 +175,64 @@ class DelayedJSONStreamHandler(MemoryHandler):
         if context is None:
             context = dict()
 
-        self.context.update(context)
+        # Don't keep the invocation's context:  warm lambda containers would carry
+        # it over into the next invocation's blob
+        context = {**self.context, **context}
+
+        # Report what the rate limit kept out of this blob, and start over for the
+        # next one
+        for log_filter in self.filters:
+            if isinstance(log_filter, RateLimitFilter):
+                suppressed = log_filter.stats()
+                if suppressed is not None:
+                    context["log_suppression"] = suppressed
+                log_filter.reset()
 
         self.acquire()
         try:
             if self.buffer and self.target:
                 # Build json string
                 log_dict = {
-                    "context": self.context,
+                    "context": context,
                     "logs": [self.target.format(record) for record in self.buffer],
                 }
                 dumped = json.dumps(log_dict)
 
                 # Use the target
                 self.target.stream.write(dumped + self.target.terminator)  # type: ignore
-                self.target.stream.flush()  # type: ignore
                 self.buffer = []
+
+            if self.target:
+                # Kept out of the blob, which may be too large for one log event
+                if metrics:
+                    dumped = json.dumps(metrics)
+                    self.target.stream.write(dumped + self.target.terminator)  # type: ignore
+                self.target.stream.flush()  # type: ignore
         finally:
             self.release()
 
 
+def get_emf_metrics(
+    namespace: str, dimensions: Dict[str, str], values: Dict[str, float]
+) -> Dict[str, Any]:
+    """A CloudWatch embedded metric format document:  CloudWatch turns the log line
+    into a datapoint of each metric in `values`, with the given dimensions."""
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": "Count"} for name in values],
+                }
+            ],
+        },
+        **dimensions,
+        **values,
+    }
+
+
 def configure_logger(logger: Logger, context: Optional[Dict] = None):
     if context is None:
         context = dict()
@@ -105,6 +254,11 @@ def configure_logger(logger: Logger, context: Optional[Dict] = None):
         Formatter("[%(asctime)s: %(pathname)s %(levelname)s] %(message)s")
     )
     dmh = DelayedJSONStreamHandler(target=target, context=context)
+
+    # Collapse repeated messages and sample high-volume loggers (on by default)
+    rate_limit = RateLimitFilter.from_env()
+    if rate_limit is not None:
+        dmh.addFilter(rate_limit)
     ROOT_LOGGER.addHandler(dmh)
 
 
@@ -0,0 +1,199 @@
+# This file is copied into the base image and tracks the memory used by each phase
+# of a lambda invocation, so runs that get close to the function's memory limit can
+# be found before they fail.  It is switched on with environment variables set by
+# the build from the pipeline's `memory` config (see pipelines_config.yml).
+
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+MB = 1024 * 1024
+
+
+def get_rss() -> int:
+    """Current resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Not on Linux:  fall back to the peak, which is all getrusage gives us
+        return get_max_rss()
+
+
+def get_max_rss() -> int:
+    """Peak resident set size of this process in bytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class MemoryTracker:
+    """Records the peak RSS of each phase of an invocation by sampling it from a
+    background thread, plus the top allocators of each phase if tracemalloc is on.
+
+    If the RSS crosses `warn_fraction` of the memory limit, a warning is written to
+    stderr right away instead of waiting for the buffered log to be flushed at the
+    end of the invocation, so it is still in the logs if the function runs out of
+    memory.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        use_tracemalloc: bool = False,
+        warn_fraction: float = 0.8,
+        limit_mb: Optional[float] = None,
+        interval_s: float = 0.05,
+        top_n: int = 10,
+    ):
+        self.enabled = enabled
+        self.use_tracemalloc = use_tracemalloc and enabled
+        self.limit = int(limit_mb * MB) if limit_mb else None
+        self.warn_at = self.limit * warn_fraction if self.limit else None
+        self.interval_s = interval_s
+        self.top_n = top_n
+
+        self.phases: Dict[str, Dict[str, Any]] = {}
+        self.warnings: List[str] = []
+        self._warned_phases = set()
+        self._phase: Optional[str] = None
+        self._phase_peak = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> "MemoryTracker":
+        """Create a tracker configured by these environment variables:
+
+        MEMORY_TRACKING: true to track the RSS of each phase
+        MEMORY_TRACEMALLOC: true to also record the top allocators (slower)
+        MEMORY_WARN_FRACTION: fraction of the memory limit that triggers a warning
+        MEMORY_TOP_N: number of allocators recorded per phase
+        AWS_LAMBDA_FUNCTION_MEMORY_SIZE: the memory limit in MB (set by AWS)
+        """
+
+        def flag(name: str) -> bool:
+            return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+        return cls(
+            enabled=flag("MEMORY_TRACKING"),
+            use_tracemalloc=flag("MEMORY_TRACEMALLOC"),
+            warn_fraction=float(os.environ.get("MEMORY_WARN_FRACTION", 0.8)),
+            limit_mb=float(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", 0)),
+            top_n=int(os.environ.get("MEMORY_TOP_N", 10)),
+        )
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.use_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Track the memory used by the code in the `with` block."""
+        if not self.enabled:
+            yield
+            return
+
+        start_rss = get_rss()
+        with self._lock:
+            self._phase = name
+            self._phase_peak = start_rss
+        snapshot = None
+        if self.use_tracemalloc:
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            end_rss = get_rss()
+            self._check(end_rss)
+            with self._lock:
+                peak = max(self._phase_peak, end_rss)
+                self._phase = None
+            stats: Dict[str, Any] = {
+                "duration_s": round(time.monotonic() - started, 3),
+                "start_rss_mb": round(start_rss / MB, 1),
+                "end_rss_mb": round(end_rss / MB, 1),
+                "peak_rss_mb": round(peak / MB, 1),
+            }
+            if snapshot is not None:
+                stats["traced_peak_mb"] = round(
+                    tracemalloc.get_traced_memory()[1] / MB, 1
+                )
+                stats["top_allocations"] = self._top_allocations(snapshot)
+            self.phases[name] = stats
+
+    def report(self) -> Optional[Dict[str, Any]]:
+        """The memory section of the log context, or None if tracking is off."""
+        if not self.enabled:
+            return None
+        return {
+            "limit_mb": round(self.limit / MB) if self.limit else None,
+            "peak_rss_mb": round(get_max_rss() / MB, 1),
+            "phases": self.phases,
+            "warnings": self.warnings,
+        }
+
+    def _sample(self):
+        while not self._stop.wait(self.interval_s):
+            rss = get_rss()
+            with self._lock:
+                if self._phase is not None:
+                    self._phase_peak = max(self._phase_peak, rss)
+            self._check(rss)
+
+    def _check(self, rss: int):
+        if self.warn_at is None or rss < self.warn_at:
+            return
+        with self._lock:
+            phase = self._phase or "between phases"
+            if phase in self._warned_phases:
+                return
+            self._warned_phases.add(phase)
+            message = (
+                f"Memory usage {rss / MB:.0f} MB is"
+                f" {100 * rss / self.limit:.0f}% of the {self.limit / MB:.0f} MB"
+                f" limit during {phase}"
+            )
+            self.warnings.append(message)
+        # Written straight to stderr so it reaches the logs even if the function is
+        # killed before the buffered log is flushed
+        print(f"WARNING: {message}", file=sys.stderr, flush=True)
+
+    def _top_allocations(self, before) -> List[Dict[str, Any]]:
+        # Leave out the snapshots' own allocations
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        before = before.filter_traces(filters)
+        return [
+            {
+                "location": str(stat.traceback[0]),
+                "size_mb": round(stat.size / MB, 2),
+                "size_diff_mb": round(stat.size_diff / MB, 2),
+                "count_diff": stat.count_diff,
+            }
+            for stat in after.compare_to(before, "lineno")[: self.top_n]
+        ]
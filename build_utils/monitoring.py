@@ -0,0 +1,270 @@
+# This file is used by the build to describe the CloudWatch dashboard and alarms of
+# each pipeline's lambdas (see the `monitoring` sections of pipelines_config.yml).
+# Only the definitions are built here:  the build creates or updates them with
+# put_dashboard and put_metric_alarm when it deploys the pipeline.
+
+import json
+from typing import Any, Dict, List, Optional
+
+from .constants import METRICS_NAMESPACE
+from .pipelines_config import MonitoringConfig
+
+NAMESPACE = "AWS/Lambda"
+
+# Size of the dashboard widgets (the dashboard grid is 24 units wide)
+WIDGET_WIDTH = 6
+WIDGET_HEIGHT = 6
+
+
+def get_alarms(
+    prefix: str,
+    label: str,
+    function_name: str,
+    timeout_s: int,
+    config: MonitoringConfig,
+    actions: Optional[List[str]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    The put_metric_alarm arguments of the alarms on one lambda:  p95 duration (as a
+    fraction of its timeout), throttles, error rate and the age of its queued
+    asynchronous events.  The handler catches the pipeline's failures, so those are
+    counted by the PipelineFailures metric it logs rather than by lambda's Errors.
+
+    Args:
+        prefix (str): prefix of the alarm names (PipelinesConfig.get_alarm_prefix)
+        label (str): the lambda's part of the alarm names (e.g., the config id)
+        function_name (str): the lambda's function name
+        timeout_s (int): the lambda's timeout in seconds
+        config (MonitoringConfig): the pipeline's thresholds
+        actions (List[str]): ARNs notified when an alarm changes state (e.g., the
+            alarm topic)
+
+    Returns:
+        List[Dict[str, Any]]: keyword arguments for put_metric_alarm.
+    """
+    period = config.period_minutes * 60
+    dimensions = [{"Name": "FunctionName", "Value": function_name}]
+    common = {
+        "EvaluationPeriods": config.evaluation_periods,
+        "DatapointsToAlarm": config.evaluation_periods,
+        # Idle lambdas send no datapoints
+        "TreatMissingData": "notBreaching",
+        "AlarmActions": actions or [],
+        "OKActions": actions or [],
+    }
+
+    def metric(name: str, **stat) -> Dict[str, Any]:
+        return {
+            "Namespace": NAMESPACE,
+            "MetricName": name,
+            "Dimensions": dimensions,
+            "Period": period,
+            **stat,
+        }
+
+    duration_threshold_ms = timeout_s * 1000 * config.duration_p95_fraction
+    return [
+        {
+            "AlarmName": f"{prefix}{label}-duration-p95",
+            "AlarmDescription": (
+                f"p95 duration of {function_name} is above"
+                f" {config.duration_p95_fraction:.0%} of its {timeout_s}s timeout"
+            ),
+            **metric("Duration", ExtendedStatistic="p95"),
+            "ComparisonOperator": "GreaterThanThreshold",
+            "Threshold": duration_threshold_ms,
+            **common,
+        },
+        {
+            "AlarmName": f"{prefix}{label}-throttles",
+            "AlarmDescription": f"{function_name} is being throttled",
+            **metric("Throttles", Statistic="Sum"),
+            "ComparisonOperator": "GreaterThanThreshold",
+            "Threshold": config.max_throttles,
+            **common,
+        },
+        {
+            "AlarmName": f"{prefix}{label}-error-rate",
+            "AlarmDescription": (
+                f"More than {config.error_rate:.0%} of the invocations of"
+                f" {function_name} fail"
+            ),
+            "Metrics": [
+                {
+                    "Id": "errors",
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": NAMESPACE,
+                            "MetricName": "Errors",
+                            "Dimensions": dimensions,
+                        },
+                        "Period": period,
+                        "Stat": "Sum",
+                    },
+                    "ReturnData": False,
+                },
+                {
+                    "Id": "failures",
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": METRICS_NAMESPACE,
+                            "MetricName": "PipelineFailures",
+                            "Dimensions": dimensions,
+                        },
+                        "Period": period,
+                        "Stat": "Sum",
+                    },
+                    "ReturnData": False,
+                },
+                {
+                    "Id": "invocations",
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": NAMESPACE,
+                            "MetricName": "Invocations",
+                            "Dimensions": dimensions,
+                        },
+                        "Period": period,
+                        "Stat": "Sum",
+                    },
+                    "ReturnData": False,
+                },
+                {
+                    "Id": "error_rate",
+                    # Container tasks report their failures under the lambda that
+                    # started them, so the rate counts each invocation once either way
+                    "Expression": (
+                        "IF(invocations > 0,"
+                        " (FILL(errors, 0) + FILL(failures, 0)) / invocations, 0)"
+                    ),
+                    "Label": "Error rate",
+                    "ReturnData": True,
+                },
+            ],
+            "ComparisonOperator": "GreaterThanThreshold",
+            "Threshold": config.error_rate,
+            **common,
+        },
+        {
+            "AlarmName": f"{prefix}{label}-async-event-age",
+            "AlarmDescription": (
+                f"Events queued for {function_name} are older than"
+                f" {config.async_event_age_minutes:g} minutes"
+            ),
+            **metric("AsyncEventAge", Statistic="Maximum"),
+            "ComparisonOperator": "GreaterThanThreshold",
+            "Threshold": config.async_event_age_minutes * 60 * 1000,
+            **common,
+        },
+    ]
+
+
+def get_dashboard_body(
+    title: str,
+    region: str,
+    functions: Dict[str, str],
+    timeouts: Dict[str, int],
+    alarm_arns: List[str],
+) -> str:
+    """
+    The body of a pipeline's dashboard:  the state of its alarms, and a row of
+    invocation, duration, concurrency and queue age graphs per lambda.
+
+    Args:
+        title (str): the dashboard's heading (e.g., the pipeline name)
+        region (str): the region of the lambdas
+        functions (Dict[str, str]): function name of each lambda, by label
+        timeouts (Dict[str, int]): timeout in seconds of each function
+        alarm_arns (List[str]): the pipeline's alarms
+
+    Returns:
+        str: the dashboard body JSON for put_dashboard.
+    """
+    widgets: List[Dict[str, Any]] = [
+        {
+            "type": "alarm",
+            "x": 0,
+            "y": 0,
+            "width": 24,
+            "height": 3,
+            "properties": {"title": f"{title} alarms", "alarms": sorted(alarm_arns)},
+        }
+    ]
+
+    def graph(x, y, title, metrics, stat, annotations=None) -> Dict[str, Any]:
+        properties: Dict[str, Any] = {
+            "title": title,
+            "region": region,
+            "view": "timeSeries",
+            "stat": stat,
+            "period": 300,
+            "metrics": metrics,
+        }
+        if annotations:
+            properties["annotations"] = {"horizontal": annotations}
+        return {
+            "type": "metric",
+            "x": x,
+            "y": y,
+            "width": WIDGET_WIDTH,
+            "height": WIDGET_HEIGHT,
+            "properties": properties,
+        }
+
+    y = 3
+    for label, function_name in functions.items():
+        dimension = ["FunctionName", function_name]
+        timeout_ms = timeouts[function_name] * 1000
+        widgets.extend(
+            [
+                graph(
+                    0,
+                    y,
+                    f"{label}: invocations",
+                    [
+                        [NAMESPACE, "Invocations", *dimension],
+                        [NAMESPACE, "Errors", *dimension],
+                        [METRICS_NAMESPACE, "PipelineFailures", *dimension],
+                        [NAMESPACE, "Throttles", *dimension],
+                    ],
+                    "Sum",
+                ),
+                graph(
+                    WIDGET_WIDTH,
+                    y,
+                    f"{label}: duration",
+                    [
+                        [NAMESPACE, "Duration", *dimension, {"stat": "p50"}],
+                        [NAMESPACE, "Duration", *dimension, {"stat": "p95"}],
+                        [NAMESPACE, "Duration", *dimension, {"stat": "Maximum"}],
+                    ],
+                    "p95",
+                    [{"label": "Timeout", "value": timeout_ms}],
+                ),
+                graph(
+                    2 * WIDGET_WIDTH,
+                    y,
+                    f"{label}: concurrency",
+                    [[NAMESPACE, "ConcurrentExecutions", *dimension]],
+                    "Maximum",
+                ),
+                graph(
+                    3 * WIDGET_WIDTH,
+                    y,
+                    f"{label}: queued event age",
+                    [
+                        [NAMESPACE, "AsyncEventAge", *dimension],
+                        [
+                            NAMESPACE,
+                            "AsyncEventsDropped",
+                            *dimension,
+                            {"stat": "Sum", "yAxis": "right"},
+                        ],
+                    ],
+                    "Maximum",
+                ),
+            ]
+        )
+        y += WIDGET_HEIGHT
+
+    return json.dumps({"widgets": widgets})
@@ -1,25 +1,392 @@
 import os
+import re
 from pathlib import Path
-from typing import Dict, List, Union
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
 import yaml
 
-from .constants import Env, Schedule
+from .constants import Backend, Env, PipelineType, S3Routing
+from .schedules import get_schedule_expression, get_window
+
+
+class ContainerConfig:
+    # vCPUs Fargate supports (each allows a range of memory sizes)
+    VCPUS = (0.25, 0.5, 1, 2, 4, 8, 16)
+
+    def __init__(self, values: dict):
+        # Size of the Fargate task
+        self.vcpu: float = float(values.get("vcpu", 1))
+        if self.vcpu not in ContainerConfig.VCPUS:
+            raise ValueError(
+                f"container vcpu must be one of {ContainerConfig.VCPUS}, got {self.vcpu}"
+            )
+        self.memory_mb: int = int(values.get("memory_mb", 4096))
+
+        # Scratch disk for the inputs and outputs (Fargate allows 21 to 200 GiB)
+        self.ephemeral_storage_gb: int = int(values.get("ephemeral_storage_gb", 21))
+        if not 21 <= self.ephemeral_storage_gb <= 200:
+            raise ValueError(
+                "container ephemeral_storage_gb must be between 21 and 200, got"
+                f" {self.ephemeral_storage_gb}"
+            )
+
+        # The run fails if it takes longer (tasks have no timeout of their own)
+        self.timeout_minutes: float = float(values.get("timeout_minutes", 240))
+
+    @property
+    def cpu_units(self) -> int:
+        return int(self.vcpu * 1024)
+
+    def get_env_vars(self) -> Dict[str, str]:
+        """Environment variables of the task, read by the task runner and handler"""
+        timeout_s = int(self.timeout_minutes * 60)
+        return {
+            "TSDAT_BACKEND": Backend.Container,
+            "TASK_TIMEOUT_S": str(timeout_s),
+            # The memory limit, as a lambda would report it (see MemoryTracker)
+            "AWS_LAMBDA_FUNCTION_MEMORY_SIZE": str(self.memory_mb),
+        }
 
 
 class RunConfig:
     def __init__(self, run_id: str, values: dict):
         self.id = run_id
-        self.input_bucket_path = values.get("input_bucket_path")
-        if self.input_bucket_path:
-            # If user specified the path starting with ./ or / that is BAD.  We
-            # need to strip these characters off the front of the path.
-            if self.input_bucket_path.startswith("./"):
-                self.input_bucket_path = self.input_bucket_path[2:]
-            if self.input_bucket_path.startswith("/"):
-                self.input_bucket_path = self.input_bucket_path[1:]
-
+        self.input_bucket_path = clean_bucket_path(values.get("input_bucket_path"))
         self.config_file_path = values.get("config_file_path")
 
+        # Output bucket prefixes of the upstream datastreams that trigger this run
+        # (Upstream trigger)
+        self.upstream_bucket_paths: List[str] = [
+            clean_bucket_path(path)
+            for path in values.get("upstream_bucket_paths") or []
+        ]
+
+        # Cron ingests:  number of input files downloaded ahead of the pipeline while
+        # it runs, and the number of files per pipeline.run.  If the depth is 0, all
+        # the files are downloaded before one run over all of them.
+        self.prefetch_depth: int = int(values.get("prefetch_depth", 0))
+        self.prefetch_batch_size: int = int(values.get("prefetch_batch_size", 1))
+
+        # S3 triggered configs only run on input keys with one of these suffixes
+        # (if given) that match this regex (if given)
+        self.input_suffixes: List[str] = values.get("input_suffixes") or []
+        self.input_regex: Optional[str] = values.get("input_regex")
+
+        # Input keys skipped before they are downloaded:  empty or partial uploads
+        # (smaller than min_size_bytes), oversized files, and temporary or sidecar
+        # files by suffix
+        self.min_size_bytes: int = int(values.get("min_size_bytes", 1))
+        max_size_bytes = values.get("max_size_bytes")
+        self.max_size_bytes: Optional[int] = (
+            int(max_size_bytes) if max_size_bytes is not None else None
+        )
+        self.exclude_suffixes: List[str] = values.get("exclude_suffixes") or []
+
+        # Also skip input keys that none of the tsdat pipeline's readers match
+        self.match_readers: bool = bool(values.get("match_readers", True))
+
+        # Where the pipeline runs:  in the lambda, or in a Fargate task the lambda
+        # starts (for runs that exceed the lambda's time, memory or disk limits)
+        self.backend: str = values.get("backend", Backend.Lambda)
+        if self.backend not in (Backend.Lambda, Backend.Container):
+            raise ValueError(f"Unknown backend for config {run_id}: {self.backend}")
+        self.container = ContainerConfig(values.get("container") or {})
+
+    def matches_input_key(self, key: str) -> bool:
+        """Check the key against the input_suffixes and input_regex filters."""
+        if self.input_suffixes and not key.endswith(tuple(self.input_suffixes)):
+            return False
+        if self.input_regex and not re.search(self.input_regex, key):
+            return False
+        return True
+
+    def get_skip_reason(self, key: str, size: Optional[int]) -> Optional[str]:
+        """Why the input key is skipped by the filters above, or None if it isn't.
+        The size rules are only checked if the size is known."""
+        if not self.matches_input_key(key):
+            return "input_filters"
+        if self.exclude_suffixes and key.endswith(tuple(self.exclude_suffixes)):
+            return "excluded_suffix"
+        if size is not None:
+            if size < self.min_size_bytes:
+                return "too_small"
+            if self.max_size_bytes is not None and size > self.max_size_bytes:
+                return "too_large"
+        return None
+
+
+def clean_bucket_path(path: Optional[str]) -> Optional[str]:
+    # If user specified the path starting with ./ or / that is BAD.  We
+    # need to strip these characters off the front of the path.
+    if path:
+        if path.startswith("./"):
+            path = path[2:]
+        if path.startswith("/"):
+            path = path[1:]
+    return path
+
+
+class BuildConfig:
+    def __init__(self, values: dict):
+        # CodeBuild compute type of each build node (SMALL, MEDIUM, LARGE, X2_LARGE)
+        self.compute_type: str = str(values.get("compute_type", "MEDIUM")).upper()
+
+        # Number of build nodes the pipeline images are split across
+        self.shards: int = int(values.get("shards", 1))
+        if self.shards < 1:
+            raise ValueError(f"build shards must be at least 1, got {self.shards}")
+
+    @property
+    def batch_enabled(self) -> bool:
+        return self.shards > 1
+
+
+class StorageConfig:
+    # Storage class that supports the transfer settings below
+    TUNED_CLASSNAME = "build_utils.storage.TunedFileSystemS3"
+
+    # Storage classes for each output_mode
+    OUTPUT_MODE_CLASSNAMES = {
+        "zarr": "build_utils.storage.ZarrS3Storage",
+    }
+
+    def __init__(self, values: dict):
+        # How output data are written: "files" (the storage class' own output files)
+        # or "zarr" (one appendable zarr store per datastream)
+        self.output_mode: str = values.get("output_mode", "files")
+        if (
+            self.output_mode != "files"
+            and self.output_mode not in StorageConfig.OUTPUT_MODE_CLASSNAMES
+        ):
+            raise ValueError(f"Unknown storage output_mode: {self.output_mode}")
+        self.zarr_time_chunk: Optional[int] = values.get("zarr_time_chunk")
+
+        self.multipart_threshold_mb: Optional[float] = values.get(
+            "multipart_threshold_mb"
+        )
+        self.max_concurrency: Optional[int] = values.get("max_concurrency")
+        self.async_upload: bool = bool(values.get("async_upload", False))
+        self.read_cache_mb: Optional[float] = values.get("read_cache_mb")
+
+        # If the user only provided transfer settings, use the storage class that
+        # supports them.  Otherwise keep the class from the pipeline's storage config.
+        tuned = (
+            self.multipart_threshold_mb is not None
+            or self.max_concurrency is not None
+            or self.async_upload
+            or self.read_cache_mb is not None
+        )
+        default_classname = StorageConfig.OUTPUT_MODE_CLASSNAMES.get(
+            self.output_mode, StorageConfig.TUNED_CLASSNAME if tuned else None
+        )
+        self.classname: Optional[str] = values.get("classname", default_classname)
+
+    def get_env_vars(self) -> Dict[str, str]:
+        """Environment variables read by the storage classes in build_utils.storage"""
+        env_vars = {"TSDAT_S3_ASYNC_UPLOAD": str(self.async_upload).lower()}
+        if self.classname:
+            env_vars["TSDAT_STORAGE_CLASS"] = self.classname
+        if self.multipart_threshold_mb is not None:
+            env_vars["TSDAT_S3_MULTIPART_THRESHOLD_MB"] = str(
+                self.multipart_threshold_mb
+            )
+        if self.max_concurrency is not None:
+            env_vars["TSDAT_S3_MAX_CONCURRENCY"] = str(self.max_concurrency)
+        if self.read_cache_mb is not None:
+            env_vars["TSDAT_S3_CACHE_MAX_MB"] = str(self.read_cache_mb)
+        if self.zarr_time_chunk is not None:
+            env_vars["TSDAT_ZARR_TIME_CHUNK"] = str(self.zarr_time_chunk)
+        return env_vars
+
+
+class ProfilingConfig:
+    def __init__(self, values: dict):
+        # Profiler wrapped around pipeline.run: "cprofile", "sample", or None (off)
+        self.mode: Optional[str] = values.get("mode")
+
+        # Fraction of invocations that are profiled
+        self.sample_rate: float = float(values.get("sample_rate", 1))
+
+        # Run config ids to profile (all of the pipeline's configs if not given)
+        self.configs: Optional[List[str]] = values.get("configs")
+
+        # Stack sampling interval for the "sample" mode
+        self.interval_ms: float = float(values.get("interval_ms", 10))
+
+        # Number of hot functions in the summary added to the log context
+        self.top_n: int = int(values.get("top_n", 20))
+
+    def get_env_vars(self, config_id: Optional[str]) -> Dict[str, str]:
+        """Environment variables read by build_utils.profiling.get_profiler().  The
+        config id is None for the lambda of a consolidated pipeline, which checks
+        the configs when it runs."""
+        if not self.mode or (
+            config_id is not None
+            and self.configs is not None
+            and config_id not in self.configs
+        ):
+            return {}
+        env_vars = {
+            "PROFILE_MODE": self.mode,
+            "PROFILE_SAMPLE_RATE": str(self.sample_rate),
+            "PROFILE_INTERVAL_MS": str(self.interval_ms),
+            "PROFILE_TOP_N": str(self.top_n),
+        }
+        if config_id is None and self.configs is not None:
+            env_vars["PROFILE_CONFIGS"] = ",".join(self.configs)
+        return env_vars
+
+
+class MemoryConfig:
+    def __init__(self, values: dict):
+        # Record the peak RSS of each phase of the lambda handler
+        self.tracking: bool = bool(values.get("tracking", False))
+
+        # Also record the top tracemalloc allocators of each phase (slower)
+        self.tracemalloc: bool = bool(values.get("tracemalloc", False))
+
+        # Fraction of the function's memory limit that triggers an early warning
+        self.warn_fraction: float = float(values.get("warn_fraction", 0.8))
+
+        # Number of allocators recorded per phase
+        self.top_n: int = int(values.get("top_n", 10))
+
+    def get_env_vars(self) -> Dict[str, str]:
+        """Environment variables read by build_utils.memory.MemoryTracker"""
+        if not self.tracking:
+            return {}
+        return {
+            "MEMORY_TRACKING": "true",
+            "MEMORY_TRACEMALLOC": str(self.tracemalloc).lower(),
+            "MEMORY_WARN_FRACTION": str(self.warn_fraction),
+            "MEMORY_TOP_N": str(self.top_n),
+        }
+
+
+class LoggingConfig:
+    def __init__(self, values: dict):
+        # Collapse repeated DEBUG/INFO messages and sample high-volume loggers
+        # (WARNING and above are always logged)
+        self.rate_limit: bool = bool(values.get("rate_limit", True))
+
+        # Times the same message is logged before the rest are only counted
+        self.max_repeats: int = int(values.get("max_repeats", 10))
+
+        # DEBUG/INFO records per logger and invocation before sampling starts, and
+        # the fraction of the records that are kept after that
+        self.sample_after: int = int(values.get("sample_after", 1000))
+        self.sample_rate: float = float(values.get("sample_rate", 0.1))
+
+    def get_env_vars(self) -> Dict[str, str]:
+        """Environment variables read by build_utils.logger.RateLimitFilter"""
+        if not self.rate_limit:
+            return {"LOG_RATE_LIMIT": "false"}
+        return {
+            "LOG_RATE_LIMIT": "true",
+            "LOG_MAX_REPEATS": str(self.max_repeats),
+            "LOG_SAMPLE_AFTER": str(self.sample_after),
+            "LOG_SAMPLE_RATE": str(self.sample_rate),
+        }
+
+
+class ScratchConfig:
+    def __init__(self, values: dict):
+        # Free space kept for the pipeline's own temporary and output files, on top
+        # of the inputs downloaded to scratch space
+        self.headroom_mb: float = float(values.get("headroom_mb", 256))
+
+        # What a run whose inputs don't fit does:  "stream" them a few at a time (cron
+        # ingests) or "fail" before downloading anything
+        self.on_shortage: str = values.get("on_shortage", "stream")
+        if self.on_shortage not in ("stream", "fail"):
+            raise ValueError(f"Unknown scratch on_shortage: {self.on_shortage}")
+
+    def get_env_vars(self) -> Dict[str, str]:
+        """Environment variables read by build_utils.scratch.ScratchManager"""
+        return {
+            "TSDAT_SCRATCH_HEADROOM_MB": str(self.headroom_mb),
+            "TSDAT_SCRATCH_ON_SHORTAGE": self.on_shortage,
+        }
+
+
+class RolloutConfig:
+    def __init__(self, values: dict):
+        # Publish a version on every deploy, warm it up, and then move the alias the
+        # triggers invoke.  If False, the image is swapped in place on $LATEST.
+        self.versioned: bool = bool(values.get("versioned", False))
+
+        # Alias the triggers invoke
+        self.alias: str = values.get("alias", "live")
+
+        # Concurrent warm-up invocations of a new version before the alias moves (0
+        # moves it without a warm-up)
+        self.warmup_invocations: int = int(values.get("warmup_invocations", 5))
+        if self.warmup_invocations < 0:
+            raise ValueError(
+                "rollout warmup_invocations must be 0 or more, got"
+                f" {self.warmup_invocations}"
+            )
+
+        # Number of published versions kept for rollbacks (older ones are deleted)
+        self.keep_versions: int = int(values.get("keep_versions", 3))
+
+
+class CatalogConfig:
+    def __init__(self, values: dict):
+        # Where datastream writes are recorded: "s3", "sqlite", or None (no catalog)
+        self.backend: Optional[str] = values.get("backend")
+
+        # Key prefix in the output bucket (s3) or path to the database file (sqlite)
+        self.path: Optional[str] = values.get("path")
+
+    def get_env_vars(self) -> Dict[str, str]:
+        """Environment variables read by build_utils.catalog.get_catalog()"""
+        env_vars = {"TSDAT_CATALOG": self.backend or ""}
+        if self.path:
+            env_vars["TSDAT_CATALOG_PATH"] = self.path
+        return env_vars
+
+
+class MonitoringConfig:
+    def __init__(self, values: dict):
+        # Create a CloudWatch dashboard and alarms for each pipeline's lambdas
+        self.enabled: bool = bool(values.get("enabled", True))
+
+        # Email address subscribed to the alarm topic (top-level section only)
+        self.alarm_email: Optional[str] = values.get("alarm_email")
+
+        # Length of each alarm datapoint, and how many in a row must breach
+        self.period_minutes: int = int(values.get("period_minutes", 5))
+        self.evaluation_periods: int = int(values.get("evaluation_periods", 3))
+
+        # p95 duration as a fraction of the lambda's timeout
+        self.duration_p95_fraction: float = float(
+            values.get("duration_p95_fraction", 0.8)
+        )
+
+        # Throttled invocations per period above which the alarm goes off
+        self.max_throttles: int = int(values.get("max_throttles", 0))
+
+        # Fraction of invocations that fail
+        self.error_rate: float = float(values.get("error_rate", 0.05))
+
+        # Age of the oldest queued asynchronous event (S3, cron and EventBridge
+        # triggers all invoke the lambdas asynchronously)
+        self.async_event_age_minutes: float = float(
+            values.get("async_event_age_minutes", 30)
+        )
+
+
+class StaggerConfig:
+    def __init__(self, values: dict):
+        # Spread the cron rules of pipelines with the same schedule over offsets
+        # within their period instead of starting them all at once
+        self.enabled: bool = bool(values.get("enabled", True))
+
+        # The largest offset, in minutes and as a fraction of the schedule's period
+        self.max_offset_minutes: int = int(values.get("max_offset_minutes", 60))
+        self.max_offset_fraction: float = float(values.get("max_offset_fraction", 0.25))
+
 
 class PipelineConfig:
     def __init__(self, values: dict):
@@ -28,6 +395,53 @@ class PipelineConfig:
         self.trigger: str = values.get("trigger")
         self.schedule: str = values.get("schedule")
 
+        # Length of the data window each cron run processes (e.g., "15 minutes",
+        # "1 day", "1 month").  Defaults to the schedule's own period.
+        self.window: Optional[str] = values.get("window")
+        self.storage = StorageConfig(values.get("storage") or {})
+        self.profiling = ProfilingConfig(values.get("profiling") or {})
+        self.memory = MemoryConfig(values.get("memory") or {})
+        self.logging = LoggingConfig(values.get("logging") or {})
+        self.scratch = ScratchConfig(values.get("scratch") or {})
+        self.rollout = RolloutConfig(values.get("rollout") or {})
+        self.monitoring = MonitoringConfig(values.get("monitoring") or {})
+
+        # Minutes to wait after an upstream write before running (Upstream trigger).
+        # Upstream writes during the wait are coalesced into the same run.
+        self.debounce_minutes: float = float(values.get("debounce_minutes", 15))
+
+        # Cron triggers:  typical minutes a run takes, the pipelines whose runs at the
+        # same scheduled time must finish first, and an offset that overrides the one
+        # the build plans (see build_utils.stagger)
+        self.estimated_duration_minutes: float = float(
+            values.get("estimated_duration_minutes", 5)
+        )
+        self.depends_on: List[str] = values.get("depends_on") or []
+        schedule_offset = values.get("schedule_offset_minutes")
+        self.schedule_offset_minutes: Optional[int] = (
+            int(schedule_offset) if schedule_offset is not None else None
+        )
+
+        # Take a lease on the output datastream and time window before running, so
+        # concurrent invocations for the same work coalesce instead of duplicating it.
+        # The lease expires this long after its run stops renewing it.
+        self.single_flight: bool = bool(values.get("single_flight", False))
+        self.lease_ttl_seconds: int = int(values.get("lease_ttl_seconds", 120))
+
+        # Deploy one lambda for all of the pipeline's configs instead of one per
+        # config, so warm containers are shared.  The config is resolved per event.
+        self.consolidated: bool = bool(values.get("consolidated", False))
+
+        # Store a fingerprint of the input objects (keys and ETags) each VAP run read,
+        # and skip the next run of the same window if its inputs are unchanged
+        self.input_fingerprints: bool = self.type == PipelineType.VAP and bool(
+            values.get("input_fingerprints", False)
+        )
+        if self.input_fingerprints and self.storage.classname is None:
+            # Only the storage classes in build_utils.storage record their inputs, so
+            # opting in also opts in to them
+            self.storage.classname = StorageConfig.TUNED_CLASSNAME
+
         self.configs: Dict[str, RunConfig] = {}
         configs: dict = values.get("configs", {})
         for run_id, run in configs.items():
@@ -35,23 +449,37 @@ class PipelineConfig:
 
     @property
     def cron_expression(self):
-        # https://docs.aws.amazon.com/eventbridge/latest/userguide/eb-cron-expressions.html
-        # cron(Minutes Hours Day-of-month Month Day-of-week Year)
-
-        if self.schedule == Schedule.Hourly:
-            return "cron(0 0/1 * * ? *)"
-
-        elif self.schedule == Schedule.Weekly:
-            # 2:30 am on the first day of the week
-            return "cron(30 2 ? * 1 *)"
-
-        elif self.schedule == Schedule.Monthly:
-            # 3 am on the first day of the month
-            return "cron(0 3 1 * ? *)"
-
-        else:  # Daily is default if not specified
-            # 2 am daily
-            return "cron(0 2 * * ? *)"
+        # Daily is default if not specified
+        return get_schedule_expression(self.schedule)
+
+    def get_window(self, now: datetime) -> Tuple[datetime, datetime]:
+        """Get the start and end of the data window a cron run at `now` processes."""
+        return get_window(self.schedule, self.window, now)
+
+    def find_run_config(self, key: str, upstream: bool = False) -> Optional[RunConfig]:
+        """Find the run config whose input_bucket_path (or, if upstream, one of whose
+        upstream_bucket_paths) is the longest prefix of the bucket key.  Input keys go
+        to the configs whose input_suffixes and input_regex match them, so configs that
+        share a prefix but not their filters each get their own files.  If none of the
+        filters match, the key goes to the longest prefix anyway (and is skipped by
+        that config's get_skip_reason)."""
+        best, best_length = None, -1
+        fallback, fallback_length = None, -1
+        for run_config in self.configs.values():
+            paths = (
+                run_config.upstream_bucket_paths
+                if upstream
+                else [run_config.input_bucket_path]
+            )
+            matches = upstream or run_config.matches_input_key(key)
+            for path in paths:
+                if not path or not key.startswith(path):
+                    continue
+                if matches and len(path) > best_length:
+                    best, best_length = run_config, len(path)
+                if len(path) > fallback_length:
+                    fallback, fallback_length = run_config, len(path)
+        return best if best is not None else fallback
 
 
 class PipelinesConfig:
@@ -74,17 +502,52 @@ class PipelinesConfig:
         self.input_bucket_name = config.get("input_bucket_name")
         self.output_bucket_name = config.get("output_bucket_name")
         self.create_buckets = config.get("create_buckets")
+        self.build = BuildConfig(config.get("build") or {})
+        self.catalog = CatalogConfig(config.get("catalog") or {})
+
+        # Dashboards and alarms.  The top-level section has the defaults that each
+        # pipeline's `monitoring` section overrides.
+        monitoring: dict = config.get("monitoring") or {}
+        self.monitoring = MonitoringConfig(monitoring)
+
+        # How the cron rules of the pipelines are staggered
+        self.stagger = StaggerConfig(config.get("stagger") or {})
+
+        # How input bucket events are routed to the S3 triggered lambdas
+        self.s3_routing: str = config.get("s3_routing") or S3Routing.Notifications
 
         self.pipelines: Dict[str, PipelineConfig] = {}
         pipelines_to_deploy: List[dict] = config.get("pipelines", [])
         for p in pipelines_to_deploy:
             name = p["name"]
+            p = {**p, "monitoring": {**monitoring, **(p.get("monitoring") or {})}}
             self.pipelines[name] = PipelineConfig(p)
 
     @property
     def base_name(self):
         return f"{self.pipelines_repo_name}-{Env.BRANCH}"
 
+    @property
+    def uses_containers(self) -> bool:
+        # The stack only creates the Fargate cluster and network if a config needs it
+        return any(
+            run_config.backend == Backend.Container
+            for pipeline in self.pipelines.values()
+            for run_config in pipeline.configs.values()
+        )
+
+    @property
+    def container_cluster_name(self):
+        return f"{self.base_name}-cluster"
+
+    @property
+    def container_log_group_name(self):
+        return f"/ecs/{self.base_name}"
+
+    @property
+    def alarm_topic_name(self):
+        return f"{self.base_name}-alarms"
+
     @property
     def pipeline_stack_name(self):
         return f"{self.base_name}-CodePipelineStack"
@@ -127,14 +590,40 @@ class PipelinesConfig:
         return f"{self.ecr_repo}:{self.get_image_tag(tsdat_pipeline_name)}"
 
     def get_lambda_name(self, tsdat_pipeline_name: str, config_id: str):
+        # Also the prefix of the names of the config's triggers and permissions
         return f"{self.base_name}-lambda-{tsdat_pipeline_name}-{config_id}"
 
+    def get_function_name(self, tsdat_pipeline_name: str, config_id: Optional[str]):
+        # The lambda that runs the config:  consolidated pipelines have one lambda
+        # for all of their configs
+        if self.pipelines[tsdat_pipeline_name].consolidated:
+            return f"{self.base_name}-lambda-{tsdat_pipeline_name}"
+        return self.get_lambda_name(tsdat_pipeline_name, config_id)
+
     def get_lambda_arn(self, tsdat_pipeline_name: str, config_id: str):
         # f'arn:aws:lambda:{YOUR_REGION}:{YOUR_ACCOUNT_ID}:function:{lambda_function_name}'
         return (
-            f"arn:aws:lambda:{self.region}:{self.account_id}:function:{self.get_lambda_name(tsdat_pipeline_name, config_id)}"
+            f"arn:aws:lambda:{self.region}:{self.account_id}:function:{self.get_function_name(tsdat_pipeline_name, config_id)}"
         )
 
+    def get_lambda_alias_arn(
+        self, tsdat_pipeline_name: str, config_id: str, alias: str
+    ):
+        return f"{self.get_lambda_arn(tsdat_pipeline_name, config_id)}:{alias}"
+
+    def get_task_family(self, tsdat_pipeline_name: str, config_id: str):
+        # Task definition family of a config with the container backend
+        return f"{self.base_name}-task-{tsdat_pipeline_name}-{config_id}"
+
+    def get_dashboard_name(self, tsdat_pipeline_name: str):
+        # Dashboard names may only contain letters, digits, "-" and "_"
+        name = f"{self.base_name}-{tsdat_pipeline_name}"
+        return re.sub(r"[^A-Za-z0-9_-]", "_", name)
+
+    def get_alarm_prefix(self, tsdat_pipeline_name: str):
+        # Prefix of the names of all of the pipeline's alarms
+        return f"{self.base_name}-alarm-{tsdat_pipeline_name}:"
+
     def get_cron_rule_name(self, tsdat_pipeline_name: str, config_id: str):
         return f"{self.get_lambda_name(tsdat_pipeline_name, config_id)}-cron-rule"
 
@@ -144,9 +633,25 @@ class PipelinesConfig:
     def get_bucket_trigger_statement_id(self, tsdat_pipeline_name: str, config_id: str):
         return f"{self.get_lambda_name(tsdat_pipeline_name, config_id)}-s3-policy"
 
+    def get_s3_rule_name(self, tsdat_pipeline_name: str, config_id: str):
+        return f"{self.get_lambda_name(tsdat_pipeline_name, config_id)}-s3-rule"
+
+    def get_s3_rule_trigger_statement_id(
+        self, tsdat_pipeline_name: str, config_id: str
+    ):
+        return f"{self.get_lambda_name(tsdat_pipeline_name, config_id)}-s3-rule-policy"
+
     def get_cron_trigger_statement_id(self, tsdat_pipeline_name: str, config_id: str):
         return f"{self.get_lambda_name(tsdat_pipeline_name, config_id)}-cron-policy"
 
+    def get_upstream_rule_name(self, tsdat_pipeline_name: str, config_id: str):
+        return f"{self.get_lambda_name(tsdat_pipeline_name, config_id)}-upstream-rule"
+
+    def get_upstream_trigger_statement_id(
+        self, tsdat_pipeline_name: str, config_id: str
+    ):
+        return f"{self.get_lambda_name(tsdat_pipeline_name, config_id)}-upstream-policy"
+
     @staticmethod
     def get_config_file_path():
         utils_dir = os.path.dirname(os.path.realpath(__file__))
@@ -0,0 +1,120 @@
+# This file is copied into the base image and streams the inputs of a cron ingest
+# through the pipeline:  the next inputs are downloaded on a background thread while
+# the current batch is processed, so network and CPU overlap and only a few inputs
+# are in scratch space at a time.
+
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class Prefetcher:
+    """Downloads inputs on a background thread, at most `depth` inputs ahead of the
+    consumer, and yields them in batches of `batch_size` in their original order.
+
+    Use it as a context manager so the download thread is stopped and any inputs that
+    were downloaded but never consumed are deleted if the consumer stops early:
+
+        with Prefetcher(download, keys, depth=4) as prefetcher:
+            for batch in prefetcher:
+                pipeline.run(batch)
+
+    An exception raised by `download` is raised by the iterator at the input that
+    failed.
+    """
+
+    def __init__(
+        self,
+        download: Callable[[str], str],
+        keys: List[str],
+        depth: int = 2,
+        batch_size: int = 1,
+    ):
+        self.download = download
+        self.keys = keys
+        self.batch_size = max(1, batch_size)
+        # Room for at least one batch, or the consumer would wait forever
+        self._queue: queue.Queue = queue.Queue(maxsize=max(depth, self.batch_size))
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.download_s = 0.0  # Time spent downloading (on the background thread)
+        self.wait_s = 0.0  # Time the consumer spent waiting for downloads
+        self.batches = 0
+
+    def __enter__(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        # Delete the inputs that were downloaded but not consumed
+        while not self._queue.empty():
+            _, path, _ = self._queue.get_nowait()
+            if path is not None:
+                _remove(path)
+        return False
+
+    def __iter__(self) -> Iterator[List[str]]:
+        batch: List[str] = []
+        for _ in self.keys:
+            started = time.monotonic()
+            key, path, error = self._queue.get()
+            self.wait_s += time.monotonic() - started
+            if error is not None:
+                raise error
+            batch.append(path)
+            if len(batch) == self.batch_size:
+                self.batches += 1
+                yield batch
+                batch = []
+        if batch:
+            self.batches += 1
+            yield batch
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inputs": len(self.keys),
+            "batches": self.batches,
+            "download_seconds": round(self.download_s, 3),
+            "wait_seconds": round(self.wait_s, 3),
+        }
+
+    def _produce(self):
+        for key in self.keys:
+            if self._stop.is_set():
+                return
+            started = time.monotonic()
+            item: Tuple[str, Optional[str], Optional[BaseException]]
+            try:
+                item = (key, self.download(key), None)
+            except BaseException as e:
+                item = (key, None, e)
+            self.download_s += time.monotonic() - started
+
+            # Block while the queue is full, but give up if the consumer stopped
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            else:
+                if item[1] is not None:
+                    _remove(item[1])
+                return
+            if item[2] is not None:
+                return
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,202 @@
+# This file is copied into the base image and is used to profile pipeline runs in
+# place.  It is switched on with environment variables set by the build from the
+# pipeline's `profiling` config (see pipelines_config.yml).
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+
+class ProfileMode:
+    # Deterministic profiler (cProfile).  Exact call counts and times, but adds
+    # overhead to every function call.
+    CProfile = "cprofile"
+
+    # Samples the running thread's stack at a fixed interval.  Low overhead, so it
+    # can stay enabled on a fraction of production invocations.
+    Sample = "sample"
+
+
+class RunProfiler(ABC):
+    """Profiles the code run inside the `with` block."""
+
+    mode: str
+    extension: str
+
+    def __init__(self, top_n: int = 20):
+        self.top_n = top_n
+
+    @abstractmethod
+    def __enter__(self):
+        """Start profiling."""
+
+    @abstractmethod
+    def __exit__(self, *exc):
+        """Stop profiling."""
+
+    @abstractmethod
+    def summary(self) -> List[Dict[str, Any]]:
+        """The top N hot functions."""
+
+    @abstractmethod
+    def save(self, path: str):
+        """Write the profile artifact to the path."""
+
+
+class CProfileProfiler(RunProfiler):
+    mode = ProfileMode.CProfile
+    extension = "prof"  # Readable with pstats, snakeviz, etc.
+
+    def __init__(self, top_n: int = 20):
+        super().__init__(top_n)
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.disable()
+        return False
+
+    def summary(self) -> List[Dict[str, Any]]:
+        stats = pstats.Stats(self.profile, stream=io.StringIO())
+        rows = []
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in sorted(
+            stats.stats.items(), key=lambda item: item[1][2], reverse=True
+        )[: self.top_n]:
+            rows.append(
+                {
+                    "function": f"{_short_path(filename)}:{line}({name})",
+                    "calls": calls,
+                    "self_s": round(tottime, 4),
+                    "total_s": round(cumtime, 4),
+                }
+            )
+        return rows
+
+    def save(self, path: str):
+        self.profile.dump_stats(path)
+
+
+class SamplingProfiler(RunProfiler):
+    """Samples the stack of the thread that entered the `with` block from a
+    background thread."""
+
+    mode = ProfileMode.Sample
+    extension = "folded"  # Collapsed stacks, readable with flamegraph tools
+
+    def __init__(self, top_n: int = 20, interval_ms: float = 10):
+        super().__init__(top_n)
+        self.interval = interval_ms / 1000
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        target_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample, args=(target_id,), daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return False
+
+    def _sample(self, target_id: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{_short_path(code.co_filename)}:{code.co_firstlineno}"
+                    f"({code.co_name})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def summary(self) -> List[Dict[str, Any]]:
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for function in set(stack):
+                total_counts[function] += count
+        samples = self.samples or 1
+        return [
+            {
+                "function": function,
+                "samples": count,
+                "self_pct": round(100 * count / samples, 2),
+                "total_pct": round(100 * total_counts[function] / samples, 2),
+            }
+            for function, count in self_counts.most_common(self.top_n)
+        ]
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{';'.join(stack)} {count}\n")
+
+
+def _short_path(filename: str) -> str:
+    # Trim the site-packages/working directory prefix so summaries stay readable
+    if "site-packages/" in filename:
+        return filename.split("site-packages/", 1)[1]
+    cwd = os.getcwd() + os.sep
+    return filename[len(cwd) :] if filename.startswith(cwd) else filename
+
+
+def get_profiler(config_id: Optional[str] = None) -> Optional[RunProfiler]:
+    """Get a profiler for this invocation, or None if profiling is off or this
+    invocation wasn't sampled.  Configured with these environment variables, which
+    the build sets from the pipeline's `profiling` config:
+
+        PROFILE_MODE: cprofile or sample.  Empty or unset disables profiling.
+        PROFILE_CONFIGS: comma-separated config ids to profile, for lambdas that run
+            several configs (default all)
+        PROFILE_SAMPLE_RATE: fraction of invocations to profile (default 1)
+        PROFILE_INTERVAL_MS: stack sampling interval for the sample mode (default 10)
+        PROFILE_TOP_N: number of hot functions in the summary (default 20)
+    """
+    mode = os.environ.get("PROFILE_MODE", "").lower()
+    if not mode:
+        return None
+    configs = os.environ.get("PROFILE_CONFIGS")
+    if configs and config_id not in configs.split(","):
+        return None
+    if random.random() >= float(os.environ.get("PROFILE_SAMPLE_RATE", 1)):
+        return None
+
+    top_n = int(os.environ.get("PROFILE_TOP_N", 20))
+    if mode == ProfileMode.CProfile:
+        return CProfileProfiler(top_n)
+    elif mode == ProfileMode.Sample:
+        interval_ms = float(os.environ.get("PROFILE_INTERVAL_MS", 10))
+        return SamplingProfiler(top_n, interval_ms)
+    raise ValueError(f"Unknown PROFILE_MODE: {mode}")
+
+
+def get_profile_name(profiler: RunProfiler) -> str:
+    # The uuid keeps concurrent runs of a datastream in the same second apart
+    timestamp = time.strftime("%Y%m%d.%H%M%S", time.gmtime())
+    run_id = uuid.uuid4().hex[:8]
+    return f"{timestamp}.{run_id}.{profiler.mode}.{profiler.extension}"
@@ -0,0 +1,174 @@
+# This file is copied into the base image and provides a scratch-disk cache for
+# files read from S3 that survives across warm lambda invocations
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class S3FileCache:
+    """Content-addressed LRU cache of S3 objects in the lambda's ephemeral storage.
+
+    Entries are keyed by bucket, key and ETag, so an object that is overwritten in S3
+    is never served stale.  When the cached bytes exceed the budget, the least
+    recently used entries are evicted.  Files are handed out as hard links (or copies
+    if linking fails), so callers may delete them without affecting the cache.
+
+    The cache is configured with these environment variables, which are set by the
+    lambda function from the pipeline's `storage` config:
+
+        TSDAT_S3_CACHE_MAX_MB: byte budget of the cache in MB.  0 disables caching.
+        TSDAT_S3_CACHE_DIR: where cached files are kept.  This must be outside the
+            lambda function's temporary directory, which is removed after each run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._loaded_dir = None
+        self.reset_stats()
+
+    @property
+    def max_bytes(self) -> int:
+        return int(float(os.environ.get("TSDAT_S3_CACHE_MAX_MB", 0)) * MB)
+
+    @property
+    def cache_dir(self) -> Path:
+        return Path(os.environ.get("TSDAT_S3_CACHE_DIR", "/tmp/tsdat-s3-cache"))
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def size(self) -> int:
+        return sum(self._entries.values())
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats: Dict[str, Any] = {
+                "hits": 0,
+                "misses": 0,
+                "evictions": 0,
+                "bytes_from_cache": 0,
+                "bytes_downloaded": 0,
+            }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["cached_bytes"] = self.size
+            stats["cached_files"] = len(self._entries)
+        stats["enabled"] = self.enabled
+        return stats
+
+    def download_file(self, client, bucket_name: str, key: str, filename: str):
+        """Download s3://bucket_name/key to filename, using the cache if possible.
+
+        Args:
+            client: boto3 S3 client
+            bucket_name (str): the bucket to read from
+            key (str): the object key
+            filename (str): local path to write the file to
+        """
+        if not self.enabled:
+            client.download_file(bucket_name, key, filename)
+            return
+
+        head = client.head_object(Bucket=bucket_name, Key=key)
+        entry = self._get_entry_name(bucket_name, key, head["ETag"])
+        size = head["ContentLength"]
+
+        with self._lock:
+            self._load_index()
+            hit = entry in self._entries
+            if hit:
+                self._entries.move_to_end(entry)
+                self.stats["hits"] += 1
+                self.stats["bytes_from_cache"] += size
+            else:
+                self.stats["misses"] += 1
+                self.stats["bytes_downloaded"] += size
+
+        if hit:
+            self._link(self.cache_dir / entry, filename)
+            return
+
+        if size > self.max_bytes:
+            # Never fits, so don't throw out the rest of the cache for it
+            client.download_file(bucket_name, key, filename)
+            return
+
+        # Download to a temporary name so a failed download never looks cached
+        path = self.cache_dir / entry
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.part")
+        client.download_file(bucket_name, key, str(tmp_path))
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._entries[entry] = size
+            self._entries.move_to_end(entry)
+            self._evict(keep=entry)
+
+        self._link(path, filename)
+
+    def _load_index(self):
+        # Rebuild the index from disk the first time the cache is used (or if the
+        # cache directory changed)
+        cache_dir = self.cache_dir
+        if self._loaded_dir == cache_dir:
+            return
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        files = [p for p in cache_dir.iterdir() if p.is_file() and not p.suffix]
+        files.sort(key=lambda p: p.stat().st_atime)
+        self._entries = OrderedDict((p.name, p.stat().st_size) for p in files)
+        self._loaded_dir = cache_dir
+
+    def _evict(self, keep: str):
+        total = self.size
+        while total > self.max_bytes and len(self._entries) > 1:
+            entry, size = next(iter(self._entries.items()))
+            if entry == keep:
+                break
+            del self._entries[entry]
+            total -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(self.cache_dir / entry)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _get_entry_name(bucket_name: str, key: str, etag: str) -> str:
+        return hashlib.sha256(f"{bucket_name}/{key}/{etag}".encode()).hexdigest()
+
+    @staticmethod
+    def _link(source: Path, filename: str):
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.lexists(filename):
+            os.remove(filename)
+        try:
+            os.link(source, filename)
+        except OSError:
+            shutil.copy2(source, filename)
+
+
+# Shared by all storage reads in the container
+CACHE = S3FileCache()
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    return CACHE.get_stats()
+
+
+def reset_cache_stats():
+    CACHE.reset_stats()
@@ -0,0 +1,332 @@
+import calendar
+import re
+from datetime import datetime, timedelta
+from typing import List, Optional, Set, Tuple
+
+from .constants import Schedule
+
+# https://docs.aws.amazon.com/eventbridge/latest/userguide/eb-cron-expressions.html
+# cron(Minutes Hours Day-of-month Month Day-of-week Year)
+SCHEDULE_CRON_EXPRESSIONS = {
+    Schedule.Hourly: "cron(0 0/1 * * ? *)",
+    # 2:30 am on the first day of the week
+    Schedule.Weekly: "cron(30 2 ? * 1 *)",
+    # 3 am on the first day of the month
+    Schedule.Monthly: "cron(0 3 1 * ? *)",
+    # 2 am daily
+    Schedule.Daily: "cron(0 2 * * ? *)",
+}
+
+# The data window each named schedule processes
+SCHEDULE_WINDOWS = {
+    Schedule.Hourly: "1 hour",
+    Schedule.Daily: "1 day",
+    Schedule.Weekly: "1 week",
+    Schedule.Monthly: "1 month",
+}
+
+_EVERY_PATTERN = re.compile(r"^every\s+(\d+)\s+(minute|hour)s?$", re.IGNORECASE)
+_WINDOW_PATTERN = re.compile(r"^(\d+)\s+(minute|hour|day|week|month)s?$", re.IGNORECASE)
+_CRON_PATTERN = re.compile(r"^cron\((.*)\)$", re.IGNORECASE)
+
+_MONTH_NAMES = {name.upper(): i for i, name in enumerate(calendar.month_abbr) if name}
+_DAY_NAMES = {"SUN": 1, "MON": 2, "TUE": 3, "WED": 4, "THU": 5, "FRI": 6, "SAT": 7}
+
+
+class CronExpression:
+    """An AWS EventBridge cron expression, e.g., `cron(0/10 * * * ? *)`.
+
+    Supports `*`, `?`, values, ranges, lists, steps, and month/day names.  The `L`,
+    `W` and `#` day wildcards are not supported.  Times are in UTC.
+    """
+
+    def __init__(self, expression: str):
+        match = _CRON_PATTERN.match(expression.strip())
+        fields = match.group(1).split() if match else []
+        if len(fields) != 6:
+            raise ValueError(
+                f"Invalid cron expression: {expression}.  Expected"
+                " cron(Minutes Hours Day-of-month Month Day-of-week Year)"
+            )
+        self.expression = expression
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12, _MONTH_NAMES)
+        self.weekdays = _parse_field(fields[4], 1, 7, _DAY_NAMES)
+        self.years = _parse_field(fields[5], 1970, 2199)
+
+    def matches_day(self, time: datetime) -> bool:
+        # AWS numbers the days of the week 1-7 starting on Sunday
+        weekday = (time.weekday() + 1) % 7 + 1
+        return (
+            time.year in self.years
+            and time.month in self.months
+            and time.day in self.days
+            and weekday in self.weekdays
+        )
+
+    def previous(self, time: datetime) -> datetime:
+        """Get the latest time at or before the given time that the expression fires.
+
+        Args:
+            time (datetime): the time to search back from
+
+        Returns:
+            datetime: the previous fire time
+        """
+        time = time.replace(second=0, microsecond=0)
+        day = time.replace(hour=0, minute=0)
+        # Search back up to the longest gap a supported expression can have
+        for offset in range(366 * 8):
+            if self.matches_day(day):
+                for hour in sorted(self.hours, reverse=True):
+                    for minute in sorted(self.minutes, reverse=True):
+                        fire = day.replace(hour=hour, minute=minute)
+                        if fire <= time:
+                            return fire
+            day -= timedelta(days=1)
+        raise ValueError(f"{self.expression} never fires before {time}")
+
+
+def _parse_field(
+    field: str, low: int, high: int, names: Optional[dict] = None
+) -> Set[int]:
+    values: Set[int] = set()
+    for part in field.upper().split(","):
+        if names:
+            for name, number in names.items():
+                part = part.replace(name, str(number))
+
+        step = None
+        if "/" in part:
+            part, step_str = part.split("/")
+            step = int(step_str)
+
+        if part in ("*", "?"):
+            start, end = low, high
+        elif "-" in part:
+            start_str, end_str = part.split("-")
+            start, end = int(start_str), int(end_str)
+        elif part.isdigit():
+            # `5/15` means every 15 starting at 5
+            start = int(part)
+            end = high if step else start
+        else:
+            raise ValueError(f"Unsupported cron field value: {field}")
+
+        if start < low or end > high or start > end or step == 0:
+            raise ValueError(f"Cron field value {field} is out of range")
+        values.update(range(start, end + 1, step or 1))
+    return values
+
+
+def get_schedule_expression(schedule: Optional[str]) -> str:
+    """Convert a pipeline schedule to an EventBridge schedule expression.
+
+    Args:
+        schedule (str): Hourly, Daily, Weekly, Monthly, `every N minutes`,
+            `every N hours`, or a raw `cron(...)` expression.  Defaults to Daily.
+
+    Returns:
+        str: the cron expression for the EventBridge rule
+    """
+    schedule = (schedule or Schedule.Daily).strip()
+    if schedule in SCHEDULE_CRON_EXPRESSIONS:
+        return SCHEDULE_CRON_EXPRESSIONS[schedule]
+
+    if _CRON_PATTERN.match(schedule):
+        CronExpression(schedule)  # Validate it
+        return schedule
+
+    match = _EVERY_PATTERN.match(schedule)
+    if match:
+        count, unit = int(match.group(1)), match.group(2).lower()
+        # Only allow intervals that evenly divide the hour/day so every run's window
+        # lines up with the previous one
+        period = 60 if unit == "minute" else 24
+        if count < 1 or period % count:
+            raise ValueError(
+                f"Schedule '{schedule}' must use an interval that divides {period}"
+            )
+        if unit == "minute":
+            return f"cron(0/{count} * * * ? *)"
+        return f"cron(0 0/{count} * * ? *)"
+
+    raise ValueError(f"Unknown schedule: {schedule}")
+
+
+def get_default_window(schedule: Optional[str]) -> Optional[str]:
+    """Get the window a schedule processes if the pipeline doesn't set one.  Named
+    schedules and `every N ...` schedules process their own period; for raw cron
+    expressions this returns None, meaning the time since the previous fire."""
+    schedule = (schedule or Schedule.Daily).strip()
+    if schedule in SCHEDULE_WINDOWS:
+        return SCHEDULE_WINDOWS[schedule]
+    match = _EVERY_PATTERN.match(schedule)
+    if match:
+        return f"{match.group(1)} {match.group(2).lower()}"
+    return None
+
+
+def get_offset_capacity(expression: str) -> int:
+    """Get the most minutes a cron expression's fire times can be delayed by (see
+    shift_cron_expression) so that each delayed fire still comes before the next
+    scheduled one.  The runs then keep processing the window of their scheduled time,
+    since get_window uses the previous fire of the unshifted expression.
+
+    Only expressions with a single minute and a single hour, or a single minute and
+    a `*` or `H/N` hour, or a `M/N` minute and a `*` hour can be shifted (all of the
+    named and `every N ...` schedules).  Fires are kept on the same day, so day of
+    month and day of week fields don't change.
+
+    Args:
+        expression (str): an EventBridge cron expression
+
+    Returns:
+        int: the largest offset in minutes, or 0 if the expression can't be shifted
+    """
+    minute, hour = _split_cron(expression)[:2]
+    minute_step, hour_step = _parse_step(minute), _parse_step(hour)
+    if minute_step and hour == "*":
+        start, step = minute_step
+        return max(0, step - 1 - start)
+    if not minute.isdigit():
+        return 0
+    if hour == "*":
+        return 59 - int(minute)
+    if hour_step:
+        start, step = hour_step
+        return max(0, step * 60 - 1 - (start * 60 + int(minute)))
+    if hour.isdigit():
+        return 24 * 60 - 1 - (int(hour) * 60 + int(minute))
+    return 0
+
+
+def shift_cron_expression(expression: str, minutes: int) -> str:
+    """Delay every fire time of a cron expression by the given minutes, e.g.,
+    `cron(0 0/1 * * ? *)` by 7 minutes is `cron(7 0/1 * * ? *)`.
+
+    Args:
+        expression (str): an EventBridge cron expression
+        minutes (int): the offset, at most get_offset_capacity(expression)
+
+    Returns:
+        str: the shifted cron expression
+    """
+    if minutes == 0:
+        return expression
+    if not 0 < minutes <= get_offset_capacity(expression):
+        raise ValueError(f"Can't shift {expression} by {minutes} minutes")
+    fields = _split_cron(expression)
+    minute_step, hour_step = _parse_step(fields[0]), _parse_step(fields[1])
+    if minute_step:
+        start, step = minute_step
+        fields[0] = f"{start + minutes}/{step}"
+    else:
+        total = int(fields[0]) + minutes
+        fields[0] = str(total % 60)
+        if hour_step:
+            start, step = hour_step
+            fields[1] = f"{start + total // 60}/{step}"
+        elif fields[1] != "*":
+            fields[1] = str(int(fields[1]) + total // 60)
+    return f"cron({' '.join(fields)})"
+
+
+def _parse_step(field: str) -> Optional[Tuple[int, int]]:
+    # The start and step of a `S/N` or `*/N` field
+    match = re.match(r"^(\*|\d+)/(\d+)$", field)
+    if not match:
+        return None
+    start = 0 if match.group(1) == "*" else int(match.group(1))
+    return start, int(match.group(2))
+
+
+def _split_cron(expression: str) -> List[str]:
+    CronExpression(expression)  # Validate it
+    match = _CRON_PATTERN.match(expression.strip())
+    assert match is not None
+    return match.group(1).split()
+
+
+def floor_time(time: datetime, window: str) -> datetime:
+    """Round the time down to the start of the window it falls in, e.g., the start
+    of the hour for `1 hour` or the first of the month for `1 month`.  Windows of N
+    minutes/hours are aligned to the start of the day; days and weeks to midnight."""
+    count, unit = _parse_window(window)
+    if unit == "minute":
+        minutes = (time.hour * 60 + time.minute) // count * count
+        return time.replace(
+            hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0
+        )
+    if unit == "hour":
+        return time.replace(
+            hour=time.hour // count * count, minute=0, second=0, microsecond=0
+        )
+    midnight = time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == "month":
+        return midnight.replace(day=1)
+    return midnight
+
+
+def subtract_window(time: datetime, window: str) -> datetime:
+    count, unit = _parse_window(window)
+    if unit == "month":
+        month_index = time.year * 12 + time.month - 1 - count
+        return time.replace(year=month_index // 12, month=month_index % 12 + 1)
+    return time - timedelta(**{f"{unit}s": count})
+
+
+def get_window(
+    schedule: Optional[str], window: Optional[str], now: datetime
+) -> Tuple[datetime, datetime]:
+    """Get the exact data window a scheduled run should process: the last complete
+    window before the schedule's most recent fire time.
+
+    For example, an Hourly run at 10:00 processes [09:00, 10:00), a Monthly run on
+    March 1st processes all of February, and a `cron(...)` schedule without a window
+    processes the time since its previous fire.
+
+    Args:
+        schedule (str): the pipeline's schedule (see get_schedule_expression)
+        window (str): length of the window, e.g., `15 minutes`, `1 day`, `1 month`,
+            or one of the named schedules.  Defaults to the schedule's period.
+        now (datetime): the time of the run
+
+    Returns:
+        Tuple[datetime, datetime]: start and end of the window
+    """
+    cron = CronExpression(get_schedule_expression(schedule))
+    # Use the scheduled time rather than now, so a late start still processes the
+    # window it was scheduled for
+    fired = cron.previous(now)
+
+    window = SCHEDULE_WINDOWS.get(window, window) or get_default_window(schedule)
+    if window is None:
+        return cron.previous(fired - timedelta(minutes=1)), fired
+
+    end = floor_time(fired, window)
+    return subtract_window(end, window), end
+
+
+def format_window(start: datetime, end: datetime) -> List[str]:
+    """Format a window as tsdat pipeline run arguments, using whole days when
+    possible."""
+    if all(t == floor_time(t, "1 day") for t in (start, end)):
+        return [start.strftime("%Y%m%d"), end.strftime("%Y%m%d")]
+    return [start.strftime("%Y%m%d.%H%M%S"), end.strftime("%Y%m%d.%H%M%S")]
+
+
+def _parse_window(window: str) -> Tuple[int, str]:
+    match = _WINDOW_PATTERN.match(window.strip())
+    if not match:
+        raise ValueError(
+            f"Invalid window: {window}.  Expected e.g. '15 minutes' or '1 month'"
+        )
+    count, unit = int(match.group(1)), match.group(2).lower()
+    if unit == "week":
+        count, unit = count * 7, "day"
+    if count < 1:
+        raise ValueError(f"Invalid window: {window}")
+    return count, unit
@@ -0,0 +1,164 @@
+# This file is copied into the base image and manages the scratch space that inputs
+# are downloaded to.  Each invocation gets its own directory, and the directories of
+# earlier invocations are deleted on a background thread instead of at the end of
+# each run, so large runs don't wait for the deletion.  Other processes may share the
+# root (e.g., the local workers of tools.reprocess), so each directory is named after
+# the process that made it, and only the manager's own earlier directories and those
+# of processes that have exited are deleted.
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Tells this process's directories from those of an earlier process with the same pid
+# (e.g., a lambda runtime restarted after running out of memory)
+PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+class ScratchManager:
+    """Per-invocation scratch directories under `root` and a budget check of the free
+    space left for them.
+
+    Configured with these environment variables, which the build sets from the
+    pipeline's `scratch` config:
+
+        TSDAT_SCRATCH_DIR: where the scratch directories are created
+            (default /tmp/tsdat-scratch)
+        TSDAT_SCRATCH_HEADROOM_MB: free space kept for the pipeline's own temporary
+            and output files, on top of its inputs (default 256)
+        TSDAT_SCRATCH_ON_SHORTAGE: what to do if the inputs don't fit:  "stream"
+            them through the pipeline a few at a time if the run supports it, or
+            "fail" before downloading anything (default stream)
+    """
+
+    def __init__(
+        self, root: Path, headroom_bytes: int = 256 * MB, on_shortage: str = "stream"
+    ):
+        self.root = root
+        self.headroom_bytes = headroom_bytes
+        self.on_shortage = on_shortage
+        self.current: Optional[Path] = None
+        self._created: Set[Path] = set()  # Still to be deleted
+        self._cleanup: Optional[threading.Thread] = None
+        self._lock = threading.Lock()  # The cleanup thread updates the stats
+        self.reset_stats()
+
+    @classmethod
+    def from_env(cls) -> "ScratchManager":
+        return cls(
+            Path(os.environ.get("TSDAT_SCRATCH_DIR", "/tmp/tsdat-scratch")),
+            int(float(os.environ.get("TSDAT_SCRATCH_HEADROOM_MB", 256)) * MB),
+            os.environ.get("TSDAT_SCRATCH_ON_SHORTAGE", "stream").lower(),
+        )
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats: Dict[str, Any] = {
+                "cleaned_dirs": 0,
+                "cleanup_s": 0.0,
+                "cleanup_wait_s": 0.0,
+            }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["cleanup_s"] = round(stats["cleanup_s"], 3)
+        stats["cleanup_wait_s"] = round(stats["cleanup_wait_s"], 3)
+        stats["free_mb"] = round(self.free_bytes() / MB, 1)
+        return stats
+
+    def new_dir(self) -> Path:
+        """Create the scratch directory of a new invocation and start deleting those
+        of earlier invocations in the background."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.reset_stats()
+        old_dirs = [path for path in self.root.iterdir() if self._is_old(path)]
+        self._created.difference_update(old_dirs)
+        if old_dirs:
+            # A cleanup that is still running (e.g., frozen with the last invocation)
+            # only deletes directories this one would also delete
+            self._cleanup = threading.Thread(
+                target=self._remove, args=(old_dirs,), daemon=True
+            )
+            self._cleanup.start()
+        self.current = Path(
+            tempfile.mkdtemp(
+                prefix=f"run-{os.getpid()}-{PROCESS_TOKEN}-", dir=self.root
+            )
+        )
+        self._created.add(self.current)
+        return self.current
+
+    def free_bytes(self) -> int:
+        self.root.mkdir(parents=True, exist_ok=True)
+        return shutil.disk_usage(self.root).free
+
+    def fits(self, nbytes: int) -> bool:
+        """Check if nbytes of inputs (and the headroom) fit in the free space.  Waits
+        for the cleanup of earlier invocations if they only fit without them."""
+        needed = nbytes + self.headroom_bytes
+        if needed <= self.free_bytes():
+            return True
+        if self._cleanup is not None and self._cleanup.is_alive():
+            started = time.monotonic()
+            self._cleanup.join()
+            with self._lock:
+                self.stats["cleanup_wait_s"] += time.monotonic() - started
+        return needed <= self.free_bytes()
+
+    def check(self, nbytes: int, what: str = "inputs"):
+        """Raise before anything is downloaded if nbytes don't fit.
+
+        Raises:
+            RuntimeError: if there isn't enough free scratch space.
+        """
+        if not self.fits(nbytes):
+            raise RuntimeError(
+                f"Not enough scratch space for {what}: {nbytes / MB:.1f} MB plus"
+                f" {self.headroom_bytes / MB:.0f} MB headroom needed, but only"
+                f" {self.free_bytes() / MB:.1f} MB free in {self.root}"
+            )
+
+    def _is_old(self, path: Path) -> bool:
+        """Check if the path is the scratch directory of an earlier invocation of this
+        manager, or of a process that has exited (e.g., one killed by an out of
+        memory error).  Those of other managers in live processes are in use."""
+        if path in self._created:
+            return True
+        if not path.name.startswith("run-") or not path.is_dir():
+            return False
+        try:
+            _, pid_text, token, _ = path.name.split("-", 3)
+            pid = int(pid_text)
+        except ValueError:
+            return True  # Not named after its process
+        if pid == os.getpid():
+            # Another manager's in this process, or an earlier process's
+            return token != PROCESS_TOKEN
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass  # Alive, but another user's
+        return False
+
+    def _remove(self, paths: List[Path]):
+        started = time.monotonic()
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+            with self._lock:
+                self.stats["cleaned_dirs"] += 1
+        with self._lock:
+            self.stats["cleanup_s"] += time.monotonic() - started
+        logger.debug("Removed %s old scratch directories", len(paths))
@@ -0,0 +1,173 @@
+# This file is used by the build to plan when the cron rules of the pipelines fire.
+# Pipelines with the same schedule would otherwise all start in the same second and
+# compete for the account's lambda concurrency and the request rate of their shared
+# input prefixes, so each run config's rule is delayed by an offset within its
+# schedule's period (see the `stagger` section of pipelines_config.yml).  Only the
+# rules move:  each run still processes the window of its scheduled time, because
+# get_window uses the unshifted schedule.
+
+import hashlib
+import math
+from typing import Dict, List, Optional, Tuple
+
+from .constants import Trigger
+from .pipelines_config import PipelinesConfig, StaggerConfig
+from .schedules import CronExpression, get_offset_capacity
+
+MINUTES_PER_DAY = 24 * 60
+
+# (pipeline name, config id)
+RunKey = Tuple[str, str]
+
+
+class PlannedRun:
+    def __init__(
+        self,
+        key: RunKey,
+        expression: str,
+        duration_minutes: float,
+        stagger: StaggerConfig,
+        pinned: Optional[int] = None,
+    ):
+        self.key = key
+        self.capacity = get_offset_capacity(expression)
+        self.duration = max(1, math.ceil(duration_minutes))
+        self.pinned = pinned
+        self.offset = 0
+
+        # The minutes of the day the unshifted rule fires at.  Load is counted on a 24
+        # hour clock, so weekly and monthly rules count as daily ones.
+        cron = CronExpression(expression)
+        self.fires = sorted(h * 60 + m for h in cron.hours for m in cron.minutes)
+
+        gaps = [b - a for a, b in zip(self.fires, self.fires[1:])]
+        period = min(gaps + [MINUTES_PER_DAY - self.fires[-1] + self.fires[0]])
+        self.max_offset = min(
+            self.capacity,
+            stagger.max_offset_minutes,
+            int(period * stagger.max_offset_fraction),
+        )
+
+        # Where the run goes if the load doesn't decide, so that offsets are stable
+        # between builds and runs that tie don't pile up on offset 0
+        digest = hashlib.sha256("/".join(key).encode()).hexdigest()
+        self.preferred = int(digest, 16) % (self.max_offset + 1)
+
+    def minutes(self, offset: int) -> List[int]:
+        """The minutes of the day the run is running at with the given offset."""
+        return [
+            (fire + offset + i) % MINUTES_PER_DAY
+            for fire in self.fires
+            for i in range(self.duration)
+        ]
+
+
+def plan_cron_offsets(config: PipelinesConfig) -> Dict[RunKey, int]:
+    """
+    Plan the offset of each cron triggered run config's rule.  Pipelines are placed
+    after the pipelines they depend on (`depends_on`), so that their runs at the same
+    scheduled time start once those are estimated to finish, and otherwise at the
+    offset where the fewest other runs are estimated to be running.
+
+    Args:
+        config (PipelinesConfig): the pipelines
+
+    Returns:
+        Dict[RunKey, int]: the offset in minutes of each (pipeline, config id).  Run
+            configs without a cron trigger aren't included.
+    """
+    runs: Dict[str, List[PlannedRun]] = {}
+    for pipeline in config.pipelines.values():
+        unknown = set(pipeline.depends_on) - set(config.pipelines)
+        if unknown:
+            raise ValueError(
+                f"Pipeline {pipeline.name} depends on unknown pipelines: {unknown}"
+            )
+        if pipeline.trigger != Trigger.Cron:
+            continue
+        runs[pipeline.name] = [
+            PlannedRun(
+                (pipeline.name, config_id),
+                pipeline.cron_expression,
+                pipeline.estimated_duration_minutes,
+                config.stagger,
+                pipeline.schedule_offset_minutes,
+            )
+            for config_id in sorted(pipeline.configs)
+        ]
+
+    if not config.stagger.enabled:
+        for pipeline_runs in runs.values():
+            for run in pipeline_runs:
+                run.offset = _check_pinned(run) if run.pinned is not None else 0
+        return {run.key: run.offset for rs in runs.values() for run in rs}
+
+    load = [0] * MINUTES_PER_DAY
+    for name in _get_order(config, runs):
+        for run in sorted(runs[name], key=lambda r: r.preferred):
+            earliest = 0
+            for upstream in config.pipelines[name].depends_on:
+                for upstream_run in runs.get(upstream, []):
+                    # Only runs at the same scheduled time are ordered
+                    if set(upstream_run.fires) & set(run.fires):
+                        earliest = max(
+                            earliest, upstream_run.offset + upstream_run.duration
+                        )
+
+            if run.pinned is not None:
+                run.offset = _check_pinned(run)
+            elif earliest > run.max_offset:
+                run.offset = run.max_offset
+            else:
+                run.offset = min(
+                    range(earliest, run.max_offset + 1),
+                    key=lambda offset: (
+                        max(load[m] for m in run.minutes(offset)),
+                        sum(load[m] for m in run.minutes(offset)),
+                        abs(offset - run.preferred),
+                    ),
+                )
+            if run.offset < earliest:
+                print(
+                    f"WARNING: {'/'.join(run.key)} starts {run.offset} minutes after"
+                    f" its scheduled time, before the pipelines it depends on are"
+                    f" estimated to finish ({earliest} minutes)"
+                )
+            for minute in run.minutes(run.offset):
+                load[minute] += 1
+
+    return {run.key: run.offset for rs in runs.values() for run in rs}
+
+
+def _check_pinned(run: PlannedRun) -> int:
+    assert run.pinned is not None
+    if not 0 <= run.pinned <= run.capacity:
+        raise ValueError(
+            f"schedule_offset_minutes of {run.key[0]} must be between 0 and"
+            f" {run.capacity} for its schedule"
+        )
+    return run.pinned
+
+
+def _get_order(config: PipelinesConfig, runs: Dict[str, List[PlannedRun]]) -> List[str]:
+    """Order the cron pipelines so each comes after the ones it depends on, longest
+    runs first among those that are ready."""
+    remaining = {
+        name: set(config.pipelines[name].depends_on) & set(runs) for name in runs
+    }
+    order: List[str] = []
+    while remaining:
+        ready = [name for name, upstream in remaining.items() if not upstream]
+        if not ready:
+            raise ValueError(
+                f"The depends_on of these pipelines form a cycle: {sorted(remaining)}"
+            )
+        ready.sort(
+            key=lambda name: (-max((r.duration for r in runs[name]), default=0), name)
+        )
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+        for upstream in remaining.values():
+            upstream.difference_update(ready)
+    return order
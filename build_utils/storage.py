@@ -0,0 +1,474 @@
+# This file is copied into the base image and provides storage classes that can be
+# selected per pipeline via the `storage` section of pipelines_config.yml
+
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from boto3.s3.transfer import TransferConfig
+from tsdat.io.storage import FileSystemS3
+
+from .catalog import record_write
+from .fingerprint import INPUTS
+from .s3_cache import CACHE
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class UploadManager:
+    """Uploads files to S3 using the transfer settings from the environment and keeps
+    track of the bytes written and upload latency for the run context.
+
+    The settings are read from these environment variables, which are set by the
+    lambda function from the pipeline's `storage` config:
+
+        TSDAT_S3_MULTIPART_THRESHOLD_MB: size at which uploads switch to multipart
+        TSDAT_S3_MAX_CONCURRENCY: number of threads used for each (multipart) upload
+        TSDAT_S3_ASYNC_UPLOAD: if "true", uploads run in the background so the pipeline
+            can continue processing while the files are sent to S3.  Call
+            `wait_for_uploads()` before the invocation ends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._staging_dir: Optional[Path] = None
+        self._pending: List[Future] = []
+        self._callbacks: List[Callable[[], None]] = []
+        self.reset_stats()
+
+    @property
+    def async_upload(self) -> bool:
+        return os.environ.get("TSDAT_S3_ASYNC_UPLOAD", "false").lower() == "true"
+
+    @property
+    def transfer_config(self) -> TransferConfig:
+        kwargs = {}
+        threshold_mb = os.environ.get("TSDAT_S3_MULTIPART_THRESHOLD_MB")
+        if threshold_mb:
+            kwargs["multipart_threshold"] = int(float(threshold_mb) * MB)
+        max_concurrency = os.environ.get("TSDAT_S3_MAX_CONCURRENCY")
+        if max_concurrency:
+            kwargs["max_concurrency"] = int(max_concurrency)
+        return TransferConfig(**kwargs)
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats: Dict[str, Any] = {
+                "files_written": 0,
+                "bytes_written": 0,
+                "upload_seconds": 0.0,
+                "max_upload_seconds": 0.0,
+            }
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["async_upload"] = self.async_upload
+        stats["upload_seconds"] = round(stats["upload_seconds"], 3)
+        stats["max_upload_seconds"] = round(stats["max_upload_seconds"], 3)
+        return stats
+
+    @contextlib.contextmanager
+    def capture_keys(self) -> Iterator[List[str]]:
+        """Collect the keys of all uploads made by this thread within the context."""
+        keys: List[str] = []
+        self._local.keys = keys
+        try:
+            yield keys
+        finally:
+            self._local.keys = None
+
+    def on_complete(self, callback: Callable[[], None]):
+        """Run callback once all uploads submitted so far have succeeded.  Callbacks
+        for uploads that fail are dropped."""
+        if not self.async_upload:
+            callback()
+            return
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def upload(
+        self, bucket, filename: str, key: str, extra_args: Optional[Dict] = None
+    ):
+        keys = getattr(self._local, "keys", None)
+        if keys is not None:
+            keys.append(key)
+
+        if not self.async_upload:
+            self._upload(bucket, filename, key, extra_args)
+            return
+
+        # The caller is free to delete its file as soon as we return (FileSystemS3
+        # writes into a temporary directory), so upload from our own hard link/copy
+        staged = self._stage(filename)
+        future = self._get_executor().submit(
+            self._upload, bucket, staged, key, extra_args, True
+        )
+        with self._lock:
+            self._pending.append(future)
+
+    def wait(self, raise_errors: bool = True):
+        """Block until all background uploads have finished.
+
+        Args:
+            raise_errors (bool): Raise the first upload error, if any. Defaults to True.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            callbacks, self._callbacks = self._callbacks, []
+
+        error = None
+        for future in pending:
+            exc = future.exception()
+            if exc is not None and error is None:
+                error = exc
+
+        if error is None:
+            for callback in callbacks:
+                callback()
+        elif raise_errors:
+            raise error
+
+    def _upload(
+        self,
+        bucket,
+        filename: str,
+        key: str,
+        extra_args: Optional[Dict] = None,
+        remove: bool = False,
+    ):
+        size = os.path.getsize(filename)
+        start = time.perf_counter()
+        try:
+            bucket.upload_file(
+                Filename=filename,
+                Key=key,
+                ExtraArgs=extra_args,
+                Config=self.transfer_config,
+            )
+        finally:
+            if remove:
+                os.remove(filename)
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats["files_written"] += 1
+            self.stats["bytes_written"] += size
+            self.stats["upload_seconds"] += elapsed
+            self.stats["max_upload_seconds"] = max(
+                self.stats["max_upload_seconds"], elapsed
+            )
+        logger.debug("Uploaded %s bytes to %s in %.3f s", size, key, elapsed)
+
+    def _stage(self, filename: str) -> str:
+        if self._staging_dir is None:
+            self._staging_dir = Path(tempfile.mkdtemp(prefix="tsdat-uploads-"))
+        staged = str(self._staging_dir / uuid.uuid4().hex)
+        try:
+            os.link(filename, staged)
+        except OSError:
+            shutil.copy2(filename, staged)
+        return staged
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix="tsdat-upload"
+            )
+        return self._executor
+
+
+# Shared by all storage instances in the container
+UPLOADS = UploadManager()
+
+
+def wait_for_uploads(raise_errors: bool = True):
+    UPLOADS.wait(raise_errors=raise_errors)
+
+
+def get_upload_stats() -> Dict[str, Any]:
+    return UPLOADS.get_stats()
+
+
+def reset_upload_stats():
+    UPLOADS.reset_stats()
+
+
+class _TunedBucket:
+    """Wraps a boto3 Bucket resource so that uploads made by FileSystemS3 go through
+    the UploadManager and downloads go through the shared S3FileCache.  Everything
+    else is passed through to the bucket."""
+
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def upload_file(self, Filename, Key, ExtraArgs=None, Callback=None, Config=None):
+        UPLOADS.upload(self._bucket, Filename, Key, ExtraArgs)
+
+    def download_file(self, Key, Filename, ExtraArgs=None, Callback=None, Config=None):
+        CACHE.download_file(self._bucket.meta.client, self._bucket.name, Key, Filename)
+
+    def __getattr__(self, name):
+        return getattr(self._bucket, name)
+
+
+class TunedFileSystemS3(FileSystemS3):
+    """FileSystemS3 with configurable multipart/concurrency transfer settings,
+    optional asynchronous uploads (see `UploadManager`), cached reads (see
+    `build_utils.s3_cache.S3FileCache`) and input fingerprints (see
+    `build_utils.fingerprint`)."""
+
+    @property
+    def _bucket(self):
+        return _TunedBucket(super()._bucket)
+
+    def _get_matching_s3_objects(self, filepath_glob: str):
+        matches = super()._get_matching_s3_objects(filepath_glob)
+        INPUTS.record_listing(matches)
+        return matches
+
+    def _find_data(
+        self,
+        start: datetime,
+        end: datetime,
+        datastream: str,
+        metadata_kwargs: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> List[Path]:
+        paths = super()._find_data(start, end, datastream, metadata_kwargs, **kwargs)
+        INPUTS.record_found(
+            datastream, start, end, metadata_kwargs, [p.as_posix() for p in paths]
+        )
+        return paths
+
+    def save_data(self, dataset: xr.Dataset, **kwargs: Any):
+        with UPLOADS.capture_keys() as keys:
+            super().save_data(dataset, **kwargs)
+        self._record_write(dataset, keys)
+        return None
+
+    @staticmethod
+    def _record_write(dataset: xr.Dataset, keys: List[str]):
+        # Add the write to the datastream catalog (if one is configured) once the
+        # files have actually been uploaded
+        datastream = dataset.attrs["datastream"]
+        start = pd.Timestamp(dataset["time"].values[0]).to_pydatetime()
+        end = pd.Timestamp(dataset["time"].values[-1]).to_pydatetime()
+
+        def record():
+            try:
+                record_write(datastream, start, end, keys)
+            except Exception:
+                # The write itself succeeded, so don't fail the run.  At worst the
+                # next scheduled run reprocesses this data.
+                logger.warning(
+                    "Failed to add %s write to the catalog", datastream, exc_info=True
+                )
+
+        UPLOADS.on_complete(record)
+
+
+class ZarrS3Storage(TunedFileSystemS3):
+    """Writes each datastream to a single chunked, appendable zarr store on S3, so a
+    run only writes the time window it produced instead of rewriting whole files.
+
+    Stores are written to `s3://{bucket}/{storage_root}/zarr/{datastream}.zarr`.  Each
+    write records its time window and write time in the store's attributes, so
+    `last_modified` and `modified_since` only read the (consolidated) store metadata
+    instead of listing objects.  Ancillary files are saved the same way as with
+    FileSystemS3.
+
+    Requires the `zarr` and `s3fs` packages in the pipelines environment.  The time
+    chunk size can be set with the TSDAT_ZARR_TIME_CHUNK environment variable (set
+    from the pipeline's `storage: zarr_time_chunk` config).
+    """
+
+    # Encoding keys that can be passed to the zarr backend when a store is created
+    _ZARR_ENCODING_KEYS = (
+        "_FillValue",
+        "dtype",
+        "units",
+        "calendar",
+        "scale_factor",
+        "add_offset",
+        "chunks",
+        "compressor",
+        "filters",
+    )
+
+    # Number of write windows kept in the store metadata
+    _MAX_WINDOWS = 1000
+
+    def save_data(self, dataset, **kwargs: Any):
+        datastream = dataset.attrs["datastream"]
+        store = self._get_store(datastream)
+        existing = self._open_store(store)
+
+        if existing is None:
+            dataset.to_zarr(
+                store, mode="w", encoding=self._get_encoding(dataset), consolidated=True
+            )
+        else:
+            last_time = existing["time"].values[-1]
+            new_data = dataset.sel(time=dataset["time"] > last_time)
+            old_data = dataset.sel(time=dataset["time"] <= last_time)
+
+            # Rewriting a window that was already written (e.g., a rerun) is only
+            # possible if the timestamps line up with what is in the store
+            if old_data["time"].size:
+                times = existing["time"].values
+                start = int(np.searchsorted(times, old_data["time"].values[0]))
+                stop = start + old_data["time"].size
+                if np.array_equal(times[start:stop], old_data["time"].values):
+                    region_vars = [
+                        name
+                        for name in old_data.variables
+                        if "time" not in old_data[name].dims
+                    ]
+                    old_data.drop_vars(region_vars).to_zarr(
+                        store, region={"time": slice(start, stop)}
+                    )
+                else:
+                    logger.warning(
+                        "Skipping %s timestamps for %s that do not line up with the"
+                        " existing zarr store",
+                        old_data["time"].size,
+                        datastream,
+                    )
+
+            if new_data["time"].size:
+                new_data.to_zarr(store, mode="a", append_dim="time", consolidated=True)
+            existing.close()
+
+        self._record_window(store, dataset)
+        self._record_write(dataset, [self._get_store_path(datastream)])
+        logger.info("Saved %s data to %s", datastream, self._get_store_path(datastream))
+        return None
+
+    def fetch_data(
+        self,
+        start: datetime,
+        end: datetime,
+        datastream: str,
+        metadata_kwargs: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ):
+        existing = self._open_store(self._get_store(datastream))
+        if existing is None:
+            logger.warning(
+                "No data found for %s in range %s - %s", datastream, start, end
+            )
+            return xr.Dataset()
+        return existing.sel(time=slice(start, end)).load()
+
+    def last_modified(self, datastream: str) -> Optional[datetime]:
+        attrs = self._read_attrs(datastream)
+        if not attrs.get("tsdat_last_modified"):
+            return None
+        return datetime.fromisoformat(attrs["tsdat_last_modified"])
+
+    def modified_since(
+        self, datastream: str, last_modified: datetime
+    ) -> List[datetime]:
+        windows = self._read_attrs(datastream).get("tsdat_windows", [])
+        return [
+            datetime.fromisoformat(window["start"])
+            for window in windows
+            if last_modified is None
+            or datetime.fromisoformat(window["written"]) > last_modified
+        ]
+
+    def _get_store_path(self, datastream: str) -> str:
+        root = self.parameters.storage_root.as_posix().strip("/")
+        return f"s3://{self.parameters.bucket}/{root}/zarr/{datastream}.zarr"
+
+    def _get_store(self, datastream: str):
+        try:
+            import s3fs
+            import zarr  # noqa: F401
+        except ImportError as e:
+            raise ImportError(
+                "ZarrS3Storage requires the 'zarr' and 's3fs' packages. Add them to"
+                " the environment.yml file in your pipelines repository."
+            ) from e
+
+        fs = s3fs.S3FileSystem(client_kwargs={"region_name": self.parameters.region})
+        return fs.get_mapper(self._get_store_path(datastream))
+
+    @staticmethod
+    def _store_exists(store) -> bool:
+        # Consolidated metadata key for zarr format 2 and 3, respectively
+        return ".zmetadata" in store or "zarr.json" in store
+
+    def _open_store(self, store):
+        if not self._store_exists(store):
+            return None
+        return xr.open_zarr(store, consolidated=True)
+
+    def _read_attrs(self, datastream: str) -> Dict[str, Any]:
+        import zarr
+
+        store = self._get_store(datastream)
+        if not self._store_exists(store):
+            return {}
+        return dict(zarr.open_group(store, mode="r").attrs)
+
+    def _get_encoding(self, dataset) -> Dict[str, Dict[str, Any]]:
+        time_chunk = os.environ.get("TSDAT_ZARR_TIME_CHUNK")
+        encoding: Dict[str, Dict[str, Any]] = {}
+        for name in dataset.variables:
+            var_encoding = {
+                key: value
+                for key, value in dataset[name].encoding.items()
+                if key in self._ZARR_ENCODING_KEYS
+            }
+            # Prevent xarray from setting 'nan' as the default _FillValue
+            if (
+                "_FillValue" not in var_encoding
+                and "_FillValue" not in dataset[name].attrs
+            ):
+                var_encoding["_FillValue"] = None
+            if time_chunk and "time" in dataset[name].dims:
+                var_encoding["chunks"] = tuple(
+                    int(time_chunk) if dim == "time" else dataset.sizes[dim]
+                    for dim in dataset[name].dims
+                )
+            encoding[name] = var_encoding
+        return encoding
+
+    def _record_window(self, store, dataset):
+        import zarr
+
+        written = datetime.now(timezone.utc).isoformat()
+        group = zarr.open_group(store, mode="a")
+        windows = list(group.attrs.get("tsdat_windows", []))
+        windows.append(
+            {
+                "start": pd.Timestamp(dataset["time"].values[0]).isoformat(),
+                "end": pd.Timestamp(dataset["time"].values[-1]).isoformat(),
+                "written": written,
+            }
+        )
+        group.attrs.update(
+            {
+                "tsdat_windows": windows[-self._MAX_WINDOWS :],
+                "tsdat_last_modified": written,
+            }
+        )
+        zarr.consolidate_metadata(store)
@@ -4,12 +4,28 @@ import shutil
 import subprocess
 import sys
 import traceback
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
 import boto3
-
-from build_utils.constants import Env, PipelineType, Trigger, Schedule
+from botocore.config import Config
+
+from build_utils.constants import (
+    PIPELINES_TO_BUILD_FILE,
+    WARMUP_EVENT_KEY,
+    Backend,
+    BuildStep,
+    Env,
+    PipelineType,
+    S3Routing,
+    Trigger,
+    Schedule,
+)
+from build_utils.containers import CONTAINER_NAME
+from build_utils.monitoring import get_alarms, get_dashboard_body
 from build_utils.pipelines_config import PipelinesConfig, PipelineConfig, RunConfig
+from build_utils.schedules import shift_cron_expression
+from build_utils.stagger import plan_cron_offsets
 
 
 class TsdatPipelineBuild:
@@ -36,6 +52,10 @@ class TsdatPipelineBuild:
         self.events_client = boto3.client("events", region_name=self.config.region)
         self.s3_client = boto3.client("s3", region_name=self.config.region)
         self.ecr_client = boto3.client("ecr", region_name=self.config.region)
+        self.ecs_client = boto3.client("ecs", region_name=self.config.region)
+        self.cloudwatch_client = boto3.client(
+            "cloudwatch", region_name=self.config.region
+        )
 
     def find_changed_tsdat_pipelines(self) -> List[str]:
         """
@@ -125,6 +145,18 @@ class TsdatPipelineBuild:
         dest_file = os.path.join(dest_folder, file_relative_path)
         shutil.copy(source_file, dest_file)
 
+    def copy_build_files(self):
+        """
+        Copy the build-provided files (Dockerfiles, lambda function, etc.) into the
+        pipelines repo, which is the context folder for the docker builds.
+
+        """
+        source_folder = os.path.join(Env.AWS_REPO_PATH, "code_build", "docker")
+        destination_folder = Env.PIPELINES_REPO_PATH
+        files = os.listdir(source_folder)
+        for file in files:
+            self.copy_file(source_folder, destination_folder, file)
+
     def build_base_image(self):
         """
         build the base Docker image that is shared by all pipelines.  This build runs
@@ -134,11 +166,8 @@ class TsdatPipelineBuild:
         # Build context is the pipeline repo root
         # Build file is code_build/docker/Dockerfile.base
         # Copy over all the build-provided files that need to be built into base image
-        source_folder = os.path.join(Env.AWS_REPO_PATH, "code_build", "docker")
+        self.copy_build_files()
         destination_folder = Env.PIPELINES_REPO_PATH
-        files = os.listdir(source_folder)
-        for file in files:
-            self.copy_file(source_folder, destination_folder, file)
 
         # We also need to copy the build utils into the pipelines repo
         shutil.copytree(
@@ -192,6 +221,9 @@ class TsdatPipelineBuild:
         if proc.returncode != 0:
             raise Exception(f"Failed to run docker build: {proc.stderr}")
 
+        # Show the script output (e.g., the image size report for the base image)
+        print(proc.stdout)
+
     def deploy_lambda(self, pipeline_config: PipelineConfig):
         pipeline_name = pipeline_config.name
         print(
@@ -200,17 +232,227 @@ class TsdatPipelineBuild:
         run_config: RunConfig
 
         # We are creating lambdas for each config so that we can properly pass
-        # relevant environment variables and control the S3 triggers
-        for config_id, run_config in pipeline_config.configs.items():
-            # TODO: we probably also want to add alarms for each lambda.
+        # relevant environment variables and control the S3 triggers.  Consolidated
+        # pipelines have one lambda that finds the config for each event.
+        run_configs: List[Optional[RunConfig]] = (
+            [None]
+            if pipeline_config.consolidated
+            else list(pipeline_config.configs.values())
+        )
+        for run_config in run_configs:
+            # The lambda's environment pins the task definitions of the configs it
+            # starts container tasks for, so register them first
+            for task_config in self.get_container_configs(pipeline_config, run_config):
+                self.register_task_definition(pipeline_config, task_config)
+
             f = self.get_lambda(pipeline_config, run_config)
             if not f:
                 self.create_lambda(pipeline_config, run_config)
             else:
                 self.update_lambda(pipeline_config, run_config)
 
-    def get_lambda(
+            if pipeline_config.rollout.versioned:
+                self.roll_out_version(pipeline_config, run_config)
+
+    def deploy_monitoring(self, pipeline_config: PipelineConfig):
+        """
+        Create or update the pipeline's CloudWatch dashboard and the alarms on each of
+        its lambdas (see build_utils.monitoring), and delete the alarms of lambdas
+        the pipeline no longer has.  The alarms notify the stack's alarm topic.
+
+        """
+        monitoring = pipeline_config.monitoring
+        prefix = self.config.get_alarm_prefix(pipeline_config.name)
+        dashboard_name = self.config.get_dashboard_name(pipeline_config.name)
+        if not monitoring.enabled:
+            self.delete_alarms(prefix, keep=[])
+            response = self.cloudwatch_client.list_dashboards(
+                DashboardNamePrefix=dashboard_name
+            )
+            if any(
+                entry["DashboardName"] == dashboard_name
+                for entry in response["DashboardEntries"]
+            ):
+                self.cloudwatch_client.delete_dashboards(
+                    DashboardNames=[dashboard_name]
+                )
+            return
+
+        # One lambda per config, or one for all of a consolidated pipeline's configs
+        labels: Dict[str, Optional[RunConfig]] = (
+            {"all": None}
+            if pipeline_config.consolidated
+            else dict(pipeline_config.configs)
+        )
+        actions = [Env.ALARM_TOPIC_ARN] if Env.ALARM_TOPIC_ARN else []
+        functions: Dict[str, str] = {}
+        timeouts: Dict[str, int] = {}
+        alarms: List[dict] = []
+        for label, run_config in labels.items():
+            function_name = self.get_function_name(pipeline_config, run_config)
+            response = self.lambda_client.get_function_configuration(
+                FunctionName=function_name
+            )
+            functions[label] = function_name
+            timeouts[function_name] = response["Timeout"]
+            alarms.extend(
+                get_alarms(
+                    prefix,
+                    label,
+                    function_name,
+                    response["Timeout"],
+                    monitoring,
+                    actions,
+                )
+            )
+
+        for alarm in alarms:
+            self.cloudwatch_client.put_metric_alarm(**alarm)
+        names = [alarm["AlarmName"] for alarm in alarms]
+        self.delete_alarms(prefix, keep=names)
+
+        alarm_arns = [
+            f"arn:aws:cloudwatch:{self.config.region}:{self.config.account_id}:alarm:{name}"
+            for name in names
+        ]
+        self.cloudwatch_client.put_dashboard(
+            DashboardName=dashboard_name,
+            DashboardBody=get_dashboard_body(
+                pipeline_config.name,
+                self.config.region,
+                functions,
+                timeouts,
+                alarm_arns,
+            ),
+        )
+        print(
+            f"Updated dashboard '{dashboard_name}' and {len(alarms)} alarms for"
+            f" pipeline {pipeline_config.name}"
+        )
+
+    def delete_alarms(self, prefix: str, keep: List[str]):
+        """Delete the alarms whose names start with prefix, except those in keep."""
+        stale = []
+        paginator = self.cloudwatch_client.get_paginator("describe_alarms")
+        for page in paginator.paginate(AlarmNamePrefix=prefix):
+            for alarm in page["MetricAlarms"]:
+                if alarm["AlarmName"] not in keep:
+                    stale.append(alarm["AlarmName"])
+
+        # At most 100 alarms can be deleted per call
+        for i in range(0, len(stale), 100):
+            print(f"Deleting alarms {stale[i : i + 100]}")
+            self.cloudwatch_client.delete_alarms(AlarmNames=stale[i : i + 100])
+
+    def get_container_configs(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ) -> List[RunConfig]:
+        """The configs with the container backend that the lambda starts tasks for
+        (run_config is None for the lambda of a consolidated pipeline)."""
+        run_configs = (
+            [run_config] if run_config else list(pipeline_config.configs.values())
+        )
+        return [rc for rc in run_configs if rc.backend == Backend.Container]
+
+    def register_task_definition(
         self, pipeline_config: PipelineConfig, run_config: RunConfig
+    ) -> str:
+        """
+        Register a new revision of the Fargate task definition that runs the config
+        (container backend) with the pipeline's current image.
+
+        Returns:
+            str: the task definition (family:revision)
+
+        """
+        if not Env.CONTAINER_CLUSTER_ARN:
+            raise Exception(
+                f"Config {pipeline_config.name} {run_config.id} has the container"
+                " backend, but the stack has no container cluster.  Redeploy the stack"
+                " (cdk deploy) after adding the first container config."
+            )
+
+        family = self.config.get_task_family(pipeline_config.name, run_config.id)
+        container = run_config.container
+        env = {
+            **self._get_run_env(pipeline_config, run_config),
+            # The task always runs one config, even for consolidated pipelines
+            "CONFIG_ID": run_config.id,
+            # Debounced re-runs requested by the task go through its lambda
+            "TRIGGER_ARN": self.get_trigger_arn(pipeline_config, run_config),
+            **container.get_env_vars(),
+        }
+        response = self.ecs_client.register_task_definition(
+            family=family,
+            # Tasks get the same access as the lambdas
+            taskRoleArn=Env.LAMBDA_ROLE_ARN,
+            executionRoleArn=Env.CONTAINER_EXECUTION_ROLE_ARN,
+            networkMode="awsvpc",
+            requiresCompatibilities=["FARGATE"],
+            runtimePlatform={
+                "cpuArchitecture": "X86_64",
+                "operatingSystemFamily": "LINUX",
+            },
+            cpu=str(container.cpu_units),
+            memory=str(container.memory_mb),
+            ephemeralStorage={"sizeInGiB": container.ephemeral_storage_gb},
+            containerDefinitions=[
+                {
+                    "name": CONTAINER_NAME,
+                    # Pinned by digest, so an older revision keeps its image
+                    "image": self.get_image_digest_uri(pipeline_config.name),
+                    "essential": True,
+                    # Run the handler once on the task's event instead of the lambda
+                    # runtime interface client
+                    "entryPoint": ["python3.12"],
+                    "command": ["task_runner.py"],
+                    "workingDirectory": "/var/task",
+                    "environment": [
+                        {"name": name, "value": value}
+                        for name, value in sorted(env.items())
+                    ],
+                    "logConfiguration": {
+                        "logDriver": "awslogs",
+                        "options": {
+                            "awslogs-group": Env.CONTAINER_LOG_GROUP,
+                            "awslogs-region": self.config.region,
+                            "awslogs-stream-prefix": family,
+                        },
+                    },
+                }
+            ],
+        )
+        revision = response["taskDefinition"]["revision"]
+        print(f"Registered task definition {family}:{revision}")
+        return f"{family}:{revision}"
+
+    def get_task_definition(
+        self, pipeline_config: PipelineConfig, run_config: RunConfig
+    ) -> str:
+        """The latest revision (family:revision) of the config's task definition."""
+        family = self.config.get_task_family(pipeline_config.name, run_config.id)
+        response = self.ecs_client.describe_task_definition(taskDefinition=family)
+        return f"{family}:{response['taskDefinition']['revision']}"
+
+    def get_image_digest_uri(self, pipeline_name: str) -> str:
+        response = self.ecr_client.describe_images(
+            repositoryName=self.config.ecr_repo_name,
+            imageIds=[{"imageTag": self.config.get_image_tag(pipeline_name)}],
+        )
+        digest = response["imageDetails"][0]["imageDigest"]
+        return f"{self.config.ecr_repo}@{digest}"
+
+    def get_function_name(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ) -> str:
+        """The name of the lambda that runs the config (run_config is None for the
+        lambda of a consolidated pipeline)."""
+        return self.config.get_function_name(
+            pipeline_config.name, run_config.id if run_config else None
+        )
+
+    def get_lambda(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
     ) -> Optional[dict]:
         """
         Gets data about a Lambda function.
@@ -220,9 +462,7 @@ class TsdatPipelineBuild:
         data = None
         try:
             data = self.lambda_client.get_function(
-                FunctionName=self.config.get_lambda_name(
-                    pipeline_config.name, run_config.id
-                )
+                FunctionName=self.get_function_name(pipeline_config, run_config)
             )
         except self.lambda_client.exceptions.ResourceNotFoundException:
             # This means the lambda does not exist.
@@ -240,13 +480,15 @@ class TsdatPipelineBuild:
                 tags.append(tag)
         return tags
 
-    def create_lambda(self, pipeline_config: PipelineConfig, run_config: RunConfig):
+    def create_lambda(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ):
         """
         Creates a new Lambda function.
 
         """
         image_uri = self.config.get_image_uri(pipeline_config.name)
-        lambda_name = self.config.get_lambda_name(pipeline_config.name, run_config.id)
+        lambda_name = self.get_function_name(pipeline_config, run_config)
 
         # This will raise an exception if something goes wrong
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/lambda/client/create_function.html
@@ -270,12 +512,14 @@ class TsdatPipelineBuild:
             f" {lambda_arn}"
         )
 
-    def update_lambda(self, pipeline_config: PipelineConfig, run_config: RunConfig):
+    def update_lambda(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ):
         """
         Update the lambda's environment variables with new build number
         (The only thing we need to change are the environment variables.)
         """
-        lambda_name = self.config.get_lambda_name(pipeline_config.name, run_config.id)
+        lambda_name = self.get_function_name(pipeline_config, run_config)
         response = self.lambda_client.update_function_configuration(
             FunctionName=lambda_name,
             Environment=self._get_lambda_env(pipeline_config, run_config),
@@ -298,24 +542,222 @@ class TsdatPipelineBuild:
             f" {response['FunctionArn']}"
         )
 
-    def _get_lambda_env(self, pipeline_config: PipelineConfig, run_config: RunConfig):
+    def roll_out_version(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ):
+        """
+        Publish the lambda's new code and configuration as a version, warm it up, and
+        then point the rollout alias (which the triggers invoke) at it.  The alias
+        description records the version it pointed at before, for rollback_lambda.
+
+        If the warm-up fails, an exception is raised and the alias stays on the
+        current version.
+        """
+        rollout = pipeline_config.rollout
+        lambda_name = self.get_function_name(pipeline_config, run_config)
+
+        # The code update has to finish before it can be published
+        waiter = self.lambda_client.get_waiter("function_updated")
+        waiter.wait(FunctionName=lambda_name)
+        response = self.lambda_client.publish_version(
+            FunctionName=lambda_name, Description=Env.CODE_VERSION
+        )
+        version = response["Version"]
+        waiter = self.lambda_client.get_waiter("published_version_active")
+        waiter.wait(FunctionName=lambda_name, Qualifier=version)
+        print(f"Published version {version} of lambda function '{lambda_name}'")
+
+        previous = self.get_alias_version(lambda_name, rollout.alias)
+        if previous == version:
+            print(f"Alias '{rollout.alias}' already points at version {version}")
+            return
+
+        self.warm_up_version(lambda_name, version, rollout.warmup_invocations)
+        self.set_alias(lambda_name, rollout.alias, version, previous)
+        self.delete_old_versions(
+            lambda_name, rollout.keep_versions, keep=[version, previous]
+        )
+
+    def warm_up_version(self, lambda_name: str, version: str, invocations: int):
+        """
+        Invoke the version concurrently with warm-up events, so that many execution
+        environments have pulled the image, done their imports and instantiated the
+        pipeline before live events are sent to it.
+
+        Raises:
+            Exception: If any of the warm-up invocations fail.
+        """
+        if invocations < 1:
+            print(f"Skipping the warm-up of version {version} (warmup_invocations: 0)")
+            return
+
+        # A cold start of a large image can take longer than the default read
+        # timeout, and a retried invoke would only start another environment
+        lambda_client = boto3.client(
+            "lambda",
+            region_name=self.config.region,
+            config=Config(read_timeout=900, retries={"total_max_attempts": 1}),
+        )
+        payload = json.dumps({WARMUP_EVENT_KEY: True})
+
+        def invoke(_) -> Optional[str]:
+            response = lambda_client.invoke(
+                FunctionName=lambda_name, Qualifier=version, Payload=payload
+            )
+            result = response["Payload"].read().decode()
+            # The handler returns true if it failed
+            if response.get("FunctionError") or json.loads(result or "null"):
+                return result
+            return None
+
+        print(f"Warming up version {version} with {invocations} invocations...")
+        with ThreadPoolExecutor(max_workers=invocations) as executor:
+            errors = [e for e in executor.map(invoke, range(invocations)) if e]
+        if errors:
+            raise Exception(
+                f"Warm-up of '{lambda_name}' version {version} failed"
+                f" ({len(errors)} of {invocations} invocations): {errors[0]}"
+            )
+
+    def get_alias_version(self, lambda_name: str, alias: str) -> Optional[str]:
+        try:
+            response = self.lambda_client.get_alias(
+                FunctionName=lambda_name, Name=alias
+            )
+            return response["FunctionVersion"]
+        except self.lambda_client.exceptions.ResourceNotFoundException:
+            return None
+
+    def set_alias(
+        self, lambda_name: str, alias: str, version: str, previous: Optional[str]
+    ):
+        description = f"previous={previous or ''}"
+        if previous is None:
+            self.lambda_client.create_alias(
+                FunctionName=lambda_name,
+                Name=alias,
+                FunctionVersion=version,
+                Description=description,
+            )
+        else:
+            self.lambda_client.update_alias(
+                FunctionName=lambda_name,
+                Name=alias,
+                FunctionVersion=version,
+                Description=description,
+            )
+        print(
+            f"Alias '{alias}' of lambda function '{lambda_name}' moved from version"
+            f" {previous} to {version}"
+        )
+
+    def delete_old_versions(self, lambda_name: str, keep_versions: int, keep: list):
+        """Delete all but the newest `keep_versions` published versions, except the
+        versions in `keep`."""
+        versions = []
+        paginator = self.lambda_client.get_paginator("list_versions_by_function")
+        for page in paginator.paginate(FunctionName=lambda_name):
+            for function in page["Versions"]:
+                if function["Version"] != "$LATEST":
+                    versions.append(int(function["Version"]))
+
+        for version in sorted(versions, reverse=True)[keep_versions:]:
+            if str(version) not in keep:
+                print(f"Deleting version {version} of lambda function '{lambda_name}'")
+                self.lambda_client.delete_function(
+                    FunctionName=lambda_name, Qualifier=str(version)
+                )
+
+    def rollback_lambda(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ):
+        """
+        Point the rollout alias back at the version it pointed at before the last
+        deploy.  Rolling back twice undoes the rollback.
+        """
+        alias = pipeline_config.rollout.alias
+        lambda_name = self.get_function_name(pipeline_config, run_config)
+        response = self.lambda_client.get_alias(FunctionName=lambda_name, Name=alias)
+        previous = response.get("Description", "").partition("previous=")[2]
+        if not previous:
+            raise Exception(
+                f"Alias '{alias}' of lambda function '{lambda_name}' has no previous"
+                " version to roll back to"
+            )
+        self.set_alias(lambda_name, alias, previous, response["FunctionVersion"])
+
+    def get_trigger_arn(self, pipeline_config: PipelineConfig, run_config: RunConfig):
+        """The ARN the triggers invoke:  the rollout alias if the pipeline is
+        versioned, otherwise the function itself ($LATEST)."""
+        if pipeline_config.rollout.versioned:
+            return self.config.get_lambda_alias_arn(
+                pipeline_config.name, run_config.id, pipeline_config.rollout.alias
+            )
+        return self.config.get_lambda_arn(pipeline_config.name, run_config.id)
+
+    def _get_lambda_env(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ):
         return {
             "Variables": {
-                "PIPELINE_NAME": pipeline_config.name,
-                "CONFIG_ID": run_config.id,
-                "RETAIN_INPUT_FILES": "true",
-                "CODE_VERSION": Env.CODE_VERSION,
-                "TSDAT_S3_BUCKET_NAME": self.config.output_bucket_name,
-                "BRANCH": Env.BRANCH,
+                **self._get_run_env(pipeline_config, run_config),
+                **self._get_task_env(pipeline_config, run_config),
             }
         }
 
+    def _get_run_env(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ) -> Dict[str, str]:
+        # Shared by the lambdas and the container tasks
+        config_id = run_config.id if run_config else None
+        return {
+            "PIPELINE_NAME": pipeline_config.name,
+            # Empty for consolidated pipelines:  the config is found per event
+            "CONFIG_ID": config_id or "",
+            "RETAIN_INPUT_FILES": "true",
+            "CODE_VERSION": Env.CODE_VERSION,
+            "TSDAT_S3_BUCKET_NAME": self.config.output_bucket_name,
+            "BRANCH": Env.BRANCH,
+            **(
+                {"TSDAT_DEBOUNCE_ROLE_ARN": Env.SCHEDULER_ROLE_ARN}
+                if Env.SCHEDULER_ROLE_ARN
+                else {}
+            ),
+            # Single-flight leases in the output bucket (see build_utils.lease)
+            "TSDAT_LEASE_BACKEND": "s3" if pipeline_config.single_flight else "",
+            "TSDAT_LEASE_TTL_S": str(pipeline_config.lease_ttl_seconds),
+            # Input fingerprints in the output bucket (see build_utils.fingerprint)
+            "TSDAT_FINGERPRINTS": str(pipeline_config.input_fingerprints).lower(),
+            # Profiling is switched on per config from the pipeline's config
+            **pipeline_config.profiling.get_env_vars(config_id),
+            **pipeline_config.memory.get_env_vars(),
+            **pipeline_config.logging.get_env_vars(),
+            **pipeline_config.scratch.get_env_vars(),
+        }
+
+    def _get_task_env(
+        self, pipeline_config: PipelineConfig, run_config: Optional[RunConfig]
+    ) -> Dict[str, str]:
+        # Read by build_utils.containers.run_task() in lambdas that start tasks
+        tasks = {
+            task_config.id: self.get_task_definition(pipeline_config, task_config)
+            for task_config in self.get_container_configs(pipeline_config, run_config)
+        }
+        if not tasks:
+            return {}
+        return {
+            "CONTAINER_TASKS": json.dumps(tasks),
+            "CONTAINER_CLUSTER": Env.CONTAINER_CLUSTER_ARN,
+            "CONTAINER_SUBNETS": Env.CONTAINER_SUBNET_IDS,
+            "CONTAINER_SECURITY_GROUP": Env.CONTAINER_SECURITY_GROUP_ID,
+        }
+
     def s3_policy_exists(self, pipeline_config: PipelineConfig, run_config: RunConfig):
         statement_id = self.config.get_bucket_trigger_statement_id(
             pipeline_config.name, run_config.id
         )
         try:
-            lambda_arn = self.config.get_lambda_arn(pipeline_config.name, run_config.id)
+            lambda_arn = self.get_trigger_arn(pipeline_config, run_config)
             policy = self.lambda_client.get_policy(FunctionName=lambda_arn)
             return statement_id in policy["Policy"]
         except Exception:
@@ -337,15 +779,17 @@ class TsdatPipelineBuild:
         the respective lambdas depending upon the path.
 
         """
+        if self.config.s3_routing == S3Routing.EventBridge:
+            self.add_or_update_s3_rules()
+            return
+
         bucket_name = self.config.input_bucket_name
         notification_configuration = {"LambdaFunctionConfigurations": []}
         print(f"Setting up S3 lambda triggers for bucket {bucket_name}.")
 
         for pipeline_config in self.config.pipelines.values():
             for run_config in pipeline_config.configs.values():
-                lambda_arn = self.config.get_lambda_arn(
-                    pipeline_config.name, run_config.id
-                )
+                lambda_arn = self.get_trigger_arn(pipeline_config, run_config)
 
                 # Add the S3 event trigger
                 if pipeline_config.trigger == Trigger.S3:
@@ -376,6 +820,13 @@ class TsdatPipelineBuild:
 
                     subpath: str = run_config.input_bucket_path
                     subpath = f"{subpath}/" if not subpath.endswith("/") else subpath
+                    filter_rules = [{"Name": "prefix", "Value": subpath}]
+                    if len(run_config.input_suffixes) == 1:
+                        # Notifications only take one suffix; with several (or a
+                        # regex) the lambda skips the keys that don't match
+                        filter_rules.append(
+                            {"Name": "suffix", "Value": run_config.input_suffixes[0]}
+                        )
                     notification_configuration["LambdaFunctionConfigurations"].append(
                         {
                             "Id": self.config.get_bucket_notification_id(
@@ -383,13 +834,7 @@ class TsdatPipelineBuild:
                             ),
                             "LambdaFunctionArn": lambda_arn,
                             "Events": ["s3:ObjectCreated:*"],
-                            "Filter": {
-                                "Key": {
-                                    "FilterRules": [
-                                        {"Name": "prefix", "Value": subpath},
-                                    ]
-                                }
-                            },
+                            "Filter": {"Key": {"FilterRules": filter_rules}},
                         },
                     )
 
@@ -407,21 +852,169 @@ class TsdatPipelineBuild:
         )
         print(f"S3 event trigger set up for bucket {self.config.input_bucket_arn}")
 
+        # Disable the EventBridge rules in case we switched from EventBridge routing
+        for pipeline_config in self.config.pipelines.values():
+            for run_config in pipeline_config.configs.values():
+                self.disable_rule(
+                    self.config.get_s3_rule_name(pipeline_config.name, run_config.id)
+                )
+
+    def add_or_update_s3_rules(self):
+        """
+        Route the input bucket's events to the S3 triggered lambdas with one
+        EventBridge rule per config.  Unlike the bucket notification configuration,
+        each rule is updated on its own (so a deploy doesn't touch the routing of
+        the other pipelines), prefixes may overlap (a key can fan out to several
+        configs), and a config can filter on several suffixes.
+
+        """
+        bucket_name = self.config.input_bucket_name
+        self.enable_bucket_event_bridge(bucket_name)
+
+        for pipeline_config in self.config.pipelines.values():
+            for run_config in pipeline_config.configs.values():
+                lambda_arn = self.get_trigger_arn(pipeline_config, run_config)
+                rule_name = self.config.get_s3_rule_name(
+                    pipeline_config.name, run_config.id
+                )
+
+                if pipeline_config.trigger != Trigger.S3:
+                    # Disable the rule in case we switched from an S3 trigger
+                    self.disable_rule(rule_name)
+                    continue
+
+                subpath: str = run_config.input_bucket_path
+                subpath = f"{subpath}/" if not subpath.endswith("/") else subpath
+                key_filters = (
+                    [{"wildcard": f"{subpath}*{s}"} for s in run_config.input_suffixes]
+                    if run_config.input_suffixes
+                    else [{"prefix": subpath}]
+                )
+                event_pattern = {
+                    "source": ["aws.s3"],
+                    "detail-type": ["Object Created"],
+                    "detail": {
+                        "bucket": {"name": [bucket_name]},
+                        "object": {"key": key_filters},
+                    },
+                }
+                print(f"Updating S3 rule for {lambda_arn} {event_pattern}")
+                response = self.events_client.put_rule(
+                    Name=rule_name,
+                    EventPattern=json.dumps(event_pattern),
+                    State="ENABLED",
+                )
+                rule_arn = response["RuleArn"]
+                self.events_client.put_targets(
+                    Rule=rule_name,
+                    Targets=[self.get_s3_event_target(lambda_arn, run_config)],
+                )
+
+                # Now add permission for our lambda to be triggered by the rule
+                statement_id = self.config.get_s3_rule_trigger_statement_id(
+                    pipeline_config.name, run_config.id
+                )
+                try:
+                    self.lambda_client.add_permission(
+                        FunctionName=lambda_arn,
+                        StatementId=statement_id,
+                        Action="lambda:InvokeFunction",
+                        Principal="events.amazonaws.com",
+                        SourceArn=rule_arn,
+                    )
+                except self.lambda_client.exceptions.ResourceConflictException:
+                    # This means the permission already exists
+                    pass
+
+                # Make sure the bucket folder exists (so we can see it in the UI)
+                if not self.s3_folder_exists(bucket_name, subpath):
+                    self.s3_client.put_object(Bucket=bucket_name, Key=(subpath))
+
+                print(
+                    f"S3 trigger rule set up for pipeline {pipeline_config.name}, run"
+                    f" {run_config.id}.  Rule arn = {rule_arn}"
+                )
+
+        # Now that the rules are in place, stop the bucket notifications they replace
+        # (events in between may be delivered twice; single_flight pipelines absorb that)
+        self.remove_bucket_notifications(bucket_name)
+
+    def remove_bucket_notifications(self, bucket_name: str):
+        """Remove the lambda notifications that add_or_update_s3_triggers created,
+        keeping the rest of the bucket's notification configuration."""
+        notification_configuration = (
+            self.s3_client.get_bucket_notification_configuration(Bucket=bucket_name)
+        )
+        notification_configuration.pop("ResponseMetadata", None)
+        ids = {
+            self.config.get_bucket_notification_id(pipeline_config.name, run_id)
+            for pipeline_config in self.config.pipelines.values()
+            for run_id in pipeline_config.configs
+        }
+        functions = notification_configuration.get("LambdaFunctionConfigurations", [])
+        keep = [function for function in functions if function.get("Id") not in ids]
+        if len(keep) == len(functions):
+            return
+
+        notification_configuration["LambdaFunctionConfigurations"] = keep
+        self.s3_client.put_bucket_notification_configuration(
+            Bucket=bucket_name,
+            NotificationConfiguration=notification_configuration,
+        )
+        print(f"Removed {len(functions) - len(keep)} notifications from {bucket_name}")
+
+    def get_s3_event_target(self, lambda_arn: str, run_config: RunConfig) -> dict:
+        """The target of a rule for S3 events delivered by EventBridge.  The config id
+        is added to the event, since the same key can trigger several configs of a
+        consolidated pipeline."""
+        return {
+            "Id": "1",
+            "Arn": lambda_arn,
+            "InputTransformer": {
+                "InputPathsMap": {
+                    "bucket": "$.detail.bucket.name",
+                    "key": "$.detail.object.key",
+                    "size": "$.detail.object.size",
+                },
+                "InputTemplate": json.dumps(
+                    {
+                        "source": "aws.s3",
+                        "detail-type": "Object Created",
+                        "config_id": run_config.id,
+                        "detail": {
+                            "bucket": {"name": "<bucket>"},
+                            "object": {"key": "<key>", "size": "<size>"},
+                        },
+                    }
+                    # The size is a number, so its placeholder isn't quoted
+                ).replace('"<size>"', "<size>"),
+            },
+        }
+
+    def disable_rule(self, rule_name: str):
+        try:
+            self.events_client.disable_rule(Name=rule_name)
+        except self.events_client.exceptions.ResourceNotFoundException:
+            pass
+
     def add_or_update_cron_schedules(self):
         """Update the cron rules for to trigger the lambda function for the
         given pipeline and config.
 
         """
+        # Cron rules are spread over offsets within their period so the pipelines
+        # don't all start at once.  The runs still process their scheduled window.
+        offsets = plan_cron_offsets(self.config)
         for pipeline_config in self.config.pipelines.values():
             for run_config in pipeline_config.configs.values():
-                lambda_arn = self.config.get_lambda_arn(
-                    pipeline_config.name, run_config.id
-                )
+                lambda_arn = self.get_trigger_arn(pipeline_config, run_config)
 
                 # TODO: if lambda function doesn't exist, then continue
 
-                # Should we give user control to specify exact cron expression?
-                cron_expression = pipeline_config.cron_expression
+                cron_expression = shift_cron_expression(
+                    pipeline_config.cron_expression,
+                    offsets.get((pipeline_config.name, run_config.id), 0),
+                )
 
                 # Create an eventbridge event rule
                 rule_name = self.config.get_cron_rule_name(
@@ -450,6 +1043,8 @@ class TsdatPipelineBuild:
                         {
                             "Id": "1",
                             "Arn": lambda_arn,
+                            # Tells a consolidated pipeline's lambda which config to run
+                            "Input": json.dumps({"config_id": run_config.id}),
                         }
                     ],
                 )
@@ -476,16 +1071,115 @@ class TsdatPipelineBuild:
                     f" {rule_arn}"
                 )
 
-    def build(self):
-        print(f"Building CodeBuild pipeline: {Env.AWS_PIPELINE_NAME}")
+    def enable_bucket_event_bridge(self, bucket_name: str):
+        """Turn on EventBridge notifications for the bucket, keeping any other
+        notification configuration it has."""
+        notification_configuration = (
+            self.s3_client.get_bucket_notification_configuration(Bucket=bucket_name)
+        )
+        notification_configuration.pop("ResponseMetadata", None)
+        if "EventBridgeConfiguration" in notification_configuration:
+            return
 
-        # Step 1:  Build the base image.
-        # All the pipelines from the same repo share the same base image
-        print("Building base image...")
-        self.build_base_image()
+        notification_configuration["EventBridgeConfiguration"] = {}
+        self.s3_client.put_bucket_notification_configuration(
+            Bucket=bucket_name,
+            NotificationConfiguration=notification_configuration,
+        )
+        print(f"EventBridge notifications enabled for bucket {bucket_name}")
 
-        # Step 2: Build the pipeline images.
+    def add_or_update_upstream_triggers(self):
+        """Update the EventBridge rules that trigger the lambda function when new
+        output is written to one of the run config's upstream_bucket_paths.
+
+        S3 only allows one notification per prefix, and an upstream datastream may
+        feed several pipelines, so output bucket events are routed through
+        EventBridge instead of bucket notifications.  The lambda then debounces the
+        events (see build_utils.debounce).
+
+        """
+        bucket_name = self.config.output_bucket_name
+        if any(
+            pipeline_config.trigger == Trigger.Upstream
+            for pipeline_config in self.config.pipelines.values()
+        ):
+            self.enable_bucket_event_bridge(bucket_name)
+
+        for pipeline_config in self.config.pipelines.values():
+            for run_config in pipeline_config.configs.values():
+                lambda_arn = self.get_trigger_arn(pipeline_config, run_config)
+                rule_name = self.config.get_upstream_rule_name(
+                    pipeline_config.name, run_config.id
+                )
+
+                if pipeline_config.trigger != Trigger.Upstream:
+                    # Disable the rule in case we switched from an Upstream trigger
+                    self.disable_rule(rule_name)
+                    continue
+
+                if not run_config.upstream_bucket_paths:
+                    raise ValueError(
+                        f"Pipeline {pipeline_config.name}, run {run_config.id} uses an"
+                        " Upstream trigger but has no upstream_bucket_paths"
+                    )
+
+                event_pattern = {
+                    "source": ["aws.s3"],
+                    "detail-type": ["Object Created"],
+                    "detail": {
+                        "bucket": {"name": [bucket_name]},
+                        "object": {
+                            "key": [
+                                {"prefix": path}
+                                for path in run_config.upstream_bucket_paths
+                            ]
+                        },
+                    },
+                }
+                print(f"Updating upstream rule for {lambda_arn} {event_pattern}")
+                response = self.events_client.put_rule(
+                    Name=rule_name,
+                    EventPattern=json.dumps(event_pattern),
+                    State="ENABLED",
+                )
+                rule_arn = response["RuleArn"]
 
+                self.events_client.put_targets(
+                    Rule=rule_name,
+                    Targets=[self.get_s3_event_target(lambda_arn, run_config)],
+                )
+
+                # Now add permission for our lambda to be triggered by the rule
+                statement_id = self.config.get_upstream_trigger_statement_id(
+                    pipeline_config.name, run_config.id
+                )
+                try:
+                    self.lambda_client.add_permission(
+                        FunctionName=lambda_arn,
+                        StatementId=statement_id,
+                        Action="lambda:InvokeFunction",
+                        Principal="events.amazonaws.com",
+                        SourceArn=rule_arn,
+                    )
+                except self.lambda_client.exceptions.ResourceConflictException:
+                    # This means the permission already exists
+                    pass
+
+                print(
+                    f"Upstream trigger rule set up for pipeline {pipeline_config.name},"
+                    f" run {run_config.id}.  Debounce is"
+                    f" {pipeline_config.debounce_minutes} minutes.  Rule arn ="
+                    f" {rule_arn}"
+                )
+
+    def get_tsdat_pipelines_to_build(self) -> List[str]:
+        """
+        Find the tsdat pipelines that need to be built for this build trigger.
+
+        Returns:
+            List[str]: names of the tsdat pipelines to build
+
+        """
         # Get the trigger, one of two types: "StartPipelineExecution" or "Webhook"
         trigger = Env.TRIGGER
         print(f"Build trigger is {trigger}")
@@ -514,20 +1208,114 @@ class TsdatPipelineBuild:
                 ):
                     tsdat_pipelines_to_build.append(pipeline_config.name)
 
-        for tsdat_pipeline_name in tsdat_pipelines_to_build:
-            print(f"Building Tsdat pipeline: {tsdat_pipeline_name}")
-            pipeline_config: PipelineConfig = self.config.pipelines.get(
-                tsdat_pipeline_name
-            )
-            # If the config is null, then this pipeline isn't in the pipelines_config.yml
-            # yet, so we won't build it.  TODO: send alert msg when this happens
-            if pipeline_config:
-                self.build_pipeline_docker_image(tsdat_pipeline_name)
-                self.deploy_lambda(pipeline_config)
+        return tsdat_pipelines_to_build
+
+    def build_tsdat_pipeline(self, tsdat_pipeline_name: str):
+        """
+        Build the image for the given tsdat pipeline and deploy its lambdas.
+
+        Args:
+            tsdat_pipeline_name (str): name of the tsdat pipeline to build
 
+        """
+        print(f"Building Tsdat pipeline: {tsdat_pipeline_name}")
+        pipeline_config: PipelineConfig = self.config.pipelines.get(tsdat_pipeline_name)
+        # If the config is null, then this pipeline isn't in the pipelines_config.yml
+        # yet, so we won't build it.  TODO: send alert msg when this happens
+        if pipeline_config:
+            self.build_pipeline_docker_image(tsdat_pipeline_name)
+            self.deploy_lambda(pipeline_config)
+            self.deploy_monitoring(pipeline_config)
+
+    def update_triggers(self):
         # If the pipeline is an S3 trigger, we have to set the notification policy all
         # in one big block
         self.add_or_update_s3_triggers()
 
         # Update cron triggers for all pipelines (will disable if not used)
         self.add_or_update_cron_schedules()
+
+        # Update upstream datastream triggers (will disable if not used).  This runs
+        # after the S3 triggers, which replace the input bucket's notification config.
+        self.add_or_update_upstream_triggers()
+
+    def rollback(self):
+        """
+        Roll the versioned pipelines listed in PIPELINES_TO_BUILD (all of them if it
+        is empty) back to the version they ran before their last deploy.
+
+        """
+        names = [name for name in Env.PIPELINES_TO_BUILD.split(",") if name]
+        for pipeline_config in self.config.pipelines.values():
+            if names and pipeline_config.name not in names:
+                continue
+            if not pipeline_config.rollout.versioned:
+                print(f"Pipeline {pipeline_config.name} is not versioned, skipping")
+                continue
+            if pipeline_config.consolidated:
+                self.rollback_lambda(pipeline_config, None)
+                continue
+            for run_config in pipeline_config.configs.values():
+                self.rollback_lambda(pipeline_config, run_config)
+
+    def build_base(self):
+        """
+        First step of a batch build:  build the base image and write the list of
+        pipelines to build so that buildspec.yml can export it to the build shards.
+
+        """
+        print("Building base image...")
+        self.build_base_image()
+
+        tsdat_pipelines_to_build = self.get_tsdat_pipelines_to_build()
+        print(f"Pipelines to build = {tsdat_pipelines_to_build}")
+        with open(PIPELINES_TO_BUILD_FILE, "w") as file:
+            file.write(",".join(tsdat_pipelines_to_build))
+
+    def build_shard(self):
+        """
+        Second step of a batch build:  build and deploy this node's share of the
+        pipelines exported by the base step.  Pipelines are assigned round-robin so
+        every shard gets a similar number of images to build.
+
+        """
+        tsdat_pipelines_to_build = [
+            name for name in Env.PIPELINES_TO_BUILD.split(",") if name
+        ]
+        shard = tsdat_pipelines_to_build[Env.SHARD_INDEX :: Env.SHARD_COUNT]
+        print(f"Building shard {Env.SHARD_INDEX + 1} of {Env.SHARD_COUNT}: {shard}")
+
+        # The pipeline images are built from the base image in ECR, so we only need
+        # the Dockerfiles in the build context
+        self.copy_build_files()
+        for tsdat_pipeline_name in shard:
+            self.build_tsdat_pipeline(tsdat_pipeline_name)
+
+    def build(self):
+        step = Env.BUILD_STEP or BuildStep.All
+        print(f"Building CodeBuild pipeline: {Env.AWS_PIPELINE_NAME} (step: {step})")
+
+        if step == BuildStep.Base:
+            self.build_base()
+
+        elif step == BuildStep.Shard:
+            self.build_shard()
+
+        elif step == BuildStep.Triggers:
+            self.update_triggers()
+
+        elif step == BuildStep.Rollback:
+            self.rollback()
+
+        else:
+            # Step 1:  Build the base image.
+            # All the pipelines from the same repo share the same base image
+            print("Building base image...")
+            self.build_base_image()
+
+            # Step 2: Build the pipeline images.
+            for tsdat_pipeline_name in self.get_tsdat_pipelines_to_build():
+                self.build_tsdat_pipeline(tsdat_pipeline_name)
+
+            # Step 3: Update the triggers for all pipelines
+            self.update_triggers()
@@ -20,7 +20,30 @@ pipeline_name="$5"
 # First perform docker login into our ecr repository
 # aws ecr get-login-password --region $AWS_DEFAULT_REGION | docker login --username AWS --password-stdin  $AWS_ACCOUNT_ID
 
+report_script="$(cd "$(dirname "$0")" && pwd)/image_report.sh"
+
+# For the base image, keep the currently deployed image around so we can report how
+# the new image compares to it
+baseline_image_uri=""
+if [[ $dockerfile == "Dockerfile.base" ]] ; then
+    if docker pull -q $image_uri > /dev/null 2>&1 ; then
+        baseline_image_uri="${image_uri}-baseline"
+        docker tag $image_uri $baseline_image_uri
+    fi
+fi
+
 # Build the image and push to ECR
 cd ${context_folder}
-docker build --build-arg PIPELINE_NAME=$pipeline_name --build-arg BASE_IMAGE_NAME=$base_image_uri -t $image_uri -f $dockerfile .
-docker push $image_uri
+docker build --build-arg PIPELINE_NAME=$pipeline_name --build-arg BASE_IMAGE_NAME=$base_image_uri -t $image_uri -f $dockerfile . \
+    && docker push $image_uri
+status=$?
+
+# Print the size and import-time report for the base image
+if [[ $status -eq 0 && $dockerfile == "Dockerfile.base" ]] ; then
+    ${report_script} $image_uri $baseline_image_uri
+    if [[ -n $baseline_image_uri ]] ; then
+        docker rmi $baseline_image_uri > /dev/null 2>&1
+    fi
+fi
+
+exit $status
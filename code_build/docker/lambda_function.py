@@ -1,47 +1,207 @@
+import hashlib
 import logging
 import os
-import shutil
-import tempfile
+import re
+import time
+from contextlib import nullcontext
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
 import boto3
 
-from build_utils.logger import DelayedJSONStreamHandler, configure_logger
+from build_utils.logger import (
+    DelayedJSONStreamHandler,
+    configure_logger,
+    get_emf_metrics,
+)
 
 # Set up logging: note that this needs to be done before the PipelinesConfig import
 # because we want to remove
 logger = logging.getLogger(__name__)
 configure_logger(logger)
 
+from build_utils.catalog import get_catalog  # noqa: E402
 from build_utils.pipelines_config import PipelinesConfig  # noqa: E402
+from build_utils.schedules import format_window  # noqa: E402
+from build_utils.scratch import ScratchManager  # noqa: E402
 
-# Initialize global parameters
-TMP_DIR = tempfile.TemporaryDirectory()
-TMP_DIRPATH = Path(TMP_DIR.name)
+# Initialize global parameters.  Each invocation downloads into its own scratch
+# directory (created by lambda_handler), and those of earlier invocations are deleted
+# in the background.
+SCRATCH = ScratchManager.from_env()
+TMP_DIRPATH = SCRATCH.root
 
-# This is passed to the lambda configuration via the build
+# This is passed to the lambda configuration via the build.  CONFIG_ID is empty for
+# the lambda of a consolidated pipeline, which finds the config for each event.
 PIPELINE_NAME = os.environ["PIPELINE_NAME"]
-CONFIG_ID = os.environ["CONFIG_ID"]
+DEPLOYED_CONFIG_ID = os.environ.get("CONFIG_ID") or None
 PIPELINES_CONFIG_PATH = os.environ.get("PIPELINES_CONFIG_PATH", "pipelines_config.yml")
 
 PIPELINES_CONFIG = PipelinesConfig(config_file_path=PIPELINES_CONFIG_PATH)
 PIPELINE_CONFIG = PIPELINES_CONFIG.pipelines[PIPELINE_NAME]
-RUN_CONFIG = PIPELINE_CONFIG.configs[CONFIG_ID]
 S3_CLIENT = boto3.client("s3", region_name=PIPELINES_CONFIG.region)
 
+# The config the current invocation runs (see use_run_config)
+CONFIG_ID = DEPLOYED_CONFIG_ID or ""
+RUN_CONFIG = PIPELINE_CONFIG.configs[CONFIG_ID] if CONFIG_ID else None
 
-def get_input_files_from_event(event) -> List[str]:
-    input_files: List[str] = []
+# The tsdat pipeline of each config, instantiated once per execution environment
+# (see get_pipeline)
+PIPELINES: Dict[str, Any] = {}
 
-    for record in event["Records"]:
-        bucket_name = record["s3"]["bucket"]["name"]
-        bucket_path = record["s3"]["object"]["key"]
-        local_path = download_s3_file(bucket_name, bucket_path)
-        input_files.append(local_path)
+# Fingerprint of each config's code and configs (see get_code_fingerprint)
+CODE_FINGERPRINTS: Dict[str, str] = {}
 
-    return input_files
+
+def get_pipeline():
+    """
+    Get the tsdat pipeline for this run config.  Importing tsdat and instantiating the
+    pipeline is the slow part of a cold start, so the pipeline is kept for the later
+    invocations in the same execution environment (and created by warm-up events).
+    """
+    if RUN_CONFIG.id not in PIPELINES:
+        from tsdat.config.pipeline import PipelineConfig as TsdatPipelineConfig
+
+        tsdat_config = TsdatPipelineConfig.from_yaml(Path(RUN_CONFIG.config_file_path))
+        if PIPELINE_CONFIG.storage.classname:
+            # Override the classname that storage-extra.yaml built into the image
+            tsdat_config.storage.classname = PIPELINE_CONFIG.storage.classname
+        PIPELINES[RUN_CONFIG.id] = tsdat_config.instantiate_pipeline()
+    return PIPELINES[RUN_CONFIG.id]
+
+
+def get_config_id(event) -> str:
+    """
+    Get the id of the run config to run for the event.  The lambda of a consolidated
+    pipeline runs all of the pipeline's configs, so the config comes from the event:
+    the config id the build adds to cron and EventBridge events (and the debounce and
+    reprocess events include), or else the config whose input_bucket_path (or
+    upstream_bucket_paths) holds the S3 event's key.
+    """
+    from build_utils.constants import Trigger
+    from build_utils.debounce import is_upstream_event
+
+    if DEPLOYED_CONFIG_ID:
+        return DEPLOYED_CONFIG_ID
+
+    if isinstance(event, dict):
+        if event.get("config_id"):
+            return event["config_id"]
+
+        if event.get("Records") or is_upstream_event(event):
+            # Upstream triggered pipelines get output bucket events
+            key = get_event_objects(event)[0][1]
+            run_config = PIPELINE_CONFIG.find_run_config(
+                key, upstream=PIPELINE_CONFIG.trigger == Trigger.Upstream
+            )
+            if run_config is not None:
+                return run_config.id
+
+    raise ValueError(f"Could not find the config of pipeline {PIPELINE_NAME} to run")
+
+
+def use_run_config(config_id: Optional[str]):
+    """Set the config (CONFIG_ID and RUN_CONFIG) the invocation runs."""
+    global CONFIG_ID, RUN_CONFIG
+    CONFIG_ID = config_id or ""
+    RUN_CONFIG = PIPELINE_CONFIG.configs[config_id] if config_id else None
+
+
+def runs_in_task() -> bool:
+    """Check if the config runs in a container task that this lambda starts, rather
+    than in the lambda itself (container backend)."""
+    from build_utils.constants import Backend
+    from build_utils.containers import is_container_task
+
+    return RUN_CONFIG.backend == Backend.Container and not is_container_task()
+
+
+def start_task(event) -> Dict:
+    """Start the container task that runs the config on the event."""
+    from build_utils.containers import run_task
+
+    task_arn = run_task(event, CONFIG_ID, s3_client=S3_CLIENT)
+    logger.info(f"Started task {task_arn} for pipeline {PIPELINE_NAME} {CONFIG_ID}")
+    return {"task_arn": task_arn}
+
+
+def is_warmup_event(event) -> bool:
+    """Check if the event is a synthetic warm-up invocation sent by the build after
+    publishing a new function version."""
+    from build_utils.constants import WARMUP_EVENT_KEY
+
+    return isinstance(event, dict) and bool(event.get(WARMUP_EVENT_KEY))
+
+
+def get_event_objects(event) -> List[Tuple[str, str, Optional[int]]]:
+    """
+    Get the bucket, key and size (if the event has it) of each object in an S3 event,
+    either a bucket notification or an "Object Created" event delivered by EventBridge
+    (s3_routing: eventbridge).
+    """
+    if "Records" in event:
+        return [
+            (
+                record["s3"]["bucket"]["name"],
+                record["s3"]["object"]["key"],
+                record["s3"]["object"].get("size"),
+            )
+            for record in event["Records"]
+        ]
+    detail = event["detail"]
+    return [
+        (
+            detail["bucket"]["name"],
+            detail["object"]["key"],
+            detail["object"].get("size"),
+        )
+    ]
+
+
+def get_skip_reason(pipeline, key: str, size: Optional[int]) -> Optional[str]:
+    """
+    Check an input key before anything is downloaded.  Returns why the key is skipped
+    (a folder marker, the run config's key and size filters, or no reader in the tsdat
+    pipeline matches it), or None if it should be downloaded.  Neither bucket
+    notifications nor EventBridge rules can apply all of these filters.
+    """
+    if key.endswith("/"):
+        return "folder"
+    reason = RUN_CONFIG.get_skip_reason(key, size)
+    if reason is None and RUN_CONFIG.match_readers and not has_reader(pipeline, key):
+        reason = "no_reader"
+    return reason
+
+
+def has_reader(pipeline, key: str) -> bool:
+    """Check if one of the pipeline's readers matches the key, the way the retriever
+    matches the downloaded file.  Pipelines without reader patterns match all keys."""
+    readers = getattr(pipeline.retriever, "readers", None)
+    if not readers:
+        return True
+    local_path = str(TMP_DIRPATH / key)
+    return any(re.match(pattern, local_path) for pattern in readers)
+
+
+def skip_key(key: str, reason: str, extra_context: Dict):
+    logger.info(f"Skipping {key}: {reason}")
+    skipped = extra_context.setdefault("skipped_keys", {})
+    skipped[reason] = skipped.get(reason, 0) + 1
+
+
+def get_input_files_from_event(pipeline, event, extra_context: Dict) -> List[str]:
+    objects = []
+    for bucket_name, bucket_path, size in get_event_objects(event):
+        reason = get_skip_reason(pipeline, bucket_path, size)
+        if reason is not None:
+            skip_key(bucket_path, reason, extra_context)
+            continue
+        objects.append((bucket_name, bucket_path, size))
+
+    # Fail before downloading anything if the inputs won't fit
+    SCRATCH.check(sum(size or 0 for _, _, size in objects))
+    return [download_s3_file(bucket_name, key) for bucket_name, key, _ in objects]
 
 
 def download_s3_file(bucket_name: str, bucket_path: str) -> str:
@@ -53,9 +213,40 @@ def download_s3_file(bucket_name: str, bucket_path: str) -> str:
     return local_path_str
 
 
-def get_recently_modified_raw_files(pipeline, output_datastream: str) -> List[str]:
-    input_files = []
-    bucket_name = PIPELINES_CONFIG.input_bucket_name
+def get_last_modified(pipeline, datastream: str) -> Optional[datetime]:
+    """
+    Get the last time the datastream was written.  Uses the datastream catalog if one
+    is configured and knows the datastream, otherwise lists the datastream in storage.
+    """
+    catalog = get_catalog()
+    if catalog is not None:
+        last_modified = catalog.last_modified(datastream)
+        if last_modified is not None:
+            return last_modified
+    return pipeline.storage.last_modified(datastream)
+
+
+def get_modified_since(
+    pipeline, datastream: str, last_modified: Optional[datetime]
+) -> List[datetime]:
+    """
+    Get the data dates of the datastream that were written after last_modified.  Uses
+    the datastream catalog if one is configured and knows the datastream, otherwise
+    lists the datastream in storage.
+    """
+    catalog = get_catalog()
+    if catalog is not None:
+        modified = catalog.modified_since(datastream, last_modified)
+        if modified is not None:
+            return modified
+    return pipeline.storage.modified_since(datastream, last_modified)
+
+
+def list_recently_modified_raw_files(
+    pipeline, output_datastream: str, extra_context: Dict
+) -> List[Tuple[str, int]]:
+    """Get the keys and sizes of the input files modified since the last output."""
+    input_objects = []
     folder_bucket_path = RUN_CONFIG.input_bucket_path
     folder_bucket_path = (
         f"{folder_bucket_path}/"
@@ -64,7 +255,7 @@ def get_recently_modified_raw_files(pipeline, output_datastream: str) -> List[st
     )
 
     # We need to find the last modified date for this pipeline's output datastream.
-    last_modified: datetime = pipeline.storage.last_modified(output_datastream)
+    last_modified: datetime = get_last_modified(pipeline, output_datastream)
 
     # Then we need to query the input bucket/prefix for all files modified since
     # last output time.  Then we run the pipeline same as below.
@@ -80,20 +271,85 @@ def get_recently_modified_raw_files(pipeline, output_datastream: str) -> List[st
             if file_bucket_path != folder_bucket_path and (
                 not last_modified or file_last_modified > last_modified
             ):
+                reason = get_skip_reason(pipeline, file_bucket_path, object["Size"])
+                if reason is not None:
+                    skip_key(file_bucket_path, reason, extra_context)
+                    continue
                 logger.info(f"Adding file to input: {object['Key']}")  # type: ignore
-                input_files.append(download_s3_file(bucket_name, file_bucket_path))
+                input_objects.append((file_bucket_path, object["Size"]))
 
-    return input_files
+    return input_objects
 
 
-def get_available_vap_dates(pipeline, output_datastream) -> List[str]:
-    inputs = []
+def check_scratch_space(
+    input_objects: List[Tuple[str, int]], prefetch: bool, extra_context: Dict
+) -> bool:
+    """
+    Check that a cron ingest's inputs fit in the scratch space before any of them are
+    downloaded.  Returns whether to stream them through the pipeline (see
+    run_prefetched):  inputs that don't all fit at once are streamed a few at a time,
+    unless the pipeline's scratch config says to fail instead.
+
+    Raises:
+        RuntimeError: if the inputs don't fit, even a few at a time.
+    """
+    sizes = [size for _, size in input_objects]
+    if not prefetch:
+        if SCRATCH.fits(sum(sizes)):
+            return False
+        if SCRATCH.on_shortage != "stream":
+            SCRATCH.check(sum(sizes))
+        logger.warning(
+            f"{sum(sizes)} bytes of inputs don't fit in the scratch space:"
+            " streaming them through the pipeline instead"
+        )
+        extra_context["scratch_streaming"] = True
+
+    # The inputs downloaded ahead of the batch being processed are on disk with it
+    depth, batch_size = get_prefetch_depth(), RUN_CONFIG.prefetch_batch_size
+    largest = sorted(sizes, reverse=True)[: depth + batch_size]
+    SCRATCH.check(sum(largest), "the prefetched inputs")
+    return True
+
+
+def get_prefetch_depth() -> int:
+    # Inputs streamed because they didn't fit are prefetched one at a time
+    return max(RUN_CONFIG.prefetch_depth, 1)
+
+
+def run_prefetched(pipeline, input_keys: List[str]) -> Dict:
+    """
+    Run the pipeline over the input files in batches of the run config's
+    prefetch_batch_size while the next prefetch_depth files are downloaded in the
+    background.  Each batch is deleted from scratch space once it has been processed.
+    """
+    from build_utils.prefetch import Prefetcher
+
+    bucket_name = PIPELINES_CONFIG.input_bucket_name
+    prefetcher = Prefetcher(
+        lambda key: download_s3_file(bucket_name, key),
+        input_keys,
+        depth=get_prefetch_depth(),
+        batch_size=RUN_CONFIG.prefetch_batch_size,
+    )
+    with prefetcher:
+        for batch in prefetcher:
+            logger.info(f"Running batch {prefetcher.batches}: {batch}")
+            try:
+                pipeline.run(batch)
+            finally:
+                for path in batch:
+                    Path(path).unlink(missing_ok=True)
+    return prefetcher.stats()
+
+
+def get_modified_input_days(pipeline, output_datastream) -> List[datetime]:
     # Get the input datastreams
     input_datastreams: List[str] = pipeline.parameters.datastreams
 
     # From storage, find the last datetime of the output datastream and any
     # input data dates that were modified since.
-    last_modified: datetime = pipeline.storage.last_modified(output_datastream)
+    last_modified: datetime = get_last_modified(pipeline, output_datastream)
     logger.info(f"Last output date for vap = {last_modified}")
     modified_days: List[datetime] = []
     for input_datastream in input_datastreams:
@@ -101,40 +357,207 @@ def get_available_vap_dates(pipeline, output_datastream) -> List[str]:
             f"Input datastream {input_datastream} modified after last output date."
         )
         modified_days.extend(
-            pipeline.storage.modified_since(input_datastream, last_modified)
+            get_modified_since(pipeline, input_datastream, last_modified)
         )
+    return modified_days
+
+
+def get_available_vap_dates(pipeline, output_datastream) -> List[str]:
+    inputs = []
+    modified_days = get_modified_input_days(pipeline, output_datastream)
 
     if len(modified_days) == 0:
         logger.info("No new input files available to run!")
 
     else:
-        # If new files were found, we'll just run the last specified time noted.
-        # Previous times will need to be rerun locally.
-
-        # Start from previous X, at midnight UTC.
-        cron_schedule = PIPELINE_CONFIG.schedule
-        if cron_schedule == "Hourly":
-            td = timedelta(hours=1)
-        elif cron_schedule == "Daily":
-            td = timedelta(days=1)
-        elif cron_schedule == "Weekly":
-            td = timedelta(days=7)
-        elif cron_schedule == "Monthly":
-            td = timedelta(weeks=4)
-
-        modified_days: datetime = datetime.now(timezone.utc) - td
-        start_day = round_time_to_midnight(modified_days)
-        end_day = round_time_to_midnight(modified_days) + td
+        # If new files were found, we'll just run the last scheduled window.
+        # Previous windows will need to be rerun locally.
+        start, end = PIPELINE_CONFIG.get_window(datetime.now(timezone.utc))
 
         # Start and end dates for the pipeline need to be strings in this
-        # format: 20230101
-        start_day_str = start_day.strftime("%Y%m%d")
-        end_day_str = end_day.strftime("%Y%m%d")
-        inputs = [start_day_str, end_day_str]
+        # format: 20230101, or 20230101.093000 if the window isn't whole days
+        inputs = format_window(start, end)
 
     return inputs
 
 
+def get_upstream_vap_dates(pipeline, output_datastream) -> List[str]:
+    """
+    Get the date range for a VAP triggered by its upstream datastreams.  All input
+    data dates modified since the last output are covered by one run, so a burst of
+    upstream writes is processed together.
+    """
+    modified_days = get_modified_input_days(pipeline, output_datastream)
+    if len(modified_days) == 0:
+        logger.info("No new input files available to run!")
+        return []
+
+    start_day = round_time_to_midnight(min(modified_days))
+    end_day = get_next_day(round_time_to_midnight(max(modified_days)))
+    return [start_day.strftime("%Y%m%d"), end_day.strftime("%Y%m%d")]
+
+
+def get_function_arn(context) -> str:
+    if context is not None:
+        return context.invoked_function_arn
+    # Running in a container task (the ARN its lambda is invoked by) or locally
+    return os.environ.get("TRIGGER_ARN") or os.environ.get(
+        "AWS_LAMBDA_FUNCTION_NAME", f"{PIPELINE_NAME}-{CONFIG_ID}"
+    )
+
+
+def get_function_name(context) -> str:
+    """The lambda's function name, also in the container task it started, so that the
+    task's metrics are counted with the lambda's (see build_utils.monitoring)."""
+    arn = get_function_arn(context)
+    return arn.split(":function:")[-1].split(":")[0]
+
+
+def request_debounced_run(context) -> bool:
+    """
+    Schedule a run of this function after the pipeline's debounce window.  Returns
+    False if a run is already pending, in which case this event is coalesced onto it.
+    """
+    from build_utils.debounce import get_debouncer
+
+    scheduled = get_debouncer().request(
+        get_function_arn(context),
+        timedelta(minutes=PIPELINE_CONFIG.debounce_minutes),
+        CONFIG_ID,
+    )
+    if scheduled:
+        logger.info(
+            f"Scheduled a run in {PIPELINE_CONFIG.debounce_minutes} minutes for new"
+            " upstream data"
+        )
+    else:
+        logger.info("A run is already pending for new upstream data")
+    return scheduled
+
+
+def get_ingest_lease_window(event) -> str:
+    """
+    Get the window an ingest's single-flight lease covers.  A cron ingest processes all
+    raw files modified since the last output, so overlapping cron runs always duplicate
+    each other.  An S3 triggered ingest processes the files in its event, so only
+    repeated deliveries of the same files collide.
+    """
+    from build_utils.constants import Trigger
+
+    if PIPELINE_CONFIG.trigger == Trigger.Cron:
+        return "modified-since"
+    keys = "\n".join(sorted(key for _, key, _ in get_event_objects(event)))
+    return f"files-{hashlib.sha1(keys.encode()).hexdigest()[:16]}"
+
+
+def take_lease(leases, output_datastream: str, window: str, context, extra_context):
+    """
+    Take the single-flight lease on the output datastream and window, and keep it
+    renewed while the run is alive.  Returns None if another invocation holds it, in
+    which case this one coalesces onto that run.
+    """
+    from build_utils.lease import get_lease_key, get_lease_ttl, get_owner
+
+    key = get_lease_key(output_datastream, window)
+    lease = leases.hold(key, get_owner(context), get_lease_ttl())
+    extra_context["lease"] = {"key": key, "coalesced": lease is None}
+    if lease is None:
+        holder = leases.holder(key) or {}
+        extra_context["lease"]["holder"] = holder.get("owner")
+        logger.info(f"Coalescing onto the run holding the lease on {key}: {holder}")
+    return lease
+
+
+def get_code_fingerprint() -> str:
+    """
+    Fingerprint of the code and configs the run config's output depends on, which are
+    part of its input fingerprints (see check_inputs_unchanged).  The image doesn't
+    change while it runs, so it is computed once per config.
+    """
+    from build_utils.fingerprint import get_code_fingerprint as fingerprint_code
+
+    if RUN_CONFIG.id not in CODE_FINGERPRINTS:
+        CODE_FINGERPRINTS[RUN_CONFIG.id] = fingerprint_code(
+            [Path("pipelines") / PIPELINE_NAME, Path("shared")],
+            os.environ.get("CODE_VERSION", ""),
+            RUN_CONFIG.id,
+        )
+    return CODE_FINGERPRINTS[RUN_CONFIG.id]
+
+
+def check_inputs_unchanged(
+    fingerprints, pipeline, output_datastream: str, window: str, extra_context
+) -> bool:
+    """
+    Check if the VAP's inputs for the window are the same objects (keys and ETags) its
+    last successful run of the window read, by listing the inputs of that run's
+    storage queries again.  Nothing is downloaded.
+    """
+    from build_utils.fingerprint import replay
+
+    stored = fingerprints.get(output_datastream, window)
+    extra_context["fingerprint"] = {
+        "previous": stored["written"] if stored else None,
+        "unchanged": False,
+    }
+    if stored is None:
+        return False
+
+    current = replay(pipeline.storage, stored["queries"])
+    if current.fingerprint(get_code_fingerprint()) != stored["fingerprint"]:
+        return False
+    extra_context["fingerprint"]["unchanged"] = True
+    logger.info(
+        f"Skipping {output_datastream} {window}: its inputs are unchanged since"
+        f" {stored['written']}"
+    )
+    return True
+
+
+def save_fingerprint(
+    fingerprints, output_datastream: str, window: str, recorder, extra_context
+):
+    """Store the fingerprint of the inputs a successful VAP run read."""
+    fingerprint = recorder.fingerprint(get_code_fingerprint())
+    if fingerprint is None:
+        # E.g., the storage class doesn't record the objects it reads
+        logger.info(f"No input fingerprint for {output_datastream} {window}")
+        return
+    try:
+        fingerprints.put(output_datastream, window, fingerprint, recorder)
+        extra_context.setdefault("fingerprint", {})["saved"] = fingerprint
+    except Exception:
+        # The run itself succeeded.  At worst the next run recomputes the window.
+        logger.warning(
+            f"Failed to save the input fingerprint of {output_datastream} {window}",
+            exc_info=True,
+        )
+
+
+def save_profile(profiler, pipeline, output_datastream: str) -> Dict:
+    """
+    Upload the profile of the pipeline run next to the pipeline's outputs
+    ({storage_root}/profiles/{datastream}/...) and summarize the hot functions.
+    """
+    from build_utils.profiling import get_profile_name
+
+    summary: Dict = {"mode": profiler.mode, "top": profiler.summary()}
+    try:
+        storage_root = getattr(
+            pipeline.storage.parameters, "storage_root", "storage/root"
+        )
+        name = get_profile_name(profiler)
+        key = f"{Path(storage_root).as_posix()}/profiles/{output_datastream}/{name}"
+        local_path = TMP_DIRPATH / name
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.save(str(local_path))
+        S3_CLIENT.upload_file(str(local_path), PIPELINES_CONFIG.output_bucket_name, key)
+        summary["s3_key"] = key
+    except Exception:
+        logger.warning("Failed to upload the profile", exc_info=True)
+    return summary
+
+
 def set_env_vars():
     """-------------------------------------------------------------------
     Environment variables are used to set values in the pipelines'
@@ -160,8 +583,12 @@ def set_env_vars():
     logging_level = os.environ.get("LOG_LEVEL", "INFO").upper()
     os.environ["LOG_LEVEL"] = logging_level
 
-    # TODO: add storage classname to the pipelines config so it can be configured
-    os.environ["TSDAT_STORAGE_CLASS"] = "tsdat.FileSystemS3"
+    # S3 transfer settings from the pipeline's storage config (the storage class
+    # itself is set on the tsdat config in get_pipeline)
+    os.environ.update(PIPELINE_CONFIG.storage.get_env_vars())
+
+    # Datastream catalog used for last_modified / modified_since queries
+    os.environ.update(PIPELINES_CONFIG.catalog.get_env_vars())
 
     try:
         # Created by the Dockerfile via dunamai
@@ -194,8 +621,15 @@ def round_time_to_midnight(time: datetime) -> datetime:
 def lambda_handler(event, context):
     """--------------------------------------------------------------------------------
     Lambda function to run a tsdat pipeline. The function will be triggered by either
-    1) a bucket event for an incoming raw data file, or
-    2) a cron event for pipelines that need to run on a schedule.
+    1) a bucket event for an incoming raw data file,
+    2) a cron event for pipelines that need to run on a schedule, or
+    3) an EventBridge event for new output in an upstream datastream, which schedules
+       a debounced run of the pipeline (Upstream trigger), or
+    4) a warm-up event sent by the build to a newly published version, which only
+       imports and instantiates the pipeline.
+
+    Configs with the container backend are run by a Fargate task that this function
+    starts, which calls this function again on the same event (see task_runner.py).
 
     The pipeline will process the raw files using the specified configuration (either
     ingest or vap) and save the file to an S3 bucket specified by an environment
@@ -209,62 +643,275 @@ def lambda_handler(event, context):
         this context provides is specified by AWS here:
         https://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
     --------------------------------------------------------------------------------"""
-    from tsdat.config.pipeline import PipelineConfig as TsdatPipelineConfig
-
-    from build_utils.constants import PipelineType, Trigger
+    from build_utils.constants import METRICS_NAMESPACE, PipelineType, Trigger
+    from build_utils.containers import is_container_task
+    from build_utils.debounce import get_debouncer, is_debounce_event, is_upstream_event
+    from build_utils.fingerprint import INPUTS, get_fingerprint_store
+    from build_utils.lease import LeaseHeldError, get_lease_manager
+    from build_utils.memory import MemoryTracker
+    from build_utils.profiling import get_profiler
+    from build_utils.s3_cache import get_cache_stats, reset_cache_stats
+    from build_utils.storage import (
+        get_upload_stats,
+        reset_upload_stats,
+        wait_for_uploads,
+    )
 
+    started = time.monotonic()
+    start_time = datetime.now(timezone.utc)
     set_env_vars()
+    reset_upload_stats()
+    reset_cache_stats()
+    global TMP_DIRPATH
+    TMP_DIRPATH = SCRATCH.new_dir()
+    # Memory tracking is off unless switched on for this pipeline (MEMORY_TRACKING)
+    memory = MemoryTracker.from_env()
+    memory.start()
     inputs = []
     extra_context = {}
     success = False
+    # Single-flight leases are off unless switched on for this pipeline
+    leases = get_lease_manager()
+    lease = None
+    retry_error = None
+    # Input fingerprints are off unless switched on for this (VAP) pipeline
+    fingerprints = get_fingerprint_store()
+    use_run_config(DEPLOYED_CONFIG_ID)
 
     try:
-        logger.info(f"Running pipeline {PIPELINE_NAME} {CONFIG_ID}")
-        tsdat_config = TsdatPipelineConfig.from_yaml(Path(RUN_CONFIG.config_file_path))
-        pipeline = tsdat_config.instantiate_pipeline()
-
-        # Get the output datastream (e.g., morro.buoy_z06-lidar-10m.a1)
-        output_datastream = pipeline.dataset_config.attrs.datastream
-
-        if (
-            PIPELINE_CONFIG.trigger == Trigger.Cron
-            and PIPELINE_CONFIG.type == PipelineType.VAP
-        ):
-            inputs = get_available_vap_dates(pipeline, output_datastream)
-
-        elif PIPELINE_CONFIG.type == PipelineType.Ingest:
-            if PIPELINE_CONFIG.trigger == Trigger.Cron:
-                inputs = get_recently_modified_raw_files(pipeline, output_datastream)
-
+        warmup = is_warmup_event(event)
+        if not warmup:
+            use_run_config(get_config_id(event))
+
+        if warmup:
+            # A consolidated pipeline's lambda warms up all of its configs
+            if DEPLOYED_CONFIG_ID or event.get("config_id"):
+                config_ids = [get_config_id(event)]
             else:
-                inputs = get_input_files_from_event(event)
-
-            assert len(inputs) >= 1, "No input files found!"
-
-        if len(inputs) > 0:
-            logger.info(f"Running with inputs: {inputs}")
-            pipeline.run(inputs)
+                config_ids = list(PIPELINE_CONFIG.configs)
+            logger.info(f"Warming up pipeline {PIPELINE_NAME} {config_ids}")
+            with memory.phase("instantiate"):
+                for config_id in config_ids:
+                    use_run_config(config_id)
+                    if not runs_in_task():
+                        get_pipeline()
+            extra_context["warmup"] = True
+
+        elif PIPELINE_CONFIG.trigger == Trigger.Upstream and is_upstream_event(event):
+            # Don't run yet:  wait for the debounce window so a burst of upstream
+            # writes is processed by a single run
+            extra_context["debounce_scheduled"] = request_debounced_run(context)
+
+        elif runs_in_task():
+            if PIPELINE_CONFIG.trigger == Trigger.Upstream and is_debounce_event(event):
+                # Later upstream writes open a new debounce window
+                get_debouncer().complete(get_function_arn(context), CONFIG_ID)
+            extra_context["task"] = start_task(event)
+
+        else:
+            if (
+                PIPELINE_CONFIG.trigger == Trigger.Upstream
+                and is_debounce_event(event)
+                and not is_container_task()  # Completed by the lambda that started it
+            ):
+                # Later upstream writes open a new debounce window
+                get_debouncer().complete(get_function_arn(context), CONFIG_ID)
+
+            logger.info(f"Running pipeline {PIPELINE_NAME} {CONFIG_ID}")
+            with memory.phase("instantiate"):
+                pipeline = get_pipeline()
+
+            # Get the output datastream (e.g., morro.buoy_z06-lidar-10m.a1)
+            output_datastream = pipeline.dataset_config.attrs.datastream
+
+            # Stream a cron ingest's inputs through the pipeline instead of
+            # downloading them all first
+            prefetch = RUN_CONFIG.prefetch_depth > 0
+            coalesced = False
+            recorder = None
+            if leases is not None and PIPELINE_CONFIG.type == PipelineType.Ingest:
+                # An ingest's window is known before anything is downloaded
+                lease = take_lease(
+                    leases,
+                    output_datastream,
+                    get_ingest_lease_window(event),
+                    context,
+                    extra_context,
+                )
+                coalesced = lease is None
+                if coalesced and PIPELINE_CONFIG.trigger == Trigger.S3:
+                    # The holder may still die before it ingests the files, so fail
+                    # this invocation for Lambda to retry the event (or send it to
+                    # the DLQ) instead of dropping it
+                    raise LeaseHeldError(
+                        f"{extra_context['lease']['key']} is held by"
+                        f" {extra_context['lease'].get('holder')}"
+                    )
+
+            if not coalesced:
+                with memory.phase("download"):
+                    if PIPELINE_CONFIG.type == PipelineType.VAP:
+                        if PIPELINE_CONFIG.trigger == Trigger.Cron:
+                            inputs = get_available_vap_dates(
+                                pipeline, output_datastream
+                            )
+
+                        elif PIPELINE_CONFIG.trigger == Trigger.Upstream:
+                            inputs = get_upstream_vap_dates(pipeline, output_datastream)
+
+                    elif PIPELINE_CONFIG.type == PipelineType.Ingest:
+                        if PIPELINE_CONFIG.trigger == Trigger.Cron:
+                            input_objects = list_recently_modified_raw_files(
+                                pipeline, output_datastream, extra_context
+                            )
+                            prefetch = check_scratch_space(
+                                input_objects, prefetch, extra_context
+                            )
+                            inputs = [key for key, _ in input_objects]
+                            if not prefetch:
+                                # Otherwise only list the files:  they are
+                                # downloaded while the pipeline runs (see
+                                # run_prefetched)
+                                bucket_name = PIPELINES_CONFIG.input_bucket_name
+                                inputs = [
+                                    download_s3_file(bucket_name, key) for key in inputs
+                                ]
+
+                        else:
+                            inputs = get_input_files_from_event(
+                                pipeline, event, extra_context
+                            )
+
+                        # An event whose keys were all filtered out isn't an error
+                        assert (
+                            len(inputs) >= 1 or "skipped_keys" in extra_context
+                        ), "No input files found!"
+
+                if (
+                    leases is not None
+                    and PIPELINE_CONFIG.type == PipelineType.VAP
+                    and len(inputs) > 0
+                ):
+                    lease = take_lease(
+                        leases,
+                        output_datastream,
+                        "-".join(inputs),
+                        context,
+                        extra_context,
+                    )
+                    coalesced = lease is None
+
+            if coalesced:
+                if PIPELINE_CONFIG.trigger == Trigger.Upstream:
+                    # The lease holder may have listed its inputs before the upstream
+                    # write that sent this event, so queue another run after it
+                    extra_context["debounce_scheduled"] = request_debounced_run(context)
+
+            elif (
+                len(inputs) > 0
+                and fingerprints is not None
+                and check_inputs_unchanged(
+                    fingerprints,
+                    pipeline,
+                    output_datastream,
+                    "-".join(inputs),
+                    extra_context,
+                )
+            ):
+                # Logged and added to the run context by check_inputs_unchanged
+                pass
+
+            elif len(inputs) > 0:
+                logger.info(f"Running with inputs: {inputs}")
+                # Profiling is off unless switched on for this config (PROFILE_MODE)
+                profiler = get_profiler(CONFIG_ID)
+                try:
+                    with memory.phase("run"), profiler or nullcontext(), (
+                        INPUTS.recording() if fingerprints else nullcontext()
+                    ) as recorder:
+                        if PIPELINE_CONFIG.trigger == Trigger.Cron and prefetch:
+                            extra_context["prefetch"] = run_prefetched(pipeline, inputs)
+                        else:
+                            pipeline.run(inputs)
+                finally:
+                    if profiler is not None:
+                        extra_context["profile"] = save_profile(
+                            profiler, pipeline, output_datastream
+                        )
+
+            # Make sure any asynchronous output uploads have finished
+            with memory.phase("write"):
+                wait_for_uploads()
+                if recorder is not None:
+                    # Only once the output is written, so a failed write is retried
+                    save_fingerprint(
+                        fingerprints,
+                        output_datastream,
+                        "-".join(inputs),
+                        recorder,
+                        extra_context,
+                    )
 
         success = True
 
+    except LeaseHeldError as e:
+        logger.warning(f"Retrying the event later: {e}")
+        retry_error = e
+
     except BaseException:
         logger.exception("Failed to run the pipeline.")
 
     finally:
-        # Clean up all files in the temp directory after running
-        logger.info(f"Cleaning up temporary files from {TMP_DIRPATH}")
-        shutil.rmtree(TMP_DIRPATH)
-
-        extra_context = {
-            "success": success,
-            "inputs": inputs,
-            "code_version": os.environ.get("CODE_VERSION", ""),
-            "event": event,
-        }
+        # Don't leave uploads from a failed run running in a frozen container
+        wait_for_uploads(raise_errors=False)
+        memory.stop()
+
+        if lease is not None:
+            try:
+                lease.stop_heartbeat()
+                leases.release(lease)
+            except Exception:
+                logger.warning(
+                    f"Failed to release the lease on {lease.key}", exc_info=True
+                )
+
+        extra_context.update(
+            {
+                "pipeline": PIPELINE_NAME,
+                "config_id": CONFIG_ID,
+                "backend": "container" if is_container_task() else "lambda",
+                "success": success,
+                "inputs": inputs,
+                "code_version": os.environ.get("CODE_VERSION", ""),
+                "start_time": start_time.isoformat(),
+                "duration_s": round(time.monotonic() - started, 3),
+                # Configured memory, used to estimate GB-seconds
+                "memory_mb": int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", 0)),
+                "event": event,
+                "storage": {**get_upload_stats(), "read_cache": get_cache_stats()},
+                # The scratch directory is left for the next invocation to delete
+                # in the background, so the deletion isn't part of this run
+                "scratch": SCRATCH.get_stats(),
+            }
+        )
+        if memory.enabled:
+            extra_context["memory"] = memory.report()
+
+        # Failures are caught above, so lambda's Errors metric only counts the runs
+        # that crashed or timed out (and the retried events, which raise below)
+        metrics = get_emf_metrics(
+            METRICS_NAMESPACE,
+            {"FunctionName": get_function_name(context)},
+            {"PipelineFailures": int(not success and retry_error is None)},
+        )
 
         for handler in logging.getLogger().handlers:
             if isinstance(handler, DelayedJSONStreamHandler):
-                handler.flush(context=extra_context)
+                handler.flush(context=extra_context, metrics=metrics)
+
+    if retry_error is not None:
+        # Raised only after the run context is logged
+        raise retry_error
 
     return not success  # Convert successful exit codes to 0
 
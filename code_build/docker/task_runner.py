@@ -0,0 +1,48 @@
+"""--------------------------------------------------------------------------------
+Runs the pipeline of a config with the container backend as a Fargate task.  The
+config's lambda starts the task with the event it received (see
+build_utils.containers), and this script runs lambda_handler on it in the same image.
+The exit code is 0 if the pipeline succeeded.
+
+The same image runs it locally, e.g.:
+
+    docker run --rm --entrypoint python3.12 \\
+        -e TSDAT_BACKEND=container -e PIPELINE_NAME=lidar -e CONFIG_ID=humboldt \\
+        -e BRANCH=dev -e TSDAT_EVENT='{"Records": [...]}' \\
+        <image> task_runner.py
+--------------------------------------------------------------------------------"""
+
+import os
+import signal
+import sys
+
+from build_utils.containers import get_task_event
+from lambda_function import lambda_handler
+
+
+def stop(signum, frame):
+    # Raised inside the pipeline run, so the handler logs the failure and releases
+    # its lease before the task exits
+    if signum == signal.SIGALRM:
+        raise TimeoutError(f"Task timed out after {os.environ['TASK_TIMEOUT_S']}s")
+    raise SystemExit(f"Task stopped by signal {signum}")
+
+
+def main() -> int:
+    # Fargate tasks have no timeout of their own
+    timeout_s = int(os.environ.get("TASK_TIMEOUT_S", 0))
+    if timeout_s > 0:
+        signal.signal(signal.SIGALRM, stop)
+        signal.alarm(timeout_s)
+    # Sent by ECS when the task is stopped
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        failed = lambda_handler(get_task_event(), None)
+    finally:
+        signal.alarm(0)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/bin/bash
+#####################################################################
+# Script Name:  image_report.sh
+# Description:  Print a size and import-time report for a pipeline
+#               image so that image changes can be compared against
+#               the image that is currently deployed.
+#
+# Arguments:
+#     1) uri of image to report on
+#     2) (optional) uri of a baseline image to compare against
+#
+# Example:
+#     ./image_report.sh $NEW_IMAGE_URI $OLD_IMAGE_URI
+#####################################################################
+
+image_uri="$1"
+baseline_image_uri="$2"
+
+# Python in the image (symlinked to the conda environment's python)
+PYTHON=/var/lang/bin/python3.12
+
+# Modules that dominate the cold start of the lambda handler
+IMPORT_SCRIPT='
+import time
+start = time.perf_counter()
+import boto3
+import tsdat
+from tsdat.config.pipeline import PipelineConfig
+print(f"    import time (boto3 + tsdat): {time.perf_counter() - start:.2f} s")
+'
+
+report() {
+    local uri="$1"
+    echo "Image: ${uri}"
+
+    local size
+    size=$(docker image inspect --format '{{.Size}}' "${uri}" 2>/dev/null)
+    if [[ -z $size ]] ; then
+        echo "    image not available locally"
+        return
+    fi
+    echo "    uncompressed size: $((size / 1024 / 1024)) MB"
+
+    # Run twice: the first run includes reading the files from disk, the second is
+    # closer to a warm page cache
+    docker run --rm --entrypoint ${PYTHON} "${uri}" -c "${IMPORT_SCRIPT}"
+    docker run --rm --entrypoint ${PYTHON} "${uri}" -c "${IMPORT_SCRIPT}"
+
+    # Top 10 slowest imports (cumulative microseconds)
+    echo "    slowest imports (cumulative us):"
+    docker run --rm --entrypoint ${PYTHON} "${uri}" -X importtime -c "import tsdat" 2>&1 \
+        | grep "import time:" | sort -t'|' -k2 -n -r | head -10 | sed 's/^/    /'
+}
+
+echo "################### Image report ###################"
+report "${image_uri}"
+
+# The baseline is the previous image, tagged locally by build_docker.sh
+if [[ -n $baseline_image_uri ]] ; then
+    report "${baseline_image_uri}"
+fi
+echo "####################################################"
@@ -1,11 +1,20 @@
-from typing import Optional
+import os
+from typing import Dict, Optional
+
+import yaml
 from aws_cdk import (
+    Fn,
     Stack,
     RemovalPolicy,
     aws_s3 as s3,
+    aws_ec2 as ec2,
     aws_ecr as ecr,
+    aws_ecs as ecs,
     aws_lambda as _lambda,
     aws_iam as iam,
+    aws_logs as logs,
+    aws_sns as sns,
+    aws_sns_subscriptions as subscriptions,
 )
 from aws_cdk.aws_codebuild import (
     PipelineProject,
@@ -25,7 +34,7 @@ from aws_cdk.aws_iam import PolicyStatement, Effect
 from constructs import Construct
 
 from build_utils.pipelines_config import PipelinesConfig
-from build_utils.constants import Env
+from build_utils.constants import BuildStep, Env, S3Routing
 
 
 class CodePipelineStack(Stack):
@@ -44,15 +53,31 @@ class CodePipelineStack(Stack):
         if self.config.create_buckets:
             self.create_buckets()
 
+        # Create a role that the EventBridge Scheduler uses to invoke debounced
+        # pipeline runs (Upstream trigger)
+        scheduler_role_arn = self.create_scheduler_role()
+
+        # Create the Fargate cluster and network that run the configs with the
+        # container backend, if there are any
+        container_env = (
+            self.create_container_resources() if self.config.uses_containers else {}
+        )
+
         # Create a role that will be used to execute lambda functions that gives them
         # read/write access to the input and output buckets
-        lambda_role_arn = self.create_lambda_role()
+        lambda_role_arn = self.create_lambda_role(scheduler_role_arn, container_env)
 
         # Create the ECR repo
         self.create_ecr_repository()
 
+        # Create the topic the pipelines' alarms notify.  The build creates the
+        # dashboards and alarms when it deploys each pipeline.
+        alarm_topic_arn = self.create_alarm_topic()
+
         # Create the code pipeline
-        self.create_code_pipeline(lambda_role_arn)
+        self.create_code_pipeline(
+            lambda_role_arn, scheduler_role_arn, container_env, alarm_topic_arn
+        )
 
         # TODO: May need an sns topic for build alert messages
 
@@ -93,7 +118,9 @@ class CodePipelineStack(Stack):
         )
         return (output, action)
 
-    def create_code_pipeline(self, lambda_role_arn):
+    def create_code_pipeline(
+        self, lambda_role_arn, scheduler_role_arn, container_env, alarm_topic_arn
+    ):
         """Create the code pipeline in AWS.
         This pipeline sets up an automated build that is connected to the two GitHub repositories
         (pipelines & aws template) via a CodeStar connection.  Whenever one of these repos change,
@@ -103,6 +130,8 @@ class CodePipelineStack(Stack):
          2) deploying the lambda function for the pipeline
          3) if the trigger is cron, set a schedule for the lambda
          4) If the trigger is s3, create sns events to trigger lambda for the raw folder path
+         5) If the trigger is upstream, create EventBridge rules for the upstream output paths
+         6) create the pipeline's CloudWatch dashboard and alarms
         """
         deployment_name = Env.BRANCH
 
@@ -121,32 +150,198 @@ class CodePipelineStack(Stack):
             self,
             f"{project_name}-project",
             build_spec=BuildSpec.from_source_filename("buildspec.yml"),
-            environment=BuildEnvironment(
-                build_image=LinuxBuildImage.AMAZON_LINUX_2_5,
-                compute_type=ComputeType.MEDIUM,
-                privileged=True,
-            ),
+            environment=self.get_build_environment(),
             # BRANCH and REPO_NAME are used to name the image and AWS resources that are created by the build
-            environment_variables={
-                "AWS_ACCOUNT_ID": BuildEnvironmentVariable(
-                    value=self.config.account_id
-                ),
-                "AWS_DEFAULT_REGION": BuildEnvironmentVariable(
-                    value=self.config.region
-                ),
-                "PIPELINES_REPO_NAME": BuildEnvironmentVariable(
-                    value=self.config.pipelines_repo_name
-                ),
-                "PIPELINES_REPO_URL": BuildEnvironmentVariable(
-                    value=self.config.pipelines_repo_url
+            environment_variables=self.get_build_environment_variables(
+                pipeline_name,
+                lambda_role_arn,
+                scheduler_role_arn,
+                container_env,
+                alarm_topic_arn,
+            ),
+        )
+        self.add_build_permissions(build_project)
+
+        stages = [
+            StageProps(
+                stage_name=f"{Env.BRANCH}-source",
+                actions=[aws_build_source_action, pipelines_source_action],
+            ),
+        ]
+
+        if not self.config.build.batch_enabled:
+            # Now define the Code Build action to run in the build stage
+            build_action = CodeBuildAction(
+                action_name=f"{project_name}-action",
+                input=aws_build_artifact,
+                project=build_project,
+                extra_inputs=[pipelines_artifact],
+                variables_namespace="BuildVariables",
+                environment_variables={},
+            )
+            stages.append(
+                StageProps(
+                    stage_name=f"{deployment_name}-build", actions=[build_action]
+                )
+            )
+
+        else:
+            # Fan the build out across several nodes:
+            #  1) build the base image and export the list of pipelines to build
+            #  2) build and deploy the pipelines in parallel shards (a batch build)
+            #  3) update the S3/cron triggers once all the lambdas exist
+            base_action = CodeBuildAction(
+                action_name=f"{project_name}-action",
+                input=aws_build_artifact,
+                project=build_project,
+                extra_inputs=[pipelines_artifact],
+                variables_namespace="BuildVariables",
+                environment_variables={
+                    "BUILD_STEP": BuildEnvironmentVariable(value=BuildStep.Base),
+                },
+            )
+
+            shard_project = PipelineProject(
+                self,
+                f"{project_name}-shard-project",
+                build_spec=self.get_batch_build_spec(self.config.build.shards),
+                environment=self.get_build_environment(),
+                environment_variables=self.get_build_environment_variables(
+                    pipeline_name,
+                    lambda_role_arn,
+                    scheduler_role_arn,
+                    container_env,
+                    alarm_topic_arn,
                 ),
-                "AWS_PIPELINE_NAME": BuildEnvironmentVariable(value=pipeline_name),
-                "BRANCH": BuildEnvironmentVariable(value=Env.BRANCH),
-                # This ARN is not one we can dynamically determine, so we have to pass it in
-                "LAMBDA_ROLE_ARN": BuildEnvironmentVariable(value=lambda_role_arn),
+            )
+            self.add_build_permissions(shard_project)
+            shard_action = CodeBuildAction(
+                action_name=f"{project_name}-shard-action",
+                input=aws_build_artifact,
+                project=shard_project,
+                extra_inputs=[pipelines_artifact],
+                execute_batch_build=True,
+                environment_variables={
+                    "PIPELINES_TO_BUILD": BuildEnvironmentVariable(
+                        value=base_action.variable("PIPELINES_TO_BUILD")
+                    ),
+                },
+            )
+
+            triggers_action = CodeBuildAction(
+                action_name=f"{project_name}-triggers-action",
+                input=aws_build_artifact,
+                project=build_project,
+                extra_inputs=[pipelines_artifact],
+                environment_variables={
+                    "BUILD_STEP": BuildEnvironmentVariable(value=BuildStep.Triggers),
+                },
+            )
+
+            stages.extend(
+                [
+                    StageProps(
+                        stage_name=f"{deployment_name}-build", actions=[base_action]
+                    ),
+                    StageProps(
+                        stage_name=f"{deployment_name}-build-pipelines",
+                        actions=[shard_action],
+                    ),
+                    StageProps(
+                        stage_name=f"{deployment_name}-deploy-triggers",
+                        actions=[triggers_action],
+                    ),
+                ]
+            )
+
+        # Define the pipeline
+        Pipeline(
+            self,
+            pipeline_name,
+            pipeline_name=pipeline_name,
+            cross_account_keys=False,
+            stages=stages,
+        )
+
+    def get_build_environment(self) -> BuildEnvironment:
+        compute_type = self.config.build.compute_type
+        if not hasattr(ComputeType, compute_type):
+            raise ValueError(f"Unknown CodeBuild compute_type: {compute_type}")
+
+        return BuildEnvironment(
+            build_image=LinuxBuildImage.AMAZON_LINUX_2_5,
+            compute_type=getattr(ComputeType, compute_type),
+            privileged=True,
+        )
+
+    def get_build_environment_variables(
+        self,
+        pipeline_name: str,
+        lambda_role_arn: str,
+        scheduler_role_arn: str,
+        container_env: Dict[str, str],
+        alarm_topic_arn: str,
+    ) -> Dict[str, BuildEnvironmentVariable]:
+        return {
+            "AWS_ACCOUNT_ID": BuildEnvironmentVariable(value=self.config.account_id),
+            "AWS_DEFAULT_REGION": BuildEnvironmentVariable(value=self.config.region),
+            "PIPELINES_REPO_NAME": BuildEnvironmentVariable(
+                value=self.config.pipelines_repo_name
+            ),
+            "PIPELINES_REPO_URL": BuildEnvironmentVariable(
+                value=self.config.pipelines_repo_url
+            ),
+            "AWS_PIPELINE_NAME": BuildEnvironmentVariable(value=pipeline_name),
+            "BRANCH": BuildEnvironmentVariable(value=Env.BRANCH),
+            # This ARN is not one we can dynamically determine, so we have to pass it in
+            "LAMBDA_ROLE_ARN": BuildEnvironmentVariable(value=lambda_role_arn),
+            "SCHEDULER_ROLE_ARN": BuildEnvironmentVariable(value=scheduler_role_arn),
+            "ALARM_TOPIC_ARN": BuildEnvironmentVariable(value=alarm_topic_arn),
+            # The Fargate resources for the container backend (see Env)
+            **{
+                name: BuildEnvironmentVariable(value=value)
+                for name, value in container_env.items()
             },
+        }
+
+    def get_batch_build_spec(self, shards: int) -> BuildSpec:
+        """Create the build spec for the build shards.  This is the same as
+        buildspec.yml, plus a batch build-list with one build per shard.
+
+        Args:
+            shards (int): the number of build shards
+
+        Returns:
+            BuildSpec: the inline build spec for the shard project
+        """
+        buildspec_path = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+            "buildspec.yml",
         )
+        # Load every value as a string so values like `git-credential-helper: yes`
+        # are passed through to CodeBuild unchanged
+        with open(buildspec_path, "r") as file:
+            spec = yaml.load(file, Loader=yaml.BaseLoader)
+
+        spec["batch"] = {
+            "fast-fail": False,
+            "build-list": [
+                {
+                    "identifier": f"shard_{index}",
+                    "env": {
+                        "variables": {
+                            "BUILD_STEP": BuildStep.Shard,
+                            "SHARD_INDEX": str(index),
+                            "SHARD_COUNT": str(shards),
+                        }
+                    },
+                }
+                for index in range(shards)
+            ],
+        }
+        return BuildSpec.from_object(spec)
 
+    def add_build_permissions(self, build_project: PipelineProject):
         # Give the pipeline the correct permissions to read/write any images in Elastic Container Registry
         build_project.add_to_role_policy(
             PolicyStatement(
@@ -183,44 +378,33 @@ class CodePipelineStack(Stack):
                     "lambda:AddPermission",
                     "lambda:RemovePermission",
                     "lambda:GetPolicy",
+                    "lambda:PublishVersion",
+                    "lambda:ListVersionsByFunction",
+                    "lambda:DeleteFunction",
+                    "lambda:GetAlias",
+                    "lambda:CreateAlias",
+                    "lambda:UpdateAlias",
+                    "lambda:InvokeFunction",
+                    "ecs:RegisterTaskDefinition",
+                    "ecs:DescribeTaskDefinition",
                     "iam:PassRole",
                     "codecommit:GitPull",
                     "codecommit:GetRepository",
                     "events:DescribeRule",
                     "events:PutRule",
                     "events:PutTargets",
+                    "events:DisableRule",
+                    "cloudwatch:PutDashboard",
+                    "cloudwatch:ListDashboards",
+                    "cloudwatch:DeleteDashboards",
+                    "cloudwatch:PutMetricAlarm",
+                    "cloudwatch:DescribeAlarms",
+                    "cloudwatch:DeleteAlarms",
                 ],
                 resources=["*"],
             )
         )
 
-        # Now define the Code Build action to run in the build stage
-        build_action = CodeBuildAction(
-            action_name=f"{project_name}-action",
-            input=aws_build_artifact,
-            project=build_project,
-            extra_inputs=[pipelines_artifact],
-            variables_namespace="BuildVariables",
-            environment_variables={},
-        )
-
-        # Define the pipeline
-        Pipeline(
-            self,
-            pipeline_name,
-            pipeline_name=pipeline_name,
-            cross_account_keys=False,
-            stages=[
-                StageProps(
-                    stage_name=f"{Env.BRANCH}-source",
-                    actions=[aws_build_source_action, pipelines_source_action],
-                ),
-                StageProps(
-                    stage_name=f"{deployment_name}-build", actions=[build_action]
-                ),
-            ],
-        )
-
     def create_buckets(self):
         input_bucket = s3.Bucket(
             self,
@@ -228,6 +412,8 @@ class CodePipelineStack(Stack):
             bucket_name=self.config.input_bucket_name,
             auto_delete_objects=True,  # Remove bucket when stack is destroyed
             removal_policy=RemovalPolicy.DESTROY,
+            # Send the bucket's events to EventBridge for the build's S3 rules
+            event_bridge_enabled=self.config.s3_routing == S3Routing.EventBridge,
         )
 
         output_bucket = s3.Bucket(
@@ -250,12 +436,19 @@ class CodePipelineStack(Stack):
 
         # TODO: can we add tags to the repo?
 
-    def create_lambda_role(self) -> str:
-        # Create an IAM role for Lambda execution
+    def create_lambda_role(
+        self, scheduler_role_arn: str, container_env: Dict[str, str]
+    ) -> str:
+        # Create an IAM role for Lambda execution.  The container tasks use it too.
+        principal = iam.ServicePrincipal("lambda.amazonaws.com")
+        if container_env:
+            principal = iam.CompositePrincipal(
+                principal, iam.ServicePrincipal("ecs-tasks.amazonaws.com")
+            )
         lambda_role = iam.Role(
             self,
             self.config.lambda_role_name,
-            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+            assumed_by=principal,
             description="IAM role for Lambda execution with access to S3 buckets.",
         )
 
@@ -278,5 +471,141 @@ class CodePipelineStack(Stack):
                 actions=["s3:*"],
             )
         )
+
+        # Let the lambdas schedule their own debounced runs (Upstream trigger)
+        lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                resources=[
+                    f"arn:aws:scheduler:{self.config.region}:{self.config.account_id}:schedule/default/*"
+                ],
+                actions=["scheduler:CreateSchedule"],
+            )
+        )
+        lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                resources=[scheduler_role_arn],
+                actions=["iam:PassRole"],
+            )
+        )
+
+        # Let the lambdas start the container tasks of their configs
+        if container_env:
+            lambda_role.add_to_policy(
+                iam.PolicyStatement(
+                    resources=[
+                        f"arn:aws:ecs:{self.config.region}:{self.config.account_id}:task-definition/{self.config.base_name}-task-*"
+                    ],
+                    actions=["ecs:RunTask"],
+                )
+            )
+            lambda_role.add_to_policy(
+                iam.PolicyStatement(
+                    resources=[
+                        lambda_role.role_arn,
+                        container_env["CONTAINER_EXECUTION_ROLE_ARN"],
+                    ],
+                    actions=["iam:PassRole"],
+                )
+            )
         # return the arn of the role
         return lambda_role.role_arn
+
+    def create_scheduler_role(self) -> str:
+        # Role assumed by the EventBridge Scheduler to invoke the pipeline lambdas
+        scheduler_role = iam.Role(
+            self,
+            f"{self.config.base_name}-SchedulerRole",
+            assumed_by=iam.ServicePrincipal("scheduler.amazonaws.com"),
+            description="IAM role for EventBridge Scheduler to invoke pipeline lambdas.",
+        )
+        lambda_arn_prefix = (
+            f"arn:aws:lambda:{self.config.region}:{self.config.account_id}:function:"
+            f"{self.config.base_name}-lambda-"
+        )
+        scheduler_role.add_to_policy(
+            iam.PolicyStatement(
+                resources=[f"{lambda_arn_prefix}*", f"{lambda_arn_prefix}*:*"],
+                actions=["lambda:InvokeFunction"],
+            )
+        )
+        return scheduler_role.role_arn
+
+    def create_alarm_topic(self) -> str:
+        # Topic the pipelines' CloudWatch alarms notify, with an optional email
+        # subscription from the monitoring section of pipelines_config.yml
+        topic = sns.Topic(
+            self,
+            f"{self.config.base_name}-AlarmTopic",
+            topic_name=self.config.alarm_topic_name,
+            display_name=f"{self.config.base_name} pipeline alarms",
+        )
+        topic.grant_publish(iam.ServicePrincipal("cloudwatch.amazonaws.com"))
+        if self.config.monitoring.alarm_email:
+            topic.add_subscription(
+                subscriptions.EmailSubscription(self.config.monitoring.alarm_email)
+            )
+        return topic.topic_arn
+
+    def create_container_resources(self) -> Dict[str, str]:
+        """Create the Fargate cluster, network, execution role and log group for the
+        configs with the container backend.  Returns the build environment variables
+        that pass them to the build (see Env)."""
+        base_name = self.config.base_name
+
+        # Public subnets only:  the tasks get public IPs to pull their image and
+        # reach S3, so there is no NAT gateway to pay for
+        vpc = ec2.Vpc(
+            self,
+            f"{base_name}-Vpc",
+            max_azs=2,
+            nat_gateways=0,
+            subnet_configuration=[
+                ec2.SubnetConfiguration(
+                    name="public", subnet_type=ec2.SubnetType.PUBLIC
+                )
+            ],
+        )
+        cluster = ecs.Cluster(
+            self,
+            f"{base_name}-Cluster",
+            cluster_name=self.config.container_cluster_name,
+            vpc=vpc,
+        )
+        security_group = ec2.SecurityGroup(
+            self,
+            f"{base_name}-TaskSecurityGroup",
+            vpc=vpc,
+            description="Outbound-only access for the pipeline container tasks.",
+            allow_all_outbound=True,
+        )
+
+        # Role ECS uses to pull the image and write the task logs
+        execution_role = iam.Role(
+            self,
+            f"{base_name}-TaskExecutionRole",
+            assumed_by=iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
+            description="IAM role for ECS to start the pipeline container tasks.",
+        )
+        execution_role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name(
+                "service-role/AmazonECSTaskExecutionRolePolicy"
+            )
+        )
+
+        log_group = logs.LogGroup(
+            self,
+            f"{base_name}-TaskLogGroup",
+            log_group_name=self.config.container_log_group_name,
+            retention=logs.RetentionDays.ONE_MONTH,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        return {
+            "CONTAINER_CLUSTER_ARN": cluster.cluster_arn,
+            "CONTAINER_SUBNET_IDS": Fn.join(
+                ",", [subnet.subnet_id for subnet in vpc.public_subnets]
+            ),
+            "CONTAINER_SECURITY_GROUP_ID": security_group.security_group_id,
+            "CONTAINER_EXECUTION_ROLE_ARN": execution_role.role_arn,
+            "CONTAINER_LOG_GROUP": log_group.log_group_name,
+        }
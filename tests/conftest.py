@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The build and the handler import build_utils from the root of the repo, and the
+# handler is imported as lambda_function (as it is in the image)
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "code_build", "docker"))
+
+os.environ.setdefault("BRANCH", "test")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
@@ -0,0 +1,125 @@
+import importlib
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from build_utils.debounce import DEBOUNCE_EVENT_SOURCE, LocalDebouncer
+
+CONFIG = """
+pipelines_repo_name: pipeline-template
+account_id: "123456789012"
+region: us-west-2
+input_bucket_name: test-input-bucket
+output_bucket_name: test-output-bucket
+
+pipelines:
+  - name: lidar_vap
+    type: VAP
+    trigger: Upstream
+    debounce_minutes: 5
+    consolidated: True
+    configs:
+      humboldt:
+        upstream_bucket_paths: [data/humboldt/]
+        config_file_path: pipelines/lidar_vap/config/pipeline_humboldt.yaml
+      morro:
+        upstream_bucket_paths: [data/morro/]
+        config_file_path: pipelines/lidar_vap/config/pipeline_morro.yaml
+"""
+
+FUNCTION_ARN = (
+    "arn:aws:lambda:us-west-2:123456789012:function:pipeline-template-test-lambda"
+    "-lidar_vap:live"
+)
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    """The handler of the consolidated lidar_vap lambda, with the local debouncer."""
+    config_path = tmp_path / "pipelines_config.yml"
+    config_path.write_text(CONFIG)
+    monkeypatch.setenv("PIPELINE_NAME", "lidar_vap")
+    monkeypatch.delenv("CONFIG_ID", raising=False)
+    monkeypatch.setenv("PIPELINES_CONFIG_PATH", str(config_path))
+    monkeypatch.setenv("TSDAT_SCRATCH_DIR", str(tmp_path / "scratch"))
+    monkeypatch.setenv("TSDAT_DEBOUNCE_BACKEND", "local")
+    monkeypatch.setenv("TSDAT_DEBOUNCE_PATH", str(tmp_path / "debounce.json"))
+
+    # The handler reads its pipeline from the environment when it is imported
+    sys.modules.pop("lambda_function", None)
+    lambda_function = importlib.import_module("lambda_function")
+
+    def get_pipeline():
+        raise RuntimeError("The tests don't run the pipeline")
+
+    monkeypatch.setattr(lambda_function, "get_pipeline", get_pipeline)
+    yield lambda_function.lambda_handler
+    sys.modules.pop("lambda_function", None)
+
+
+@pytest.fixture
+def debouncer(tmp_path) -> LocalDebouncer:
+    return LocalDebouncer(str(tmp_path / "debounce.json"))
+
+
+def get_context() -> SimpleNamespace:
+    return SimpleNamespace(
+        invoked_function_arn=FUNCTION_ARN,
+        aws_request_id="request-id",
+        function_name=FUNCTION_ARN.split(":")[6],
+    )
+
+
+def get_upstream_event(key: str) -> dict:
+    """An "Object Created" event of the output bucket, as EventBridge delivers it."""
+    return {
+        "version": "0",
+        "source": "aws.s3",
+        "detail-type": "Object Created",
+        "time": datetime.now(timezone.utc).isoformat(),
+        "detail": {
+            "bucket": {"name": "test-output-bucket"},
+            "object": {"key": key, "size": 1024},
+        },
+    }
+
+
+def test_burst_is_coalesced(handler, debouncer):
+    for i in range(5):
+        event = get_upstream_event(f"data/humboldt/lidar.b1.20230101.{i:06d}.nc")
+        assert handler(event, get_context()) == 0
+
+    (pending,) = debouncer.pending().values()
+    assert pending["requests"] == 5
+    assert pending["function_arn"] == FUNCTION_ARN
+    assert pending["event"]["source"] == DEBOUNCE_EVENT_SOURCE
+    assert pending["event"]["config_id"] == "humboldt"
+    delay = datetime.fromisoformat(pending["fire_at"]) - datetime.now(timezone.utc)
+    assert timedelta(minutes=4) < delay <= timedelta(minutes=5)
+
+
+def test_configs_are_debounced_separately(handler, debouncer):
+    for site in ("humboldt", "morro", "humboldt", "morro"):
+        event = get_upstream_event(f"data/{site}/lidar.b1.20230101.000000.nc")
+        assert handler(event, get_context()) == 0
+
+    pending = debouncer.pending().values()
+    assert sorted(p["event"]["config_id"] for p in pending) == ["humboldt", "morro"]
+    assert [p["requests"] for p in pending] == [2, 2]
+
+
+def test_debounced_run_opens_a_new_window(handler, debouncer):
+    event = get_upstream_event("data/humboldt/lidar.b1.20230101.000000.nc")
+    handler(event, get_context())
+    (pending,) = debouncer.pending().values()
+
+    # The debounced run completes its window before running the pipeline (which
+    # fails here), so writes during the run schedule another one
+    assert handler(pending["event"], get_context())
+    assert debouncer.pending() == {}
+
+    handler(event, get_context())
+    (pending,) = debouncer.pending().values()
+    assert pending["requests"] == 1
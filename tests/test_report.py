@@ -0,0 +1,55 @@
+from tools.report import build_report
+
+
+def get_context(**values) -> dict:
+    return {
+        "pipeline": "lidar",
+        "config_id": "humboldt",
+        "success": True,
+        "inputs": ["lidar/humboldt/a.sta"],
+        "code_version": "v1",
+        "start_time": "2026-01-01T00:00:00+00:00",
+        "duration_s": 10.0,
+        "memory_mb": 1024,
+        "backend": "lambda",
+        **values,
+    }
+
+
+def test_warmups_are_reported_on_their_own():
+    contexts = [get_context(), get_context(duration_s=20.0)] + [
+        get_context(warmup=True, inputs=[], duration_s=30.0) for _ in range(5)
+    ]
+    summary = build_report(contexts, 1.0, 0.2)["lidar/humboldt"]
+    assert summary["invocations"] == 2
+    assert summary["duration_s"]["max"] == 20.0
+    assert summary["gb_seconds"] == 30.0
+    assert summary["other"]["warmup"]["invocations"] == 5
+    assert summary["other"]["warmup"]["gb_seconds"] == 150.0
+
+
+def test_container_runs_are_not_priced_as_lambda():
+    contexts = [
+        # The lambda that only started the task, and the task's run
+        get_context(task={"task_arn": "arn"}, inputs=[], duration_s=0.5),
+        get_context(backend="container", memory_mb=16384, duration_s=3600.0),
+        get_context(),
+    ]
+    summary = build_report(contexts, 1.0, 0.2)["lidar/humboldt"]
+    assert summary["invocations"] == 2
+    assert summary["inputs"]["total"] == 2
+    assert summary["gb_seconds"] == 10.0
+    assert summary["container_task_s"] == 3600.0
+    assert summary["other"]["task_start"]["invocations"] == 1
+
+
+def test_debounce_requests_are_reported_on_their_own():
+    contexts = [
+        get_context(debounce_scheduled=i == 0, inputs=[], duration_s=0.1)
+        for i in range(20)
+    ] + [get_context(source="tsdat.debounce", inputs=["a", "b", "c"])]
+    summary = build_report(contexts, 1.0, 0.2)["lidar/humboldt"]
+    assert summary["invocations"] == 1
+    assert summary["duration_s"]["p50"] == 10.0
+    assert summary["inputs"]["mean"] == 3
+    assert summary["other"]["debounce"]["invocations"] == 20
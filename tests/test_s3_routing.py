@@ -0,0 +1,198 @@
+import json
+
+import pytest
+
+moto = pytest.importorskip("moto")
+
+import boto3  # noqa: E402
+
+from build_utils.constants import S3Routing  # noqa: E402
+from build_utils.pipelines_config import PipelinesConfig  # noqa: E402
+
+CONFIG = """
+pipelines_repo_name: pipeline-template
+account_id: "123456789012"
+region: us-west-2
+input_bucket_name: test-input-bucket
+output_bucket_name: test-output-bucket
+s3_routing: {routing}
+
+pipelines:
+  - name: lidar
+    type: Ingest
+    trigger: S3
+    configs:
+      humboldt:
+        input_bucket_path: lidar/humboldt/
+        input_suffixes: [.txt]
+        config_file_path: pipelines/lidar/config/pipeline_humboldt.yaml
+      z06:
+        input_bucket_path: lidar/
+        input_suffixes: [.sta, .sta.7z, .txt]
+        input_regex: z06
+        config_file_path: pipelines/lidar/config/pipeline_z06.yaml
+"""
+
+
+@pytest.fixture
+def make_build(tmp_path, monkeypatch):
+    """Make a TsdatPipelineBuild of the test config with the given s3_routing, with
+    the buckets and lambdas it routes to."""
+    import code_build.build as build_module
+
+    with moto.mock_aws():
+        region = "us-west-2"
+        s3 = boto3.client("s3", region_name=region)
+        for bucket in ("test-input-bucket", "test-output-bucket"):
+            s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": region},
+            )
+        role = boto3.client("iam", region_name=region).create_role(
+            RoleName="lambda-role", AssumeRolePolicyDocument="{}"
+        )["Role"]["Arn"]
+        functions = set()
+
+        def make(routing: str):
+            path = tmp_path / f"{routing}.yml"
+            path.write_text(CONFIG.format(routing=routing))
+            monkeypatch.setattr(
+                build_module, "PipelinesConfig", lambda: PipelinesConfig(str(path))
+            )
+            build = build_module.TsdatPipelineBuild()
+            for pipeline in build.config.pipelines.values():
+                for config_id in pipeline.configs:
+                    name = build.config.get_function_name(pipeline.name, config_id)
+                    if name not in functions:
+                        build.lambda_client.create_function(
+                            FunctionName=name,
+                            Runtime="python3.11",
+                            Role=role,
+                            Handler="lambda_function.lambda_handler",
+                            Code={"ZipFile": b"code"},
+                        )
+                        functions.add(name)
+            return build
+
+        yield make
+
+
+def get_notifications(build) -> dict:
+    return build.s3_client.get_bucket_notification_configuration(
+        Bucket=build.config.input_bucket_name
+    )
+
+
+def get_rule_states(build) -> dict:
+    rules = build.events_client.list_rules(NamePrefix=build.config.base_name)
+    return {rule["Name"]: rule["State"] for rule in rules["Rules"]}
+
+
+def get_s3_event(bucket: str, key: str) -> dict:
+    return {
+        "source": "aws.s3",
+        "detail-type": "Object Created",
+        "detail": {"bucket": {"name": bucket}, "object": {"key": key}},
+    }
+
+
+def test_switch_routing(make_build):
+    build = make_build(S3Routing.Notifications)
+    build.add_or_update_s3_triggers()
+    ids = {
+        function["Id"]
+        for function in get_notifications(build)["LambdaFunctionConfigurations"]
+    }
+    assert ids == {
+        build.config.get_bucket_notification_id("lidar", "humboldt"),
+        build.config.get_bucket_notification_id("lidar", "z06"),
+    }
+    assert get_rule_states(build) == {}
+
+    build = make_build(S3Routing.EventBridge)
+    build.add_or_update_s3_triggers()
+    # (moto doesn't return the EventBridgeConfiguration, so it isn't checked)
+    assert not get_notifications(build).get("LambdaFunctionConfigurations")
+    assert get_rule_states(build) == {
+        build.config.get_s3_rule_name("lidar", "humboldt"): "ENABLED",
+        build.config.get_s3_rule_name("lidar", "z06"): "ENABLED",
+    }
+
+    build = make_build(S3Routing.Notifications)
+    build.add_or_update_s3_triggers()
+    assert len(get_notifications(build)["LambdaFunctionConfigurations"]) == 2
+    assert set(get_rule_states(build).values()) == {"DISABLED"}
+
+
+def test_input_transformer(make_build):
+    build = make_build(S3Routing.EventBridge)
+    build.add_or_update_s3_triggers()
+    rule_name = build.config.get_s3_rule_name("lidar", "z06")
+    (target,) = build.events_client.list_targets_by_rule(Rule=rule_name)["Targets"]
+    transformer = target["InputTransformer"]
+    assert transformer["InputPathsMap"]["size"] == "$.detail.object.size"
+
+    # EventBridge puts the values in as they are:  the strings go in quoted
+    # placeholders, but the size is a number, so its placeholder must not be quoted
+    template = transformer["InputTemplate"]
+    assert '"size": <size>' in template
+    event = json.loads(
+        template.replace("<bucket>", "test-input-bucket")
+        .replace("<key>", "lidar/a.z06.sta")
+        .replace("<size>", "1024")
+    )
+    assert event["config_id"] == "z06"
+    assert event["detail"]["object"] == {"key": "lidar/a.z06.sta", "size": 1024}
+
+
+@pytest.mark.parametrize(
+    "key, delivered, run",
+    [
+        ("lidar/humboldt/a.z06.txt", {"humboldt", "z06"}, {"humboldt", "z06"}),
+        ("lidar/humboldt/a.z06.sta", {"z06"}, {"z06"}),
+        # The rules can't filter on the regex, so the lambda skips these
+        ("lidar/humboldt/a.txt", {"humboldt", "z06"}, {"humboldt"}),
+        ("lidar/morro/a.z07.sta", {"z06"}, set()),
+        ("lidar/morro/a.z06.dat", set(), set()),
+    ],
+)
+def test_fan_out(make_build, key, delivered, run):
+    from moto.events.models import EventPattern
+
+    build = make_build(S3Routing.EventBridge)
+    build.add_or_update_s3_triggers()
+    event = get_s3_event(build.config.input_bucket_name, key)
+    pipeline = build.config.pipelines["lidar"]
+    matched = set()
+    for config_id in pipeline.configs:
+        rule = build.events_client.describe_rule(
+            Name=build.config.get_s3_rule_name("lidar", config_id)
+        )
+        if EventPattern.load(rule["EventPattern"]).matches_event(event):
+            matched.add(config_id)
+    assert matched == delivered
+    assert {
+        config_id
+        for config_id in matched
+        if pipeline.configs[config_id].get_skip_reason(key, None) is None
+    } == run
+
+
+@pytest.mark.parametrize(
+    "key, config_id",
+    [
+        ("lidar/humboldt/a.txt", "humboldt"),
+        ("lidar/humboldt/a.z06.txt", "humboldt"),
+        # The longer prefix's config doesn't take keys that only the other matches
+        ("lidar/humboldt/a.z06.sta", "z06"),
+        ("lidar/morro/a.z06.sta", "z06"),
+        # Matches no filters:  goes to the longest prefix to be skipped there
+        ("lidar/morro/a.txt", "z06"),
+        ("other/a.z06.sta", None),
+    ],
+)
+def test_find_run_config(tmp_path, key, config_id):
+    path = tmp_path / "pipelines_config.yml"
+    path.write_text(CONFIG.format(routing=S3Routing.EventBridge))
+    run_config = PipelinesConfig(str(path)).pipelines["lidar"].find_run_config(key)
+    assert (run_config.id if run_config else None) == config_id
@@ -0,0 +1,68 @@
+from datetime import datetime
+
+import pytest
+
+from build_utils.schedules import (
+    CronExpression,
+    get_offset_capacity,
+    get_schedule_expression,
+    get_window,
+    shift_cron_expression,
+)
+
+SCHEDULES = [
+    "Hourly",
+    "Daily",
+    "Weekly",
+    "Monthly",
+    "every 15 minutes",
+    "every 6 hours",
+]
+
+# Times around the ends of a day, week, month and year
+TIMES = [
+    datetime(2026, 3, 1, 3, 0),
+    datetime(2026, 3, 1, 2, 59),
+    datetime(2026, 1, 4, 2, 30),
+    datetime(2026, 12, 31, 23, 59),
+    datetime(2027, 1, 1, 0, 0),
+    datetime(2026, 6, 17, 11, 44),
+]
+
+
+@pytest.mark.parametrize(
+    "expression, minutes, shifted",
+    [
+        ("cron(0 0/1 * * ? *)", 7, "cron(7 0/1 * * ? *)"),
+        ("cron(0/15 * * * ? *)", 14, "cron(14/15 * * * ? *)"),
+        ("cron(0 0/6 * * ? *)", 75, "cron(15 1/6 * * ? *)"),
+        ("cron(30 2 ? * 1 *)", 45, "cron(15 3 ? * 1 *)"),
+        ("cron(0 3 1 * ? *)", 0, "cron(0 3 1 * ? *)"),
+    ],
+)
+def test_shift_cron_expression(expression, minutes, shifted):
+    assert shift_cron_expression(expression, minutes) == shifted
+
+
+def test_shift_beyond_capacity():
+    expression = get_schedule_expression("Hourly")
+    assert get_offset_capacity(expression) == 59
+    with pytest.raises(ValueError):
+        shift_cron_expression(expression, 60)
+
+
+@pytest.mark.parametrize("schedule", SCHEDULES)
+@pytest.mark.parametrize("offset", [1, 13, "max"])
+@pytest.mark.parametrize("now", TIMES)
+def test_shifted_rule_processes_the_scheduled_window(schedule, offset, now):
+    expression = get_schedule_expression(schedule)
+    capacity = get_offset_capacity(expression)
+    offset = capacity if offset == "max" else min(offset, capacity)
+    shifted = CronExpression(shift_cron_expression(expression, offset))
+
+    # The shifted rule fires `offset` minutes after each scheduled time, and its run
+    # processes the same window as a run at the scheduled time would
+    fired = shifted.previous(now)
+    scheduled = CronExpression(expression).previous(fired)
+    assert (fired - scheduled).total_seconds() == offset * 60
+    assert get_window(schedule, None, fired) == get_window(schedule, None, scheduled)
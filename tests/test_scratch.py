@@ -0,0 +1,56 @@
+import os
+import subprocess
+
+from build_utils.scratch import PROCESS_TOKEN, ScratchManager
+
+
+def wait_for_cleanup(manager: ScratchManager):
+    if manager._cleanup is not None:
+        manager._cleanup.join()
+
+
+def test_new_dir_removes_own_earlier_dirs(tmp_path):
+    manager = ScratchManager(tmp_path)
+    first = manager.new_dir()
+    second = manager.new_dir()
+    wait_for_cleanup(manager)
+    assert not first.exists()
+    assert second.exists()
+    assert manager.get_stats()["cleaned_dirs"] == 1
+
+
+def test_new_dir_keeps_dirs_in_use(tmp_path):
+    # E.g., the local workers of tools.reprocess on a shared root
+    first, second = ScratchManager(tmp_path), ScratchManager(tmp_path)
+    first_dir = first.new_dir()
+    second.new_dir()
+    wait_for_cleanup(second)
+    assert first_dir.exists()
+
+    with subprocess.Popen(["sleep", "30"]) as other:
+        other_dir = tmp_path / f"run-{other.pid}-{PROCESS_TOKEN}-live"
+        other_dir.mkdir()
+        first.new_dir()
+        wait_for_cleanup(first)
+        assert other_dir.exists()
+        other.kill()
+
+
+def test_new_dir_removes_dirs_of_exited_processes(tmp_path):
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    orphans = [
+        tmp_path / f"run-{exited.pid}-{PROCESS_TOKEN}-dead",
+        # An earlier process with this process's pid (e.g., a restarted runtime)
+        tmp_path / f"run-{os.getpid()}-00000000-restarted",
+    ]
+    for orphan in orphans:
+        orphan.mkdir()
+    unrelated = tmp_path / "worker-1"
+    unrelated.mkdir()
+
+    manager = ScratchManager(tmp_path)
+    manager.new_dir()
+    wait_for_cleanup(manager)
+    assert not any(orphan.exists() for orphan in orphans)
+    assert unrelated.exists()
@@ -0,0 +1,132 @@
+import pytest
+import yaml
+
+from build_utils.pipelines_config import PipelinesConfig
+from build_utils.stagger import plan_cron_offsets
+
+
+def make_config(tmp_path, pipelines, stagger=None) -> PipelinesConfig:
+    config = {
+        "pipelines_repo_name": "pipeline-template",
+        "account_id": "123456789012",
+        "region": "us-west-2",
+        "stagger": stagger or {},
+        "pipelines": [
+            {
+                "type": "VAP",
+                "trigger": "Cron",
+                "schedule": "Hourly",
+                "configs": {"humboldt": {}, "morro": {}},
+                **pipeline,
+            }
+            for pipeline in pipelines
+        ],
+    }
+    path = tmp_path / "pipelines_config.yml"
+    path.write_text(yaml.safe_dump(config))
+    return PipelinesConfig(str(path))
+
+
+PIPELINES = [
+    {"name": "lidar_vap", "estimated_duration_minutes": 3},
+    {"name": "buoy_vap", "estimated_duration_minutes": 2},
+    {"name": "met_vap", "schedule": "Daily", "estimated_duration_minutes": 20},
+    {"name": "wave_vap", "schedule": "every 15 minutes"},
+]
+
+
+def test_offsets_are_stable(tmp_path):
+    offsets = plan_cron_offsets(make_config(tmp_path, PIPELINES))
+    assert offsets == plan_cron_offsets(make_config(tmp_path, PIPELINES))
+    assert offsets == plan_cron_offsets(make_config(tmp_path, PIPELINES[::-1]))
+
+    # Runs with the same schedule are spread out
+    hourly = [offsets[("lidar_vap", c)] for c in ("humboldt", "morro")]
+    hourly += [offsets[("buoy_vap", c)] for c in ("humboldt", "morro")]
+    assert len(set(hourly)) == len(hourly)
+
+
+def test_depends_on(tmp_path):
+    pipelines = [
+        {"name": "report", "depends_on": ["lidar_summary"]},
+        {
+            "name": "lidar_summary",
+            "estimated_duration_minutes": 2,
+            "depends_on": ["lidar_vap"],
+        },
+        {"name": "lidar_vap", "estimated_duration_minutes": 4},
+    ]
+    pipelines = [{**pipeline, "schedule": "Daily"} for pipeline in pipelines]
+    offsets = plan_cron_offsets(make_config(tmp_path, pipelines))
+    for config_id in ("humboldt", "morro"):
+        vap_end = max(offsets[("lidar_vap", c)] + 4 for c in ("humboldt", "morro"))
+        assert offsets[("lidar_summary", config_id)] >= vap_end
+        summary_end = max(
+            offsets[("lidar_summary", c)] + 2 for c in ("humboldt", "morro")
+        )
+        assert offsets[("report", config_id)] >= summary_end
+
+
+def test_depends_on_errors(tmp_path):
+    with pytest.raises(ValueError, match="unknown"):
+        plan_cron_offsets(
+            make_config(tmp_path, [{"name": "a", "depends_on": ["missing"]}])
+        )
+    with pytest.raises(ValueError, match="cycle"):
+        plan_cron_offsets(
+            make_config(
+                tmp_path,
+                [
+                    {"name": "a", "depends_on": ["b"]},
+                    {"name": "b", "depends_on": ["a"]},
+                ],
+            )
+        )
+
+
+@pytest.mark.parametrize(
+    "stagger, schedule, max_offset",
+    [
+        # A quarter of the period by default
+        ({}, "Hourly", 15),
+        ({}, "every 15 minutes", 3),
+        ({"max_offset_minutes": 5}, "Hourly", 5),
+        ({"max_offset_fraction": 0.5}, "Daily", 60),
+    ],
+)
+def test_max_offset(tmp_path, stagger, schedule, max_offset):
+    pipelines = [
+        {"name": f"vap{i}", "schedule": schedule, "estimated_duration_minutes": 30}
+        for i in range(10)
+    ]
+    offsets = plan_cron_offsets(make_config(tmp_path, pipelines, stagger))
+    assert max(offsets.values()) == max_offset
+    assert min(offsets.values()) >= 0
+
+
+def test_max_offset_clamps_dependents(tmp_path, capsys):
+    pipelines = [
+        {"name": "slow_vap", "estimated_duration_minutes": 40},
+        {"name": "summary", "depends_on": ["slow_vap"]},
+    ]
+    offsets = plan_cron_offsets(make_config(tmp_path, pipelines))
+    # Can't wait the 40 minutes within the hour's 15 minute limit
+    assert offsets[("summary", "humboldt")] == 15
+    assert "before the pipelines it depends on" in capsys.readouterr().out
+
+
+def test_pinned_offsets(tmp_path):
+    pipelines = [{"name": "vap", "schedule_offset_minutes": 42}]
+    offsets = plan_cron_offsets(make_config(tmp_path, pipelines))
+    assert set(offsets.values()) == {42}
+    offsets = plan_cron_offsets(make_config(tmp_path, pipelines, {"enabled": False}))
+    assert set(offsets.values()) == {42}
+
+    pipelines = [{"name": "vap", "schedule_offset_minutes": 60}]
+    with pytest.raises(ValueError, match="schedule_offset_minutes"):
+        plan_cron_offsets(make_config(tmp_path, pipelines))
+
+
+def test_disabled(tmp_path):
+    offsets = plan_cron_offsets(make_config(tmp_path, PIPELINES, {"enabled": False}))
+    assert set(offsets.values()) == {0}
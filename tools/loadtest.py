@@ -0,0 +1,583 @@
+"""Measure how many raw files per minute an ingest can sustain.
+
+Uploads bursts of synthetic raw files under a run config's `input_bucket_path` and,
+as each upload finishes, sends the pipeline an S3 event for it, either by invoking
+the deployed lambda function or by running the lambda handler in local worker
+processes.  At most --concurrency events are in flight; events that don't fit wait
+in a queue, like S3 events waiting for a throttled lambda.  The report has the
+sustained throughput, percentiles of the queue, run and end-to-end latencies, and
+the failures by kind (throttled, timeout, function_error, pipeline_failed, ...).
+
+The files are copies of a real raw file (--template or --template-key), so the
+pipeline can read them, or random bytes (--file-size) to only load the path up to
+the reader.
+
+Examples:
+
+    # Against the local S3 stand-in (docker compose --profile loadtest up -d s3),
+    # with 4 local workers in the environment of the pipelines repo
+    AWS_ENDPOINT_URL=http://localhost:5000 BRANCH=dev python -m tools.loadtest \\
+        lidar humboldt --target local --workers 4 --pipelines-repo ../pipeline-template \\
+        --create-buckets --template lidar.z05.00.20230101.000000.sta \\
+        --bursts 3 --burst-size 50 --interval 60
+
+    # Against the deployed dev lambda, 200 files per minute for 10 minutes
+    BRANCH=dev python -m tools.loadtest lidar humboldt --template-key \\
+        lidar/humboldt/lidar.z05.00.20230101.000000.sta \\
+        --bursts 10 --burst-size 200 --interval 60 --concurrency 100
+
+The files are uploaded under loadtest/{run id}/ (see --prefix), which no trigger
+watches, so each file is only processed by the event the tool sends.  The tool
+refuses prefixes that one of the bucket's triggers watches, since every file would
+also be processed by the trigger.  The files are deleted afterwards unless
+--keep-files is given.
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import boto3
+from botocore.config import Config
+
+from build_utils.constants import S3Routing, Trigger
+from build_utils.pipelines_config import PipelinesConfig
+from tools.reprocess import (
+    RateLimiter,
+    Target,
+    _init_local_worker,
+    get_qualifier,
+    invoke_lambda,
+    invoke_local,
+    percentile,
+)
+
+DEFAULT_NAME_TEMPLATE = "loadtest.{time:%Y%m%d.%H%M%S}.{burst:03d}{index:05d}{suffix}"
+
+
+class SyntheticFile:
+    def __init__(self, burst: int, key: str, size: int):
+        self.burst = burst
+        self.key = key
+        self.size = size
+        self.etag = ""
+        self.uploaded: float = 0.0  # monotonic time the upload finished
+        self.started: float = 0.0  # ... the event was sent
+        self.finished: float = 0.0  # ... the pipeline returned
+        self.error: Optional[str] = None
+
+
+def make_event(bucket: str, file: SyntheticFile, shape: str, config_id: str) -> Dict:
+    """Make the event S3 would send for the upload:  a bucket notification, or the
+    "Object Created" event the build's EventBridge rules pass on (with the config
+    id they add).  Notifications also get the config id, since the file isn't under
+    the config's input_bucket_path for a consolidated lambda to find it by."""
+    now = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+    if shape == S3Routing.EventBridge:
+        return {
+            "source": "aws.s3",
+            "detail-type": "Object Created",
+            "config_id": config_id,
+            "detail": {
+                "bucket": {"name": bucket},
+                "object": {"key": file.key, "size": file.size},
+            },
+        }
+    return {
+        "config_id": config_id,
+        "Records": [
+            {
+                "eventVersion": "2.1",
+                "eventSource": "aws:s3",
+                "eventTime": now,
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "s3SchemaVersion": "1.0",
+                    "bucket": {"name": bucket, "arn": f"arn:aws:s3:::{bucket}"},
+                    "object": {
+                        "key": file.key,
+                        "size": file.size,
+                        "eTag": file.etag,
+                        "sequencer": f"{time.time_ns():X}",
+                    },
+                },
+            }
+        ],
+    }
+
+
+def classify(error: Optional[str]) -> str:
+    """The kind of failure of an invocation, from its error message."""
+    if error is None:
+        return "ok"
+    if "TooManyRequestsException" in error:
+        return "throttled"
+    if "timed out" in error.lower() or "ReadTimeout" in error:
+        return "timeout"
+    if error.startswith("Pipeline failed"):
+        return "pipeline_failed"
+    if error.startswith(("Unhandled", "Handled")):
+        return "function_error"
+    return error.split(":", 1)[0]
+
+
+def get_suffix(args: argparse.Namespace, input_suffixes: List[str]) -> str:
+    # Keep the template's extension (or the input suffix it matches, e.g., .sta.7z)
+    # so that the files pass the config's filters and the pipeline's readers match
+    name = Path(args.template or args.template_key or "").name
+    matches = [suffix for suffix in input_suffixes if name.endswith(suffix)]
+    if matches:
+        return max(matches, key=len)
+    if Path(name).suffix:
+        return Path(name).suffix
+    return input_suffixes[0] if input_suffixes else ".dat"
+
+
+def get_trigger(config: PipelinesConfig, bucket: str, prefix: str) -> Optional[str]:
+    """The trigger (pipeline/config) that watches the prefix of the bucket, if any:
+    S3 triggers watch input_bucket_paths of the input bucket, and Upstream triggers
+    upstream_bucket_paths of the output bucket."""
+    for pipeline in config.pipelines.values():
+        for run_config in pipeline.configs.values():
+            if pipeline.trigger == Trigger.S3 and bucket == config.input_bucket_name:
+                paths = [run_config.input_bucket_path or ""]
+            elif (
+                pipeline.trigger == Trigger.Upstream
+                and bucket == config.output_bucket_name
+            ):
+                paths = run_config.upstream_bucket_paths
+            else:
+                continue
+            if any(prefix.startswith(path) for path in paths):
+                return f"{pipeline.name}/{run_config.id}"
+    return None
+
+
+def summarize(files: List[SyntheticFile], started: float) -> Dict[str, Any]:
+    done = [f for f in files if f.finished]
+    invoked = [f for f in done if f.started]
+    ok = [f for f in done if f.error is None]
+    failures: Dict[str, int] = {}
+    examples: Dict[str, str] = {}
+    for f in done:
+        kind = classify(f.error)
+        if kind != "ok":
+            failures[kind] = failures.get(kind, 0) + 1
+            examples.setdefault(kind, f.error or "")
+
+    def latencies(values: List[float]) -> Dict[str, float]:
+        return {
+            "p50": round(percentile(values, 0.5), 2),
+            "p90": round(percentile(values, 0.9), 2),
+            "p95": round(percentile(values, 0.95), 2),
+            "p99": round(percentile(values, 0.99), 2),
+            "max": round(max(values, default=0), 2),
+        }
+
+    elapsed = max((f.finished for f in done), default=started) - started
+    # Most successful files finished in any minute of the run
+    finish_times = sorted(f.finished for f in ok)
+    peak_per_min, first = 0, 0
+    for last, finished in enumerate(finish_times):
+        while finished - finish_times[first] > 60:
+            first += 1
+        peak_per_min = max(peak_per_min, last - first + 1)
+
+    return {
+        "files": len(done),
+        "succeeded": len(ok),
+        "failed": len(done) - len(ok),
+        "failures": failures,
+        "failure_examples": {kind: error[:300] for kind, error in examples.items()},
+        "elapsed_s": round(elapsed, 1),
+        "files_per_min": round(len(ok) / elapsed * 60, 1) if elapsed else 0,
+        "peak_files_per_min": peak_per_min,
+        "mb_per_min": (
+            round(sum(f.size for f in ok) / 1e6 / elapsed * 60, 2) if elapsed else 0
+        ),
+        # Upload finished -> event sent (waiting for a free slot)
+        "queue_s": latencies([f.started - f.uploaded for f in invoked]),
+        # Event sent -> pipeline returned
+        "run_s": latencies([f.finished - f.started for f in invoked]),
+        # Upload finished -> pipeline returned
+        "end_to_end_s": latencies([f.finished - f.uploaded for f in invoked]),
+    }
+
+
+def loadtest(args: argparse.Namespace) -> int:
+    config = PipelinesConfig()
+    pipeline_config = config.pipelines[args.pipeline]
+    run_config = pipeline_config.configs[args.config_id]
+    bucket = args.bucket or config.input_bucket_name
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S-") + uuid.uuid4().hex[:6]
+    prefix = (args.prefix or f"loadtest/{run_id}").rstrip("/") + "/"
+    shape = args.event_shape or config.s3_routing
+    endpoint = os.environ.get("AWS_ENDPOINT_URL")
+
+    # The local stand-in has no triggers
+    trigger = None if endpoint else get_trigger(config, bucket, prefix)
+    if trigger:
+        raise SystemExit(
+            f"s3://{bucket}/{prefix} is watched by the trigger of {trigger}, which"
+            " would process every file a second time.  Use a --prefix no trigger"
+            " watches."
+        )
+
+    s3_client = boto3.client(
+        "s3",
+        region_name=config.region,
+        config=Config(max_pool_connections=args.upload_concurrency),
+    )
+    if args.create_buckets:
+        # For the local S3 stand-in:  the handler also writes to the output bucket
+        for name in {bucket, config.output_bucket_name}:
+            try:
+                s3_client.create_bucket(
+                    Bucket=name,
+                    CreateBucketConfiguration={"LocationConstraint": config.region},
+                )
+            except s3_client.exceptions.BucketAlreadyOwnedByYou:
+                pass
+
+    body: Optional[bytes] = None
+    if args.template:
+        body = Path(args.template).read_bytes()
+    elif not args.template_key:
+        body = os.urandom(args.file_size)
+    size = (
+        len(body)
+        if body is not None
+        else s3_client.head_object(Bucket=bucket, Key=args.template_key)[
+            "ContentLength"
+        ]
+    )
+    suffix = get_suffix(args, run_config.input_suffixes)
+    data_time = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def make_key(burst: int, index: int) -> str:
+        file_time = data_time + timedelta(
+            seconds=(burst * args.burst_size + index) * args.file_interval
+        )
+        return prefix + args.name_template.format(
+            time=file_time, burst=burst, index=index, suffix=suffix
+        )
+
+    # The handler would skip every file without running the pipeline
+    skip_reason = run_config.get_skip_reason(make_key(0, 0), size)
+    if skip_reason:
+        raise SystemExit(
+            f"The config's input filters skip the files ({skip_reason}):  change"
+            " --name-template, --prefix or the file size"
+        )
+
+    print(
+        f"Sending {args.bursts} bursts of {args.burst_size} files ({size} bytes) to"
+        f" {args.target} every {args.interval}s, as {shape} events with up to"
+        f" {args.concurrency if args.target == Target.Lambda else args.workers} in"
+        f" flight.  Files go to s3://{bucket}/{prefix}"
+        f"{f' via {endpoint}' if endpoint else ''}."
+    )
+
+    executor: Executor
+    if args.target == Target.Lambda:
+        function_name = args.function_name or config.get_function_name(
+            args.pipeline, args.config_id
+        )
+        lambda_client = boto3.client(
+            "lambda",
+            region_name=config.region,
+            # Throttles are a result here, so they aren't retried
+            config=Config(
+                read_timeout=960,
+                retries={"max_attempts": 0},
+                max_pool_connections=args.concurrency,
+            ),
+        )
+        qualifier = args.qualifier or get_qualifier(pipeline_config)
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        max_in_flight = args.concurrency
+
+        def submit(event: Dict) -> Future:
+            return executor.submit(
+                invoke_lambda, lambda_client, function_name, event, qualifier
+            )
+
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=_init_local_worker,
+            initargs=(args.pipeline, args.config_id, args.pipelines_repo),
+        )
+        max_in_flight = args.workers
+
+        def submit(event: Dict) -> Future:
+            return executor.submit(invoke_local, event)
+
+    files: List[SyntheticFile] = []
+    uploaded: "queue.Queue[SyntheticFile]" = queue.Queue()
+
+    def upload(file: SyntheticFile):
+        try:
+            if body is not None:
+                response = s3_client.put_object(Bucket=bucket, Key=file.key, Body=body)
+                file.etag = response["ETag"].strip('"')
+            else:
+                s3_client.copy_object(
+                    Bucket=bucket,
+                    Key=file.key,
+                    CopySource={"Bucket": bucket, "Key": args.template_key},
+                )
+        except Exception as e:
+            # Reported as a failure without an invocation
+            file.error = f"UploadError: {e}"
+            file.finished = time.monotonic()
+        file.uploaded = time.monotonic()
+        uploaded.put(file)
+
+    def send_bursts(uploader: ThreadPoolExecutor):
+        # Open loop:  bursts start on schedule, however far behind the pipeline is
+        for burst in range(args.bursts):
+            if stopped.is_set():
+                return
+            burst_started = time.monotonic()
+            for index in range(args.burst_size):
+                file = SyntheticFile(burst, make_key(burst, index), size)
+                files.append(file)
+                uploader.submit(upload, file)
+            if burst < args.bursts - 1:
+                stopped.wait(max(0.0, burst_started + args.interval - time.monotonic()))
+
+    stopped = threading.Event()
+    limiter = RateLimiter(args.rate)
+    in_flight: Dict[Future, SyntheticFile] = {}
+    total = args.bursts * args.burst_size
+    started = time.monotonic()
+
+    def collect(block: bool):
+        if not in_flight:
+            return
+        finished, _ = wait(
+            list(in_flight), timeout=None if block else 0, return_when=FIRST_COMPLETED
+        )
+        for future in finished:
+            file = in_flight.pop(future)
+            file.finished = time.monotonic()
+            try:
+                file.error = future.result()
+            except Exception as e:
+                file.error = f"{type(e).__name__}: {e}"
+
+    sent = handled = 0
+    with ThreadPoolExecutor(max_workers=args.upload_concurrency) as uploader, executor:
+        scheduler = threading.Thread(target=send_bursts, args=(uploader,), daemon=True)
+        scheduler.start()
+        try:
+            while handled < total:
+                try:
+                    file = uploaded.get(timeout=1)
+                except queue.Empty:
+                    collect(block=False)
+                    continue
+                handled += 1
+                if file.error:
+                    continue
+                while len(in_flight) >= max_in_flight:
+                    collect(block=True)
+                limiter.wait()
+                file.started = time.monotonic()
+                event = make_event(bucket, file, shape, args.config_id)
+                in_flight[submit(event)] = file
+                sent += 1
+                collect(block=False)
+                if sent % 100 == 0:
+                    print(f"Sent {sent}/{total} events, {len(in_flight)} in flight")
+            while in_flight:
+                collect(block=True)
+        except KeyboardInterrupt:
+            print("Interrupted: waiting for running invocations to finish...")
+            stopped.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            collect(block=False)
+        scheduler.join()
+
+    report = summarize(files, started)
+    if args.per_burst:
+        # Throughput of each burst from its first upload
+        report["bursts"] = []
+        for burst in range(args.bursts):
+            burst_files = [f for f in files if f.burst == burst and f.uploaded]
+            burst_started = min((f.uploaded for f in burst_files), default=started)
+            report["bursts"].append(
+                {"burst": burst, **summarize(burst_files, burst_started)}
+            )
+    report.update(
+        {
+            "target": args.target,
+            "event_shape": shape,
+            "max_in_flight": max_in_flight,
+            "file_size": size,
+            "prefix": f"s3://{bucket}/{prefix}",
+        }
+    )
+
+    if args.results:
+        with open(args.results, "w") as output:
+            for f in files:
+                record = {
+                    "key": f.key,
+                    "burst": f.burst,
+                    "status": classify(f.error) if f.finished else "not_sent",
+                    "queue_s": round(f.started - f.uploaded, 3) if f.started else None,
+                    "run_s": round(f.finished - f.started, 3) if f.finished else None,
+                    "error": f.error,
+                }
+                output.write(json.dumps(record) + "\n")
+
+    if not args.keep_files:
+        keys = [{"Key": f.key} for f in files if f.uploaded]
+        for i in range(0, len(keys), 1000):
+            s3_client.delete_objects(
+                Bucket=bucket, Delete={"Objects": keys[i : i + 1000], "Quiet": True}
+            )
+
+    print(json.dumps(report, indent=2))
+    return 1 if report["failed"] or report["files"] < total else 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.loadtest",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("pipeline", help="pipeline name in pipelines_config.yml")
+    parser.add_argument("config_id", help="run config id of the pipeline")
+
+    load = parser.add_argument_group("load")
+    load.add_argument(
+        "--bursts", type=int, default=1, help="number of bursts (default 1)"
+    )
+    load.add_argument(
+        "--burst-size", type=int, default=20, help="files per burst (default 20)"
+    )
+    load.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="seconds between the starts of the bursts (default 60)",
+    )
+    load.add_argument(
+        "--concurrency",
+        type=int,
+        default=10,
+        help="max concurrent lambda invocations (default 10)",
+    )
+    load.add_argument(
+        "--workers", type=int, default=2, help="local worker processes (default 2)"
+    )
+    load.add_argument(
+        "--rate", type=float, help="max events sent per second (default none)"
+    )
+
+    files = parser.add_argument_group("synthetic files")
+    source = files.add_mutually_exclusive_group()
+    source.add_argument("--template", help="local raw file the files are copies of")
+    source.add_argument(
+        "--template-key", help="raw file in the bucket the files are copies of"
+    )
+    files.add_argument(
+        "--file-size",
+        type=int,
+        default=1_000_000,
+        help="size of the random files if there is no template (default 1000000)",
+    )
+    files.add_argument(
+        "--name-template",
+        default=DEFAULT_NAME_TEMPLATE,
+        help="file name with {time}, {burst}, {index} and {suffix} fields (default"
+        f" {DEFAULT_NAME_TEMPLATE.replace('%', '%%')})",
+    )
+    files.add_argument(
+        "--file-interval",
+        type=float,
+        default=60,
+        help="seconds between the {time} of consecutive files (default 60)",
+    )
+    files.add_argument("--bucket", help="defaults to the input bucket")
+    files.add_argument(
+        "--prefix",
+        help="defaults to loadtest/{run id}/ (must not be watched by a trigger)",
+    )
+    files.add_argument(
+        "--create-buckets",
+        action="store_true",
+        help="create the input and output buckets (for the local S3 stand-in)",
+    )
+    files.add_argument(
+        "--upload-concurrency",
+        type=int,
+        default=16,
+        help="concurrent uploads (default 16)",
+    )
+    files.add_argument(
+        "--keep-files", action="store_true", help="don't delete the files afterwards"
+    )
+
+    target = parser.add_argument_group("target")
+    target.add_argument(
+        "--target", choices=[Target.Lambda, Target.Local], default=Target.Lambda
+    )
+    target.add_argument(
+        "--function-name", help="defaults to the deployed function for $BRANCH"
+    )
+    target.add_argument(
+        "--qualifier",
+        help="version or alias to invoke (defaults to the rollout alias of versioned"
+        " pipelines, else $LATEST)",
+    )
+    target.add_argument(
+        "--pipelines-repo",
+        default=".",
+        help="path to the pipelines repo for --target local (default .)",
+    )
+    target.add_argument(
+        "--event-shape",
+        choices=[S3Routing.Notifications, S3Routing.EventBridge],
+        help="defaults to the s3_routing in pipelines_config.yml",
+    )
+
+    output = parser.add_argument_group("output")
+    output.add_argument(
+        "--per-burst", action="store_true", help="also report each burst"
+    )
+    output.add_argument("--results", help="JSONL file with a record per file")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = get_parser().parse_args(argv)
+    if min(args.bursts, args.burst_size, args.concurrency, args.workers) < 1:
+        raise SystemExit(
+            "--bursts, --burst-size, --concurrency and --workers must be >= 1"
+        )
+    return loadtest(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
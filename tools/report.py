@@ -0,0 +1,296 @@
+"""Summarize pipeline latency and cost from the lambda handler's JSON log blobs.
+
+Each invocation of the lambda handler writes one JSON blob (see
+build_utils.logger.DelayedJSONStreamHandler) whose `context` section records the
+pipeline, config, success, inputs, code version, duration and configured memory.
+This command reads those blobs from files or directories and reports, per pipeline
+and config:  invocation counts, success rates, duration percentiles, input counts,
+estimated GB-seconds and cost, and regressions between code versions.  Invocations
+that don't run the pipeline (e.g., the warm-ups of a new version) are summarized
+in their own groups, so they don't skew the statistics of the pipeline runs.  Runs
+in container tasks (the container backend) are left out of the GB-seconds and cost,
+which are priced for lambda, and their task time is reported instead.
+
+The input files can be:
+
+    - one blob per line (e.g., saved handler output), optionally prefixed with a
+      CloudWatch timestamp/request id, or gzipped
+    - the JSON output of `aws logs filter-log-events`
+
+Examples:
+
+    aws logs filter-log-events --log-group-name /aws/lambda/$FUNCTION \\
+        --filter-pattern '"context"' > logs.json
+    python -m tools.report logs.json
+
+    python -m tools.report exported_logs/ --json > report.json
+"""
+
+import argparse
+import gzip
+import json
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# https://aws.amazon.com/lambda/pricing/ (x86, us-west-2)
+PRICE_PER_GB_SECOND = 0.0000166667
+PRICE_PER_REQUEST = 0.0000002
+
+
+def iter_files(paths: List[str]) -> Iterator[Path]:
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(p for p in path.rglob("*") if p.is_file())
+        else:
+            yield path
+
+
+def read_text(path: Path) -> str:
+    if path.suffix == ".gz":
+        with gzip.open(path, "rt") as file:
+            return file.read()
+    return path.read_text()
+
+
+def parse_blob(message: str) -> Optional[Dict[str, Any]]:
+    # Skip any CloudWatch timestamp/request id in front of the blob
+    start = message.find("{")
+    if start < 0:
+        return None
+    try:
+        blob = json.loads(message[start:])
+    except json.JSONDecodeError:
+        return None
+    if isinstance(blob, dict) and isinstance(blob.get("context"), dict):
+        return blob["context"]
+    return None
+
+
+def read_contexts(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    """Read the `context` of every handler log blob in the files."""
+    for path in iter_files(paths):
+        text = read_text(path)
+        try:
+            doc = json.loads(text)
+        except json.JSONDecodeError:
+            doc = None
+
+        if isinstance(doc, dict) and "events" in doc:
+            messages = [event.get("message", "") for event in doc["events"]]
+        elif isinstance(doc, dict):
+            messages = [text]
+        else:
+            messages = text.splitlines()
+
+        for message in messages:
+            context = parse_blob(message)
+            if context is not None:
+                yield context
+
+
+def get_kind(context: Dict[str, Any]) -> str:
+    """What the invocation did:  ran the pipeline ("run"), or only warmed up a new
+    version ("warmup"), scheduled a debounced run for new upstream data ("debounce")
+    or started the container task that runs it ("task_start")."""
+    if context.get("warmup"):
+        return "warmup"
+    if "debounce_scheduled" in context:
+        return "debounce"
+    if context.get("task"):
+        return "task_start"
+    return "run"
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(contexts: List[Dict[str, Any]], price_per_gb_s: float) -> Dict[str, Any]:
+    """Summarize a group of invocations."""
+    durations = [c["duration_s"] for c in contexts if "duration_s" in c]
+    # Fargate is priced differently, so only lambda runs are costed
+    lambdas = [c for c in contexts if c.get("backend") != "container"]
+    gb_seconds = sum(
+        c["duration_s"] * c["memory_mb"] / 1024
+        for c in lambdas
+        if c.get("duration_s") and c.get("memory_mb")
+    )
+    container_s = sum(
+        c.get("duration_s") or 0 for c in contexts if c.get("backend") == "container"
+    )
+    successes = sum(1 for c in contexts if c.get("success"))
+    inputs = [len(c.get("inputs") or []) for c in contexts]
+    start_times = sorted(c["start_time"] for c in contexts if c.get("start_time"))
+    return {
+        "invocations": len(contexts),
+        "success_rate": round(successes / len(contexts), 4) if contexts else 0,
+        "failures": len(contexts) - successes,
+        "duration_s": {
+            "p50": round(percentile(durations, 0.5), 3),
+            "p90": round(percentile(durations, 0.9), 3),
+            "p99": round(percentile(durations, 0.99), 3),
+            "max": round(max(durations, default=0), 3),
+        },
+        "inputs": {
+            "total": sum(inputs),
+            "mean": round(sum(inputs) / len(inputs), 2) if inputs else 0,
+        },
+        "gb_seconds": round(gb_seconds, 2),
+        "estimated_cost_usd": round(
+            gb_seconds * price_per_gb_s + len(lambdas) * PRICE_PER_REQUEST, 4
+        ),
+        "container_task_s": round(container_s, 2),
+        "first_seen": start_times[0] if start_times else None,
+        "last_seen": start_times[-1] if start_times else None,
+    }
+
+
+def find_regressions(
+    versions: Dict[str, Dict[str, Any]], threshold: float
+) -> List[Dict[str, Any]]:
+    """Compare each code version with the one deployed before it (ordered by when
+    they were first seen) and report p50/p90 duration, GB-seconds per invocation
+    and success rate changes that are worse than the threshold."""
+    ordered = sorted(
+        (v for v in versions.items() if v[1]["first_seen"]),
+        key=lambda v: v[1]["first_seen"],
+    )
+    regressions = []
+    for (old_version, old), (new_version, new) in zip(ordered, ordered[1:]):
+        changes = {}
+        for name in ("p50", "p90"):
+            before, after = old["duration_s"][name], new["duration_s"][name]
+            if before and after > before * (1 + threshold):
+                changes[f"duration_{name}_s"] = [before, after]
+        before = old["gb_seconds"] / old["invocations"]
+        after = new["gb_seconds"] / new["invocations"]
+        if before and after > before * (1 + threshold):
+            changes["gb_seconds_per_invocation"] = [round(before, 3), round(after, 3)]
+        if new["success_rate"] < old["success_rate"] - threshold / 4:
+            changes["success_rate"] = [old["success_rate"], new["success_rate"]]
+        if changes:
+            regressions.append(
+                {"from_version": old_version, "to_version": new_version, **changes}
+            )
+    return regressions
+
+
+def build_report(
+    contexts: List[Dict[str, Any]], price_per_gb_s: float, threshold: float
+) -> Dict[str, Any]:
+    groups: Dict[Tuple[str, str], List[Dict]] = defaultdict(list)
+    for context in contexts:
+        key = (context.get("pipeline") or "unknown", context.get("config_id") or "")
+        groups[key].append(context)
+
+    report = {}
+    for (pipeline, config_id), group in sorted(groups.items()):
+        by_kind: Dict[str, List[Dict]] = defaultdict(list)
+        for context in group:
+            by_kind[get_kind(context)].append(context)
+        runs = by_kind.pop("run", [])
+
+        by_version: Dict[str, List[Dict]] = defaultdict(list)
+        for context in runs:
+            by_version[context.get("code_version") or "unknown"].append(context)
+        versions = {
+            version: summarize(version_group, price_per_gb_s)
+            for version, version_group in by_version.items()
+        }
+        report[f"{pipeline}/{config_id}"] = {
+            **summarize(runs, price_per_gb_s),
+            "versions": versions,
+            "regressions": find_regressions(versions, threshold),
+            # The invocations that didn't run the pipeline, by kind
+            "other": {
+                kind: summarize(kind_group, price_per_gb_s)
+                for kind, kind_group in sorted(by_kind.items())
+            },
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    header = (
+        f"{'pipeline/config':<32} {'calls':>7} {'ok %':>6} {'p50 s':>8} {'p90 s':>8}"
+        f" {'p99 s':>8} {'inputs':>7} {'GB-s':>10} {'cost $':>9} {'task s':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for name, summary in report.items():
+        rows = [(name, summary)] + [
+            (f"  ({kind})", other) for kind, other in summary["other"].items()
+        ]
+        for label, row in rows:
+            d = row["duration_s"]
+            print(
+                f"{label:<32} {row['invocations']:>7}"
+                f" {row['success_rate'] * 100:>6.1f} {d['p50']:>8.2f} {d['p90']:>8.2f}"
+                f" {d['p99']:>8.2f} {row['inputs']['total']:>7}"
+                f" {row['gb_seconds']:>10.1f} {row['estimated_cost_usd']:>9.4f}"
+                f" {row['container_task_s']:>9.0f}"
+            )
+
+    regressions = [
+        (name, regression)
+        for name, summary in report.items()
+        for regression in summary["regressions"]
+    ]
+    if regressions:
+        print("\nRegressions between code versions:")
+        for name, regression in regressions:
+            changes = ", ".join(
+                f"{key} {value[0]} -> {value[1]}"
+                for key, value in regression.items()
+                if key not in ("from_version", "to_version")
+            )
+            print(
+                f"  {name}: {regression['from_version']} ->"
+                f" {regression['to_version']}: {changes}"
+            )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.report",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("paths", nargs="+", help="log files or directories")
+    parser.add_argument(
+        "--json", action="store_true", help="print the full report as JSON"
+    )
+    parser.add_argument(
+        "--price-per-gb-s",
+        type=float,
+        default=PRICE_PER_GB_SECOND,
+        help=f"lambda price per GB-second (default {PRICE_PER_GB_SECOND})",
+    )
+    parser.add_argument(
+        "--regression-threshold",
+        type=float,
+        default=0.2,
+        help="relative increase flagged as a regression (default 0.2 = 20%%)",
+    )
+    args = parser.parse_args(argv)
+
+    contexts = list(read_contexts(args.paths))
+    if not contexts:
+        print("No handler log blobs found", file=sys.stderr)
+        return 1
+
+    report = build_report(contexts, args.price_per_gb_s, args.regression_threshold)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
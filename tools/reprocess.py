@@ -0,0 +1,459 @@
+"""Reprocess the raw files under an ingest's input bucket path.
+
+Lists the keys under a run config's `input_bucket_path` (or any prefix) in a time
+range, groups them into batches, and sends each batch to the pipeline as a synthetic
+S3 event, either by invoking the deployed lambda function or by running the lambda
+handler in local worker processes.  Completed batches are appended to a JSONL
+progress file, so an interrupted run picks up where it left off when restarted with
+the same arguments.
+
+Examples:
+
+    # Reprocess a month of lidar/humboldt files with the deployed dev lambda
+    BRANCH=dev python -m tools.reprocess lidar humboldt \\
+        --start 20230101 --end 20230201 --concurrency 20 --rate 5
+
+    # Same thing with 4 local worker processes, run from the pipelines repo
+    BRANCH=dev python -m tools.reprocess lidar humboldt --target local \\
+        --workers 4 --pipelines-repo ../pipeline-template
+
+    # Only show the batches that would be sent
+    BRANCH=dev python -m tools.reprocess lidar humboldt --dry-run
+
+Keys in the same batch are processed by one pipeline run, exactly like an S3 event
+with several records, so only use --batch-size > 1 for pipelines that are meant to
+combine their input files.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+import boto3
+from botocore.config import Config
+
+from build_utils.pipelines_config import PipelineConfig, PipelinesConfig
+
+# Start of the date in a raw file name, e.g., lidar.z06.00.20201201.000000.sta.7z
+KEY_DATE_PATTERN = re.compile(r"(?<!\d)(\d{8})(?:[._-]?(\d{6}))?(?!\d)")
+
+LAMBDA_DIR = Path(__file__).resolve().parent.parent / "code_build" / "docker"
+
+
+class Target:
+    Lambda = "lambda"
+    Local = "local"
+
+
+class RawFile:
+    def __init__(self, key: str, size: int, time: datetime):
+        self.key = key
+        self.size = size
+        self.time = time
+
+
+class RateLimiter:
+    """Spaces out calls to `wait()` so there are at most `rate` per second."""
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_time(value: str) -> datetime:
+    for fmt in ("%Y%m%d.%H%M%S", "%Y%m%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"Invalid time: {value}")
+
+
+def get_key_time(key: str) -> Optional[datetime]:
+    match = KEY_DATE_PATTERN.search(Path(key).name)
+    if not match:
+        return None
+    date, time_of_day = match.group(1), match.group(2) or "000000"
+    try:
+        return datetime.strptime(date + time_of_day, "%Y%m%d%H%M%S").replace(
+            tzinfo=timezone.utc
+        )
+    except ValueError:
+        return None
+
+
+def list_raw_files(
+    s3_client,
+    bucket: str,
+    prefix: str,
+    start: Optional[datetime],
+    end: Optional[datetime],
+    by_key_date: bool,
+) -> Iterator[RawFile]:
+    """List the files under the prefix whose time is in [start, end).  The time is
+    the object's LastModified, or the date in the file name if by_key_date."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.endswith("/"):
+                continue
+            file_time = get_key_time(key) if by_key_date else obj["LastModified"]
+            if file_time is None:
+                print(f"Skipping {key}: no date in the file name")
+                continue
+            if (start and file_time < start) or (end and file_time >= end):
+                continue
+            yield RawFile(key, obj["Size"], file_time)
+
+
+def make_event(bucket: str, files: List[RawFile], config_id: str) -> Dict:
+    """Make an S3 event like the ones that trigger the ingest lambda.  The config id
+    tells the lambda of a consolidated pipeline which config to run, since --prefix
+    may not be under the config's input_bucket_path."""
+    return {
+        "config_id": config_id,
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": bucket},
+                    "object": {"key": f.key, "size": f.size},
+                },
+            }
+            for f in files
+        ],
+    }
+
+
+def load_progress(path: Path) -> Set[str]:
+    """Get the keys that were already processed successfully."""
+    done: Set[str] = set()
+    if path.exists():
+        with open(path) as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if record["status"] == "ok":
+                    done.update(record["keys"])
+    return done
+
+
+def get_qualifier(pipeline_config: PipelineConfig) -> Optional[str]:
+    """The alias the triggers of a versioned pipeline invoke, so that events sent by
+    the tools run the same code as the triggers (e.g., not a rolled back $LATEST)."""
+    if pipeline_config.rollout.versioned:
+        return pipeline_config.rollout.alias
+    return None
+
+
+def invoke_lambda(
+    lambda_client, function_name: str, event: Dict, qualifier: Optional[str] = None
+) -> Optional[str]:
+    """Invoke the deployed function (or its qualifier) and wait for it.  Returns an
+    error message, or None if the pipeline succeeded."""
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType="RequestResponse",
+        Payload=json.dumps(event).encode(),
+        **({"Qualifier": qualifier} if qualifier else {}),
+    )
+    payload = response["Payload"].read().decode()
+    if "FunctionError" in response:
+        return f"{response['FunctionError']}: {payload[:500]}"
+    # The handler returns True if the pipeline failed
+    if json.loads(payload or "false"):
+        return "Pipeline failed (see the function's logs)"
+    return None
+
+
+def _init_local_worker(pipeline: str, config_id: str, pipelines_repo: str):
+    pipelines_repo = os.path.abspath(pipelines_repo)
+    os.environ["PIPELINE_NAME"] = pipeline
+    os.environ["CONFIG_ID"] = config_id
+    os.environ.setdefault(
+        "PIPELINES_CONFIG_PATH", str(PipelinesConfig.get_config_file_path())
+    )
+    # Each worker downloads into its own scratch root, so none of them can delete
+    # another's inputs (see build_utils.scratch)
+    scratch_root = os.environ.get("TSDAT_SCRATCH_DIR", "/tmp/tsdat-scratch")
+    os.environ["TSDAT_SCRATCH_DIR"] = os.path.join(
+        scratch_root, f"worker-{os.getpid()}"
+    )
+    os.chdir(pipelines_repo)
+    sys.path.insert(0, pipelines_repo)
+    sys.path.insert(0, str(LAMBDA_DIR))
+
+
+def invoke_local(event: Dict) -> Optional[str]:
+    """Run the lambda handler in this (worker) process."""
+    import lambda_function
+
+    if lambda_function.lambda_handler(event, None):
+        return "Pipeline failed (see the log output)"
+    return None
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def reprocess(args: argparse.Namespace) -> int:
+    config = PipelinesConfig()
+    pipeline_config = config.pipelines[args.pipeline]
+    run_config = pipeline_config.configs[args.config_id]
+    bucket = args.bucket or config.input_bucket_name
+    prefix = args.prefix or run_config.input_bucket_path
+    if not prefix:
+        raise ValueError(
+            f"{args.pipeline} {args.config_id} has no input_bucket_path; use --prefix"
+        )
+    prefix = prefix if prefix.endswith("/") else f"{prefix}/"
+
+    s3_client = boto3.client("s3", region_name=config.region)
+    files = sorted(
+        list_raw_files(
+            s3_client, bucket, prefix, args.start, args.end, args.by_key_date
+        ),
+        key=lambda f: (f.time, f.key),
+    )
+
+    progress_path = Path(args.progress)
+    done = load_progress(progress_path)
+    todo = [f for f in files if f.key not in done]
+    batches = [
+        todo[i : i + args.batch_size] for i in range(0, len(todo), args.batch_size)
+    ]
+    print(
+        f"Found {len(files)} files under s3://{bucket}/{prefix}"
+        f" ({len(files) - len(todo)} already done).  Sending {len(batches)} batches"
+        f" to {args.target}."
+    )
+    if args.dry_run:
+        for batch in batches:
+            print(" ".join(f.key for f in batch))
+        return 0
+
+    executor: Executor
+    if args.target == Target.Lambda:
+        function_name = args.function_name or config.get_function_name(
+            args.pipeline, args.config_id
+        )
+        lambda_client = boto3.client(
+            "lambda",
+            region_name=config.region,
+            # Invocations can take up to the 15 minute lambda timeout
+            config=Config(
+                read_timeout=960,
+                retries={"max_attempts": 0},
+                max_pool_connections=args.concurrency,
+            ),
+        )
+        qualifier = args.qualifier or get_qualifier(pipeline_config)
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+
+        def submit(event: Dict) -> Future:
+            return executor.submit(
+                invoke_lambda, lambda_client, function_name, event, qualifier
+            )
+
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=_init_local_worker,
+            initargs=(args.pipeline, args.config_id, args.pipelines_repo),
+        )
+
+        def submit(event: Dict) -> Future:
+            return executor.submit(invoke_local, event)
+
+    limiter = RateLimiter(args.rate)
+    max_in_flight = args.concurrency if args.target == Target.Lambda else args.workers
+    in_flight: Dict[Future, tuple] = {}
+    latencies: List[float] = []
+    ok_batches = ok_files = ok_bytes = failed_batches = 0
+    started = time.monotonic()
+
+    with open(progress_path, "a") as progress, executor:
+
+        def collect(block: bool):
+            nonlocal ok_batches, ok_files, ok_bytes, failed_batches
+            if not in_flight:
+                return
+            finished, _ = wait(
+                list(in_flight),
+                timeout=None if block else 0,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in finished:
+                batch, batch_started = in_flight.pop(future)
+                duration = time.monotonic() - batch_started
+                try:
+                    error = future.result()
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                latencies.append(duration)
+                if error:
+                    failed_batches += 1
+                    print(f"FAILED {batch[0].key} (+{len(batch) - 1}): {error}")
+                else:
+                    ok_batches += 1
+                    ok_files += len(batch)
+                    ok_bytes += sum(f.size for f in batch)
+                record = {
+                    "keys": [f.key for f in batch],
+                    "status": "failed" if error else "ok",
+                    "duration_s": round(duration, 3),
+                    "error": error,
+                    "finished": datetime.now(timezone.utc).isoformat(),
+                }
+                progress.write(json.dumps(record) + "\n")
+                progress.flush()
+
+        try:
+            for i, batch in enumerate(batches):
+                while len(in_flight) >= max_in_flight:
+                    collect(block=True)
+                limiter.wait()
+                event = make_event(bucket, batch, args.config_id)
+                in_flight[submit(event)] = (batch, time.monotonic())
+                collect(block=False)
+                if (i + 1) % 100 == 0:
+                    print(f"Sent {i + 1}/{len(batches)} batches")
+            while in_flight:
+                collect(block=True)
+        except KeyboardInterrupt:
+            print("Interrupted: waiting for running batches to finish...")
+            executor.shutdown(wait=True, cancel_futures=True)
+            collect(block=False)
+
+    elapsed = time.monotonic() - started
+    print(
+        json.dumps(
+            {
+                "batches": len(batches),
+                "succeeded_batches": ok_batches,
+                "failed_batches": failed_batches,
+                "files_processed": ok_files,
+                "bytes_processed": ok_bytes,
+                "elapsed_s": round(elapsed, 1),
+                "files_per_s": round(ok_files / elapsed, 2) if elapsed else 0,
+                "mb_per_s": round(ok_bytes / 1e6 / elapsed, 2) if elapsed else 0,
+                "latency_s": {
+                    "p50": round(percentile(latencies, 0.5), 2),
+                    "p95": round(percentile(latencies, 0.95), 2),
+                    "max": round(max(latencies, default=0), 2),
+                },
+                "progress_file": str(progress_path),
+            },
+            indent=2,
+        )
+    )
+    return 1 if failed_batches else 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.reprocess",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("pipeline", help="pipeline name in pipelines_config.yml")
+    parser.add_argument("config_id", help="run config id of the pipeline")
+    parser.add_argument(
+        "--start", type=parse_time, help="only files at or after this time (UTC)"
+    )
+    parser.add_argument(
+        "--end", type=parse_time, help="only files before this time (UTC)"
+    )
+    parser.add_argument(
+        "--by-key-date",
+        action="store_true",
+        help="filter on the date in the file name instead of the S3 LastModified",
+    )
+    parser.add_argument("--bucket", help="defaults to the input bucket")
+    parser.add_argument("--prefix", help="defaults to the run's input_bucket_path")
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="files per invocation (default 1)"
+    )
+    parser.add_argument(
+        "--target", choices=[Target.Lambda, Target.Local], default=Target.Lambda
+    )
+    parser.add_argument(
+        "--function-name", help="defaults to the deployed function for $BRANCH"
+    )
+    parser.add_argument(
+        "--qualifier",
+        help="version or alias to invoke (defaults to the rollout alias of versioned"
+        " pipelines, else $LATEST)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=10,
+        help="max concurrent lambda invocations (default 10)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="local worker processes (default 2)"
+    )
+    parser.add_argument(
+        "--pipelines-repo",
+        default=".",
+        help="path to the pipelines repo for --target local (default .)",
+    )
+    parser.add_argument(
+        "--rate", type=float, help="max invocations started per second (default none)"
+    )
+    parser.add_argument(
+        "--progress",
+        default="reprocess-progress.jsonl",
+        help="JSONL file of finished batches, used to resume (default"
+        " reprocess-progress.jsonl)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="list the batches without sending them"
+    )
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = get_parser().parse_args(argv)
+    if args.batch_size < 1 or args.concurrency < 1 or args.workers < 1:
+        raise SystemExit("--batch-size, --concurrency and --workers must be >= 1")
+    return reprocess(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())